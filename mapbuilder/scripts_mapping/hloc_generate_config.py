@@ -48,6 +48,15 @@ def hloc_generate_config(hloc_dir, input_model_dir, output_dir, output_config_fi
                 "prior_model_path": str(input_model_dir_path),
                 "reconstruction_path": str(output_dir),
                 "optimize_poses": True,
+                # parameters of the localization in the MapLocalizer
+                "num_retrieved": 20, # number of map images retrieved for matching
+                "min_num_inliers": 20, # poses with fewer inliers are rejected
+                "adaptive_matching": False, # match the map images one by one and stop when the pose is confident
+                "cascade_matching": False, # run the learned matcher only if mutual nearest neighbour matching gives no confident pose
+                "localization_engine": "image_matching", # image_matching or direct (2D-3D matching with the descriptor index of the 3D points)
+                "default_profile": "balanced", # quality/latency profile of the requests without a profile (fast, balanced, accurate)
+                "inference_backend": "eager", # eager or torchscript (CPU only)
+                "inference_precision": "float32", # float32, int8 or bf16 (CPU only)
             },
         }
 
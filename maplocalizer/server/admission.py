@@ -0,0 +1,130 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Load-aware admission control of the localization requests.
+# The controller counts the localizations in flight (running or waiting for a worker thread) and keeps an exponentially
+# weighted moving average (EWMA) of the localization time of each map and profile. The expected latency of a new request
+# is its localization time plus the time to drain the localizations queued before it. If that does not fit into the
+# deadline of the request, the request is downgraded to the most accurate cheaper profile that fits, or rejected (shed),
+# so the admitted requests are served at a predictable latency instead of all of them timing out under overload.
+
+import threading
+from contextlib import contextmanager
+
+from metrics import count_shed, set_in_flight
+
+
+kDefaultEwmaWeight = 0.2 # weight of the newest measurement in the moving averages
+
+
+class AdmissionDecision:
+
+    def __init__(self, admitted: bool, profile=None, expected_latency=None, reason=None):
+        self.admitted = admitted
+        self.profile = profile # None: the profile selected for the request
+        self.expected_latency = expected_latency # seconds, None if unknown
+        self.reason = reason
+
+
+class AdmissionController:
+
+    # num_workers: number of concurrent localizations, max_queued: maximum number of waiting localizations (0: unlimited)
+    def __init__(self, num_workers, max_queued=0, ewma_weight=kDefaultEwmaWeight):
+        self.num_workers = max(num_workers, 1)
+        self.max_queued = max_queued
+        self.ewma_weight = ewma_weight
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latencies = {} # (map_id, profile) -> EWMA of the localization time in seconds
+        self.shed_counts = {"rejected": 0, "downgraded": 0}
+
+    # Number of localizations waiting for a worker thread
+    def queue_depth(self):
+        return max(self.in_flight - self.num_workers, 0)
+
+    # Expected latency (seconds) of a new localization with the profile, or None if the profile was not measured yet
+    def expected_latency(self, map_id, profile):
+        latency = self.latencies.get((map_id, profile))
+        if latency is None:
+            return None
+        # NOTE: the queued localizations drain num_workers at a time, approximated with the latency of the same profile
+        num_ahead = max(self.in_flight + 1 - self.num_workers, 0)
+        return latency * (1.0 + num_ahead / self.num_workers)
+
+    # Decides whether a request with the given profile can be admitted within the budget (seconds, None: no deadline).
+    # profiles are the other profiles of the map that the request can be downgraded to.
+    # fallback_profile is tried (optimistically) if no measured profile fits, as long as its latency is unknown.
+    def admit(self, map_id, profile, profiles, budget=None, fallback_profile=None, endpoint="localize") -> AdmissionDecision:
+        with self.lock:
+            if self.max_queued > 0 and self.queue_depth() >= self.max_queued:
+                decision = AdmissionDecision(False, reason=f"too many queued localizations ({self.queue_depth()})")
+            elif budget is None:
+                decision = AdmissionDecision(True, expected_latency=self.expected_latency(map_id, profile))
+            else:
+                decision = self.admit_within(map_id, profile, profiles, budget, fallback_profile)
+            if not decision.admitted:
+                self.shed_counts["rejected"] += 1
+                count_shed(map_id, endpoint, "rejected")
+            elif decision.profile is not None:
+                self.shed_counts["downgraded"] += 1
+                count_shed(map_id, endpoint, "downgraded")
+        return decision
+
+    def admit_within(self, map_id, profile, profiles, budget, fallback_profile):
+        expected = self.expected_latency(map_id, profile)
+        if budget <= 0:
+            return AdmissionDecision(False, expected_latency=expected, reason="the deadline has already passed")
+        if expected is None or expected <= budget:
+            return AdmissionDecision(True, expected_latency=expected)
+        # the most accurate (slowest) cheaper profile that fits
+        candidates = []
+        for other in profiles:
+            other_expected = self.expected_latency(map_id, other)
+            if other != profile and other_expected is not None and other_expected <= budget:
+                candidates.append((other_expected, other))
+        if len(candidates) > 0:
+            other_expected, other = max(candidates)
+            return AdmissionDecision(True, other, other_expected)
+        if fallback_profile is not None and fallback_profile != profile and self.expected_latency(map_id, fallback_profile) is None:
+            return AdmissionDecision(True, fallback_profile)
+        return AdmissionDecision(False, expected_latency=expected,
+            reason=f"expected latency {expected * 1000.0:.0f} ms exceeds the deadline ({budget * 1000.0:.0f} ms left)")
+
+    # Counts the enclosed localization as in flight (including its waiting for a worker thread)
+    @contextmanager
+    def track(self, map_id):
+        with self.lock:
+            self.in_flight += 1
+            set_in_flight(map_id, self.in_flight, self.queue_depth())
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                set_in_flight(map_id, self.in_flight, self.queue_depth())
+
+    # Updates the average localization time (without the waiting) of the map and profile
+    def observe_latency(self, map_id, profile, seconds):
+        with self.lock:
+            key = (map_id, profile)
+            if key not in self.latencies:
+                self.latencies[key] = seconds
+            else:
+                self.latencies[key] += self.ewma_weight * (seconds - self.latencies[key])
+
+    # Returns the state of the controller for monitoring
+    def status(self):
+        with self.lock:
+            return {
+                "inFlight": self.in_flight,
+                "queueDepth": self.queue_depth(),
+                "workers": self.num_workers,
+                "maxQueued": self.max_queued,
+                "shed": dict(self.shed_counts),
+                "latencyMs": {f"{map_id}/{profile}": latency * 1000.0 for (map_id, profile), latency in self.latencies.items()},
+            }
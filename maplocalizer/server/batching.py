@@ -0,0 +1,90 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Dynamic micro-batching of the feature extraction across concurrent requests.
+# The requests (running in different threads) submit their preprocessed images and wait for the result.
+# A worker thread takes the first waiting image, collects the images that arrive within a short delay (up to the maximum
+# batch size), runs them in one call of the batch function, and hands each result back to its request.
+# Under load, the images that queued up during the previous forward pass are taken without any delay.
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import observe_batch_size
+
+
+class MicroBatcher:
+
+    # batch_fn maps a list of inputs to the list of their results (in the same order)
+    def __init__(self, batch_fn, max_batch_size=8, max_delay=0.002, name="batcher", map_id=""):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay # seconds
+        self.name = name
+        self.map_id = map_id
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=f"{name}-{map_id}", daemon=True)
+        self.thread.start()
+
+    # Submits one input and returns a Future of its result
+    def submit(self, item) -> Future:
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                future.set_exception(RuntimeError(f"{self.name} is stopped"))
+            else:
+                self.queue.put((item, future))
+        return future
+
+    # Submits one input and waits for its result
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.perf_counter() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                try:
+                    # take what is already waiting, then wait for more until the deadline
+                    remaining = deadline - time.perf_counter()
+                    entry = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopped = True
+                    break
+                batch.append(entry)
+            self.process(batch)
+
+    def process(self, batch):
+        items = [item for item, _ in batch]
+        observe_batch_size(self.map_id, self.name, len(items))
+        try:
+            results = self.batch_fn(items)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    # Stops the worker thread after the inputs submitted so far are processed
+    def stop(self):
+        with self.lock:
+            if not self.stopped:
+                self.stopped = True
+                self.queue.put(None)
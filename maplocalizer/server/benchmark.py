@@ -0,0 +1,250 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+# This script replays query images with known poses through the localizer and reports the latency, throughput and accuracy.
+# The queries are given as a Colmap model (for example held-out StrayScanner frames converted with stray_to_colmap.py)
+# whose poses must be in the coordinate system of the map.
+# The localizer runs either in this process (with per-stage latencies) or behind the HTTP endpoint of a running server.
+#
+# Example usage
+# python server/benchmark.py --config_file /uploads/<dataset>/hlocMaps/<map>/config.yaml \
+#     --query_model /path/to/queries/sparse --query_images /path/to/queries/images --concurrency 4 --output results.json
+# python server/benchmark.py --config_file ... --query_model ... --query_images ... \
+#     --mode http --url http://localhost:8000/localize/geopose --concurrency 8
+#
+# Accuracy regression check of the quantized models (exits with 1 if a recall drops by more than --max_recall_drop)
+# python server/benchmark.py --config_file ... --query_model ... --query_images ... --precision float32 --output float32.json
+# python server/benchmark.py --config_file ... --query_model ... --query_images ... --precision int8 --baseline float32.json
+
+import argparse
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+import metrics
+from benchmark_utils import Query, load_queries, pose_errors, latency_summary
+from gpp_client import make_geopose_request, post_geopose_request
+from hloc_localizer import HlocLocalizer
+from image_utils import decode_image, scale_camera_parameters
+from log_utils import setup_logging
+from oscp.geopose import GeoPose
+
+
+kDefaultThresholds = "0.25,2;0.5,5;5,10" # (meters, degrees) pairs for the recall
+
+
+# Collects the raw per-stage latencies reported by the localizer
+class StageRecorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = defaultdict(list)
+
+    def __call__(self, map_id, stage, seconds):
+        with self.lock:
+            self.stages[stage].append(seconds)
+
+    def clear(self):
+        with self.lock:
+            self.stages.clear()
+
+
+def localize_in_process(localizer: HlocLocalizer, query: Query, profile=None):
+    t_start = time.perf_counter()
+    with open(query.image_path, "rb") as f:
+        data = f.read()
+    grayscale = not localizer.requires_color_image()
+    with metrics.time_stage(localizer.map_id, "decode"):
+        image, scale_x, scale_y = decode_image(data, localizer.get_max_image_size(), grayscale)
+        camera_parameters = query.camera_parameters
+        if scale_x != 1.0 or scale_y != 1.0:
+            camera_parameters = scale_camera_parameters(camera_parameters, scale_x, scale_y)
+    ret, _ = localizer.localize_in_map(image, camera_parameters, profile=profile)
+    pose_c2m = None
+    if ret is not None:
+        localizer.geopose_from_cam_from_world(ret["cam_from_world"]) # included in the latency like in the server
+        pose_c2m = np.eye(4)
+        pose_c2m[:3,:4] = ret["cam_from_world"].inverse().matrix()
+    return pose_c2m, time.perf_counter() - t_start, None
+
+
+def localize_over_http(localizer: HlocLocalizer, url: str, query: Query):
+    with open(query.image_path, "rb") as f:
+        data = f.read()
+    gppRequest = make_geopose_request(data, (query.width, query.height), query.camera_parameters)
+    status_code, jresponse, seconds = post_geopose_request(url, gppRequest.toJson())
+    pose_c2m = None
+    if status_code == 200 and jresponse is not None:
+        # NOTE: the GeoPose is converted back into the map with the map transform, so the map transform must be the same as in the server
+        pose_c2m = localizer.geopose_to_map_pose(GeoPose.fromJson(jresponse["geopose"]))
+    return pose_c2m, seconds, status_code
+
+
+def run_benchmark(localizer: HlocLocalizer, queries, mode="inprocess", url=None, concurrency=1, warmup=1, thresholds=None, profile=None):
+    if mode == "inprocess":
+        run_query = lambda query: localize_in_process(localizer, query, profile)
+    else:
+        if profile is not None:
+            url = url + ("&" if "?" in url else "?") + f"profile={profile}"
+        run_query = lambda query: localize_over_http(localizer, url, query)
+
+    recorder = StageRecorder()
+    metrics.stage_observers.append(recorder)
+    try:
+        for query in queries[:warmup]:
+            run_query(query)
+        recorder.clear()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(run_query, queries))
+        wall_time = time.perf_counter() - t_start
+    finally:
+        metrics.stage_observers.remove(recorder)
+
+    per_query = []
+    latencies = []
+    status_codes = defaultdict(int)
+    for query, (pose_c2m, seconds, status_code) in zip(queries, results):
+        latencies.append(seconds)
+        if status_code is not None:
+            status_codes[str(status_code)] += 1
+        item = {"name": query.name, "latency_ms": seconds * 1000.0, "localized": pose_c2m is not None}
+        if pose_c2m is not None:
+            item["position_error_m"], item["orientation_error_deg"] = pose_errors(pose_c2m, query.gt_pose_c2m, localizer.map_scale)
+        per_query.append(item)
+
+    localized = [q for q in per_query if q["localized"]]
+    recall = {}
+    for max_position_error, max_orientation_error in thresholds:
+        num_correct = sum(q["position_error_m"] <= max_position_error and q["orientation_error_deg"] <= max_orientation_error for q in localized)
+        recall[f"{max_position_error}m_{max_orientation_error}deg"] = num_correct / max(len(queries), 1)
+
+    memory = {"max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    if torch.cuda.is_available():
+        memory["cuda_max_allocated_mb"] = torch.cuda.max_memory_allocated() / (1024.0 * 1024.0)
+
+    report = {
+        "mode": mode,
+        "profile": profile,
+        "concurrency": concurrency,
+        "num_queries": len(queries),
+        "num_localized": len(localized),
+        "wall_time_s": wall_time,
+        "queries_per_second": len(queries) / wall_time if wall_time > 0 else 0.0,
+        "latency_ms": latency_summary(latencies),
+        "stage_latency_ms": {stage: latency_summary(s) for stage, s in sorted(recorder.stages.items())},
+        "recall": recall,
+        "median_position_error_m": float(np.median([q["position_error_m"] for q in localized])) if len(localized) > 0 else None,
+        "median_orientation_error_deg": float(np.median([q["orientation_error_deg"] for q in localized])) if len(localized) > 0 else None,
+        "memory": memory,
+        "per_query": per_query,
+    }
+    if mode == "http":
+        report["status_codes"] = dict(status_codes)
+    return report
+
+
+# Compares the recall of the report with the baseline report and returns the recalls that dropped by more than max_recall_drop
+def recall_regressions(report, baseline, max_recall_drop):
+    regressions = {}
+    for name, baseline_value in baseline["recall"].items():
+        value = report["recall"].get(name)
+        if value is None:
+            continue
+        print(f"Recall @ {name}: {100.0 * value:.1f}% (baseline {100.0 * baseline_value:.1f}%, {100.0 * (value - baseline_value):+.1f}%)")
+        if baseline_value - value > max_recall_drop:
+            regressions[name] = (value, baseline_value)
+    return regressions
+
+
+def print_report(report):
+    print(f"Localized {report['num_localized']} of {report['num_queries']} queries ({report['mode']}, concurrency {report['concurrency']})")
+    print(f"Throughput: {report['queries_per_second']:.2f} queries/s")
+    latency = report["latency_ms"]
+    print(f"Latency (ms): p50 {latency.get('p50', 0):.1f}  p90 {latency.get('p90', 0):.1f}  p99 {latency.get('p99', 0):.1f}  max {latency.get('max', 0):.1f}")
+    for stage, s in report["stage_latency_ms"].items():
+        print(f"  {stage:20s} n={s['count']:6d}  p50 {s['p50']:8.2f}  p90 {s['p90']:8.2f}  p99 {s['p99']:8.2f}  max {s['max']:8.2f}")
+    for name, value in report["recall"].items():
+        print(f"Recall @ {name}: {100.0 * value:.1f}%")
+    print(f"Memory: {report['memory']}")
+    if "precision" in report:
+        print(f"Inference precision: {report['precision']}")
+    if "status_codes" in report:
+        print(f"Status codes: {report['status_codes']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Localization benchmark for the OpenVPS MapLocalizer")
+    parser.add_argument("--config_file", type=str, required=True, help="config.yaml of the map (in the hlocMaps folder)")
+    parser.add_argument("--transform_file", type=str, default=None, help="transform.json of the map (default: next to the config)")
+    parser.add_argument("--query_model", type=str, required=True, help="Colmap model with the query cameras and poses in map coordinates")
+    parser.add_argument("--query_images", type=str, required=True, help="folder of the query images")
+    parser.add_argument("--mode", type=str, choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", type=str, default="http://localhost:8000/localize/geopose", help="localization endpoint in http mode")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1, help="number of queries to run before the measurements")
+    parser.add_argument("--max_queries", type=int, default=None)
+    parser.add_argument("--profile", type=str, default=None, help="quality/latency profile (default: the default profile of the map)")
+    parser.add_argument("--thresholds", type=str, default=kDefaultThresholds, help="recall thresholds as meters,degrees pairs separated by ;")
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the results")
+    parser.add_argument("--precision", type=str, default=None, help="inference precision of the models (float32, int8 or bf16, overrides the map config)")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of a baseline run (e.g. float32) to compare the recall with")
+    parser.add_argument("--max_recall_drop", type=float, default=0.01, help="maximum allowed drop of the recall compared to the baseline")
+    args = parser.parse_args()
+
+    setup_logging("WARNING")
+
+    config_path = Path(args.config_file)
+    transform_path = Path(args.transform_file) if args.transform_file is not None else config_path.parent / "transform.json"
+    thresholds = [tuple(float(v) for v in t.split(",")) for t in args.thresholds.split(";")]
+
+    localizer = HlocLocalizer(map_id=config_path.parent.name)
+    if not localizer.load_map_transform(transform_path):
+        print("Warning: no map transform, the errors are in map units")
+    if args.mode == "inprocess":
+        config = HlocLocalizer.load_map_config(config_path)
+        if config is None:
+            print("Error: invalid config file: " + str(config_path))
+            exit(-1)
+        if args.precision is not None:
+            config['inference_precision'] = args.precision
+        localizer.load_map(config)
+
+    queries = load_queries(Path(args.query_model), Path(args.query_images), args.max_queries)
+    if len(queries) == 0:
+        print("Error: no query images found")
+        exit(-1)
+    print(f"{len(queries)} query images")
+
+    report = run_benchmark(localizer, queries, args.mode, args.url, args.concurrency, args.warmup, thresholds, args.profile)
+    if args.mode == "inprocess":
+        report["precision"] = localizer.inference_precisions
+    print_report(report)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = recall_regressions(report, baseline, args.max_recall_drop)
+        if len(regressions) > 0:
+            print(f"Error: the recall dropped by more than {100.0 * args.max_recall_drop:.1f}% at {', '.join(regressions)}")
+            exit(1)
+        print("No recall regression compared to the baseline")
@@ -0,0 +1,67 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Helpers of the benchmark and load-test tools. They do not depend on the localizer, so the load-test client can run without hloc.
+
+from pathlib import Path
+
+import numpy as np
+import pycolmap
+
+from oscp.geoposeprotocol import CameraModel, CameraParameters
+
+
+kPercentiles = (50, 90, 95, 99)
+
+
+class Query:
+
+    def __init__(self, name, image_path, width, height, camera_parameters, gt_pose_c2m):
+        self.name = name
+        self.image_path = image_path
+        self.width = width
+        self.height = height
+        self.camera_parameters = camera_parameters
+        self.gt_pose_c2m = gt_pose_c2m # 4x4 camera-to-map pose
+
+
+# Reads the query images and their ground truth poses from a Colmap model (text or binary)
+def load_queries(query_model_path: Path, query_images_path: Path, max_queries=None):
+    model = pycolmap.Reconstruction(str(query_model_path))
+    queries = []
+    for image in sorted(model.images.values(), key=lambda i: i.name):
+        image_path = query_images_path / image.name
+        if not image_path.exists():
+            print(f"Skipping {image.name}, image not found")
+            continue
+        camera = model.cameras[image.camera_id]
+        camera_parameters = CameraParameters(model=CameraModel.fromJson(camera.model.name), modelParams=list(camera.params))
+        gt_pose_c2m = np.eye(4)
+        gt_pose_c2m[:3,:4] = image.cam_from_world.inverse().matrix()
+        queries.append(Query(image.name, image_path, camera.width, camera.height, camera_parameters, gt_pose_c2m))
+        if max_queries is not None and len(queries) >= max_queries:
+            break
+    return queries
+
+
+# Returns the position error (meters) and orientation error (degrees) of the estimated pose
+def pose_errors(pose_c2m, gt_pose_c2m, map_scale):
+    position_error = np.linalg.norm(pose_c2m[:3,3] - gt_pose_c2m[:3,3]) * map_scale
+    cos_angle = (np.trace(np.matmul(pose_c2m[:3,:3].T, gt_pose_c2m[:3,:3])) - 1.0) / 2.0
+    orientation_error = np.degrees(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+    return float(position_error), float(orientation_error)
+
+
+def latency_summary(seconds_list):
+    if len(seconds_list) == 0:
+        return {"count": 0}
+    ms = np.array(seconds_list) * 1000.0
+    summary = {"count": len(ms), "mean": float(ms.mean()), "max": float(ms.max())}
+    for p in kPercentiles:
+        summary[f"p{p}"] = float(np.percentile(ms, p))
+    return summary
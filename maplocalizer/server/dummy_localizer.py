@@ -16,7 +16,7 @@ kDefaultLon = 19.079377689751166
 
 class DummyLocalizer:
 
-    async def localize(self, query_image, camera_parameters: CameraParameters):
+    async def localize(self, query_image, camera_parameters: CameraParameters, prior_geopose: GeoPose | None = None):
         time.sleep(1)
         dummyGeoPose = GeoPose(position=Position(lat=kDefaultLat, lon=kDefaultLon))
         return dummyGeoPose
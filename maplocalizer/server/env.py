@@ -12,7 +12,19 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 class Settings(BaseSettings):
     appName:str = "MapLocalizer"
     uploadsDir:str = ""
-    debug:bool = False
+    debug:bool = False # also sets the log level to DEBUG
+    logLevel:str = "INFO"
+    logSampleRate:float = 1.0 # fraction of the requests whose verbose diagnostics are logged (at DEBUG level)
+    tracking:bool = False # frame-to-frame tracking for consecutive requests of the same client and camera
+    priorPoseMaxAge:float = 0.0 # milliseconds, prior poses older than this are ignored. 0 disables the prior-guided retrieval (opt-in).
+    localizationThreads:int = 4 # number of localizations that run concurrently in worker threads
+    resultCacheTtl:float = 0.0 # milliseconds, the results of identical queries are reused for this long. 0 disables the cache.
+    resultCacheSize:int = 256 # maximum number of cached results
+    batchingMaxDelay:float = 2.0 # milliseconds, concurrent feature extractions are batched within this delay. Set to a negative value to disable.
+    loadProfileThreshold:int = 0 # requests without a profile use loadProfile if at least this many localizations are running or waiting. Set to 0 to disable.
+    loadProfile:str = "fast" # quality/latency profile used under load
+    requestDeadline:float = 0.0 # milliseconds, requests that cannot be localized within this time are downgraded or rejected. Set to 0 to disable.
+    maxQueuedLocalizations:int = 0 # requests are rejected if this many localizations are waiting for a worker thread. Set to 0 to disable.
 
     # this line loads the env_file and overwrites the values in this class (case-insensitive)
     model_config = SettingsConfigDict(env_file="server/.env")
@@ -0,0 +1,82 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Minimal GeoPoseProtocol client for the benchmark and load-test tools
+
+import base64
+import json
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+
+from oscp.geopose import GeoPose
+from oscp.geoposeprotocol import GeoPoseRequest, GeoPoseResponse, GeolocationReading, CameraReading, CameraParameters, \
+    ImageFormat, ImageOrientation, Privacy, Sensor, SensorReadings, SensorType
+
+kAcceptHeader = "application/vnd.oscp+json;version=2.0"
+
+
+def get_timestamp_ms():
+    return datetime.now(timezone.utc).timestamp() * 1000.0
+
+
+# Creates a GeoPoseRequest with a single camera reading.
+# image_bytes is the encoded image (JPG) or the raw GRAY8/RGBA32 buffer, size is (width, height).
+# Optionally a prior pose and a geolocation reading (latitude, longitude, altitude, accuracy) are added.
+def make_geopose_request(image_bytes: bytes, size, camera_parameters: CameraParameters,
+        image_format=ImageFormat.JPG, image_orientation: ImageOrientation | None = None, sensor_id="camera",
+        prior_geopose: GeoPose | None = None, geolocation=None, timestamp=None) -> GeoPoseRequest:
+    # NOTE: the default arguments of the protocol classes are evaluated only once, so we always pass new ids and timestamps
+    if timestamp is None:
+        timestamp = get_timestamp_ms()
+    sensors = [Sensor(type=SensorType.CAMERA, id=sensor_id)]
+    camera_reading = CameraReading(timestamp=timestamp, sensorId=sensor_id, privacy=Privacy(),
+        imageFormat=image_format, size=[int(size[0]), int(size[1])],
+        imageBytes=base64.b64encode(image_bytes).decode("ascii"),
+        imageOrientation=image_orientation if image_orientation is not None else ImageOrientation(),
+        params=camera_parameters)
+    sensor_readings = SensorReadings(cameraReadings=[camera_reading])
+
+    if geolocation is not None:
+        sensors.append(Sensor(type=SensorType.GEOLOCATION, id="geolocation"))
+        latitude, longitude, altitude, accuracy = geolocation
+        sensor_readings.geolocationReadings.append(GeolocationReading(timestamp=timestamp, sensorId="geolocation",
+            privacy=Privacy(), latitude=latitude, longitude=longitude, altitude=altitude, accuracy=accuracy))
+
+    prior_poses = []
+    if prior_geopose is not None:
+        prior_poses.append(GeoPoseResponse(id=str(uuid.uuid4()), timestamp=timestamp, geopose=prior_geopose))
+
+    return GeoPoseRequest(id=str(uuid.uuid4()), timestamp=timestamp, sensors=sensors,
+        sensorReadings=sensor_readings, priorPoses=prior_poses)
+
+
+# Sends the request body (JSON string) to the localization endpoint.
+# Returns the HTTP status code (0 on connection errors), the parsed JSON response (or None) and the latency in seconds.
+def post_geopose_request(url: str, body: str, timeout=60.0):
+    http_request = urllib.request.Request(url, data=body.encode("utf-8"), method="POST",
+        headers={"Content-Type": "application/json", "Accept": kAcceptHeader})
+    t_start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as http_response:
+            status_code = http_response.status
+            data = http_response.read()
+    except urllib.error.HTTPError as e:
+        status_code = e.code
+        data = e.read()
+    except (urllib.error.URLError, OSError):
+        return 0, None, time.perf_counter() - t_start
+    seconds = time.perf_counter() - t_start
+
+    try:
+        jresponse = json.loads(data)
+    except ValueError:
+        jresponse = None
+    return status_code, jresponse, seconds
@@ -17,7 +17,10 @@ from hloc.localize_sfm import do_covisibility_clustering
 
 from types import SimpleNamespace
 from typing import List, Tuple
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+import queue
+import threading
+import time
 
 import torch
 import numpy as np
@@ -31,8 +34,77 @@ import json
 import yaml
 
 from oscp.geopose import GeoPose, Position, Quaternion
-from oscp.geoposeprotocol import CameraParameters
-from oscp.geopose_utils import enu_to_geodetic
+from oscp.geoposeprotocol import CameraParameters, GeoPoseAccuracy
+from oscp.geopose_utils import LocalTangentFrame
+
+from metrics import time_stage, count_failure, observe_inliers, count_cascade
+from log_utils import get_logger, get_diagnostics_logger
+from map_export import export_point_cloud
+from batching import MicroBatcher
+from nn_matching import kDefaultRatioThreshold, mutual_nn_match_batch
+from point_index import kDefaultNumWords, kDefaultNumAssignedWords, load_or_build_point_index
+from inference_backend import kInferenceBackends, kDefaultInferenceBackend, compile_model, example_image, load_precisions, quantize_model, set_inference_threads
+
+logger = get_logger("localizer")
+diagnostics_logger = get_diagnostics_logger()
+
+
+# Default parameters of the prior-guided retrieval. They can be overwritten in the map config.
+kDefaultPriorMaxDistance = 10.0 # meters, maximum distance of the reference camera centres from the prior position
+kDefaultPriorMaxAngle = 60.0 # degrees, maximum angle between the reference and prior viewing directions
+kDefaultPriorMinCandidates = 3 # if fewer reference images are found near the prior, we fall back to global retrieval
+
+# Default parameters of the frame-to-frame tracking. They can be overwritten in the map config.
+kDefaultTrackingSearchRadius = 30.0 # pixels, search radius around the projected points
+kDefaultTrackingMinSimilarity = 0.7 # minimum descriptor similarity (dot product) of a tracked point and a keypoint
+kDefaultTrackingMinInliers = 30 # tracking is lost if fewer inliers remain
+kDefaultTrackingMaxGap = 1.0 # seconds, tracking is lost if there was no frame for this long
+kMaxTrackingSessions = 100 # the least recently used sessions are dropped above this limit
+
+kDefaultMaxHypotheses = 5 # maximum number of pose hypotheses (one per covisibility cluster) returned by localize_hypotheses()
+
+# Default parameters of the retrieval and pose estimation. They can be overwritten in the map config.
+kDefaultNumRetrieved = 20 # number of map images retrieved (or selected around the prior) for matching
+kDefaultMinNumInliers = 20 # poses with fewer inliers are rejected
+kDefaultAdaptiveMatching = False # match the map images one by one and stop when the pose is confident
+kDefaultAdaptiveMinCorrespondences = 50 # PnP is attempted once a covisibility cluster has this many 2D-3D correspondences
+kDefaultAdaptiveConfidentInliers = 100 # the matching stops when a pose has at least this many inliers
+kAdaptiveAttemptGrowth = 1.5 # the next PnP attempt of a cluster needs this factor more correspondences
+kDefaultCascadeMatching = False # match with mutual nearest neighbours first and run the learned matcher only if the pose is not confident
+kDefaultCascadeConfidentInliers = 60 # the pose from the mutual nearest neighbour matches is accepted with at least this many inliers
+kLocalizationEngines = ("image_matching", "direct") # direct: the query keypoints are matched with the 3D points (see point_index.py)
+kDefaultLocalizationEngine = "image_matching"
+
+# Quality/latency profiles of the localization. The values override the parameters of the map, None keeps the map's value:
+#   resize_max           maximum query image size for the feature extraction (only downscales, the map's resize_max is the upper limit)
+#   max_keypoints        the query keypoints with the highest detection scores are kept
+#   num_retrieved        number of map images retrieved (or selected around the prior) for matching
+#   max_clusters         number of covisibility clusters (the largest ones) for which PnP is attempted
+#   refine_focal_length  the focal length (and the extra parameters) of the query camera are refined with the pose
+#   adaptive_matching    see kDefaultAdaptiveMatching
+#   cascade_matching     see kDefaultCascadeMatching
+# The profiles can be overwritten (and new ones added) with the 'profiles' dict of the map config.
+kDefaultProfiles = {
+    "fast": {"resize_max": 640, "max_keypoints": 1024, "num_retrieved": 5, "max_clusters": 1, "refine_focal_length": False, "adaptive_matching": True,
+        "cascade_matching": True},
+    "balanced": {},
+    "accurate": {"num_retrieved": 40, "adaptive_matching": False},
+}
+kDefaultProfile = "balanced"
+
+kMaxExtractionBatchSize = 8 # maximum number of images in one forward pass of the feature extractors
+kMaxCachedRefFeatures = 100 # maximum number of map images whose local features are kept in memory during batch localization
+kDefaultPrefetchRefFeatures = True # read the local features of the map images in a background thread while matching
+kMaxPrefetchedRefFeatures = 8 # maximum number of map images read ahead of the matching
+kAdaptiveMaxPrefetchedRefFeatures = 2 # fewer in adaptive matching, which might stop early
+
+# rotation from computer vision (X right, Y down, Z forward) to robotics convention (X forward, Y left, Z up)
+kRotationCvToRob = Rotation.from_matrix([
+    [0.0,-1.0, 0.0],
+    [0.0, 0.0,-1.0],
+    [1.0, 0.0, 0.0]
+])
+kRotationMatrixCvToRob = kRotationCvToRob.as_matrix()
 
 
 # code adapted from hloc.localize_sfm.QueryLocalizer
@@ -50,24 +122,114 @@ class QueryLocalizerNew:
 
         points2D = points2D_all[points2D_idxs]
         points3D = [self.reconstruction.points3D[j].xyz for j in points3D_id]
+        return self.localize_points(points2D, points3D, query_camera)
+
+    # NOTE: same as localize() but the 3D points are given directly instead of their ids in the reconstruction
+    def localize_points(self, points2D, points3D, query_camera):
+        if len(points2D) < 4: # Note: not enough points!
+            return None
+
         ret = pycolmap.estimate_and_refine_absolute_pose(
             points2D,
             points3D,
             query_camera,
             estimation_options=self.config.get("estimation", {}),
             refinement_options=self.config.get("refinement", {}),
+            return_covariance=self.config.get("return_covariance", False),
         )
         return ret
 
 
+# A pose hypothesis of the query camera, estimated from one covisibility cluster of the reference images
+class PoseHypothesis:
+
+    def __init__(self, geopose: GeoPose, accuracy: GeoPoseAccuracy, numInliers: int):
+        self.geopose = geopose
+        self.accuracy = accuracy
+        self.numInliers = numInliers
+
+
+# Localization parameters of a quality/latency profile, resolved against the parameters of the map
+class LocalizationProfile:
+
+    def __init__(self, name, resize_max=None, max_keypoints=None, num_retrieved=kDefaultNumRetrieved, max_clusters=None,
+            refine_focal_length=True, adaptive_matching=kDefaultAdaptiveMatching, cascade_matching=kDefaultCascadeMatching):
+        self.name = name
+        self.resize_max = resize_max
+        self.max_keypoints = max_keypoints
+        self.num_retrieved = num_retrieved
+        self.max_clusters = max_clusters
+        self.refine_focal_length = refine_focal_length
+        self.adaptive_matching = adaptive_matching
+        self.cascade_matching = cascade_matching
+
+
+# Reads the local features of map images in a background thread, in the given order, so that the HDF5 reads and
+# the tensor conversions overlap with the matching. The matching loop takes the features in the same order with get().
+class RefFeaturePrefetcher:
+
+    def __init__(self, load_ref_features, ref_names, max_prefetched=kMaxPrefetchedRefFeatures):
+        self.pending = deque(ref_names)
+        self.queue = queue.Queue(maxsize=max_prefetched)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(load_ref_features, list(ref_names)), daemon=True)
+        self.thread.start()
+
+    def run(self, load_ref_features, ref_names):
+        for ref_name in ref_names:
+            if self.stopped.is_set():
+                return
+            try:
+                item = (load_ref_features(ref_name), None)
+            except Exception as e:
+                item = (None, e) # raised in the matching thread
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    # Whether ref_name is the next map image whose features are read
+    def is_next(self, ref_name):
+        return len(self.pending) > 0 and self.pending[0] == ref_name
+
+    def get(self, ref_name):
+        assert self.is_next(ref_name)
+        self.pending.popleft()
+        data, error = self.queue.get()
+        if error is not None:
+            raise error
+        return data
+
+    # Stops the reading, e.g. when the matching stopped early
+    def stop(self):
+        self.stopped.set()
+
+
+# The inlier 3D points of the last successfully localized frame of a tracking session
+class TrackingState:
+
+    def __init__(self, cam_from_world, points3D, descriptors):
+        self.cam_from_world = cam_from_world # pycolmap.Rigid3d of the last frame
+        self.points3D = points3D # Nx3 array of the inlier 3D points in map coordinates
+        self.descriptors = descriptors # DxN array of the query descriptors of the inlier points
+        self.timestamp = time.monotonic()
+
+
 class HlocLocalizer():
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, map_id=""):
         self.debug=debug
+        self.map_id = map_id # used as label of the metrics
         self.kQueryImageName = 'query'
         self.covisibility_clustering = True
-        self.map_to_ENU_transform = np.eye(4)
-        self.map_geodetic_ref = Position(0,0,0)
+        self.set_map_transform(np.eye(4), Position(0,0,0))
+        self.tracking_states = OrderedDict()
+        self.tracking_lock = threading.Lock()
+        self.local_batcher = None
+        self.global_batcher = None
+        self.inference_precisions = load_precisions(None)
 
 
     def get_all_map_ids_and_paths(rootDir:str|Path):
@@ -110,25 +272,146 @@ class HlocLocalizer():
 
                 return mapConfig
             except yaml.YAMLError as err:
-                print(err)
+                logger.error(err)
                 return None
 
 
     def load_map(self, config):
         self.config = config
+        self.load_models(config)
+
+        # Load map (reconstruction)
+        map_path = Path(config['reconstruction_path']) # / 'models' / '0'
+        if not map_path.exists() or not map_path.is_dir():
+            raise FileNotFoundError(f"map path {str(map_path)} does not exist")
+        logger.info("Map path: %s", map_path)
+        self.reconstruction = pycolmap.Reconstruction()
+        self.reconstruction.read(str(map_path))
+
+        self.map_image_names = [i.name for i in self.reconstruction.images.values()]
+        if len(self.map_image_names) == 0:
+            raise ValueError("Could not find any map images.")
+
+        self.db_name_to_id = {img.name: i for i, img in self.reconstruction.images.items()}
+        self.load_map_image_poses()
+
+        # Parameters of the prior-guided retrieval
+        self.prior_max_distance = config.get('prior_max_distance', kDefaultPriorMaxDistance)
+        self.prior_max_angle = config.get('prior_max_angle', kDefaultPriorMaxAngle)
+        self.prior_min_candidates = config.get('prior_min_candidates', kDefaultPriorMinCandidates)
+
+        # Parameters of the retrieval and pose estimation
+        self.num_retrieved = config.get('num_retrieved', kDefaultNumRetrieved)
+        self.min_num_inliers = config.get('min_num_inliers', kDefaultMinNumInliers)
+        self.max_hypotheses = config.get('max_hypotheses', kDefaultMaxHypotheses)
+        self.adaptive_matching = config.get('adaptive_matching', kDefaultAdaptiveMatching)
+        self.adaptive_min_correspondences = config.get('adaptive_min_correspondences', kDefaultAdaptiveMinCorrespondences)
+        self.adaptive_confident_inliers = config.get('adaptive_confident_inliers', kDefaultAdaptiveConfidentInliers)
+        self.cascade_matching = config.get('cascade_matching', kDefaultCascadeMatching)
+        self.cascade_ratio_threshold = config.get('cascade_ratio_threshold', kDefaultRatioThreshold)
+        self.cascade_confident_inliers = config.get('cascade_confident_inliers', kDefaultCascadeConfidentInliers)
+
+        # Parameters of the frame-to-frame tracking
+        self.tracking_search_radius = config.get('tracking_search_radius', kDefaultTrackingSearchRadius)
+        self.tracking_min_similarity = config.get('tracking_min_similarity', kDefaultTrackingMinSimilarity)
+        self.tracking_min_inliers = config.get('tracking_min_inliers', kDefaultTrackingMinInliers)
+        self.tracking_max_gap = config.get('tracking_max_gap', kDefaultTrackingMaxGap)
+
+        # Background reading of the map features during matching
+        self.prefetch_ref_features = config.get('prefetch_ref_features', kDefaultPrefetchRefFeatures)
+
+        # Quality/latency profiles
+        self.profiles = self.load_profiles(config.get('profiles', {}))
+        self.default_profile = config.get('default_profile', kDefaultProfile)
+        if self.default_profile not in self.profiles:
+            raise ValueError(f"unknown default profile {self.default_profile}")
+
+        # Load map local features
+        local_features_path = Path(config['reconstruction_path']) / 'features.h5'
+        self.load_map_local_features(local_features_path)
 
+        # Descriptor index of the 3D points for the direct 2D-3D matching (optional)
+        self.localization_engine = config.get('localization_engine', kDefaultLocalizationEngine)
+        if self.localization_engine not in kLocalizationEngines:
+            raise ValueError(f"unknown localization engine {self.localization_engine}, must be one of {kLocalizationEngines}")
+        self.point_index = None
+        if self.localization_engine == "direct":
+            self.direct_num_assigned_words = config.get('direct_num_assigned_words', kDefaultNumAssignedWords)
+            self.direct_ratio_threshold = config.get('direct_ratio_threshold', kDefaultRatioThreshold)
+            self.point_index = load_or_build_point_index(self.reconstruction, self.map_local_descriptors, local_features_path,
+                Path(config['reconstruction_path']) / 'point_index.h5', config.get('direct_num_words', kDefaultNumWords))
+
+        # Load map global features
+        global_features_path = Path(config['reconstruction_path']) / 'global_features.h5'
+        if global_features_path.exists():
+            self.load_map_global_features(global_features_path)
+
+
+    # Resolves the profiles (the defaults updated with the ones of the map config) against the parameters of the map
+    def load_profiles(self, profiles_config):
+        profiles = {}
+        for name in dict.fromkeys(list(kDefaultProfiles.keys()) + list(profiles_config.keys())):
+            overrides = {**kDefaultProfiles.get(name, {}), **(profiles_config.get(name) or {})}
+            profile = LocalizationProfile(name, num_retrieved=self.num_retrieved, adaptive_matching=self.adaptive_matching,
+                cascade_matching=self.cascade_matching)
+            for key, value in overrides.items():
+                if not hasattr(profile, key) or key == "name":
+                    raise ValueError(f"unknown parameter {key} in profile {name}")
+                if value is not None:
+                    setattr(profile, key, value)
+            profiles[name] = profile
+        logger.info("Profiles: %s", {name: vars(profile) for name, profile in profiles.items()})
+        return profiles
+
+
+    # Returns the profile with the given name (the default profile if None)
+    def get_profile(self, name=None) -> LocalizationProfile:
+        if name is None:
+            name = self.default_profile
+        if name not in self.profiles:
+            raise ValueError(f"unknown profile {name}, must be one of {list(self.profiles.keys())}")
+        return self.profiles[name]
+
+
+    # Returns the preprocessing conf of the feature extractor conf, with the image size limit of the profile
+    def preprocessing_conf(self, conf, profile: LocalizationProfile | None = None):
+        preproc_conf = conf["preprocessing"] if conf["preprocessing"] is not None else {}
+        if profile is not None and profile.resize_max:
+            resize_max = preproc_conf.get("resize_max")
+            if not resize_max or profile.resize_max < resize_max:
+                preproc_conf = {**preproc_conf, "resize_max": profile.resize_max}
+        return preproc_conf
+
+
+    # Keeps the max_keypoints query keypoints with the highest detection scores (in their original order)
+    def limit_keypoints(self, features, max_keypoints=None):
+        if not max_keypoints or "scores" not in features or len(features["scores"]) <= max_keypoints:
+            return features
+        idxs = np.sort(np.argsort(-features["scores"], kind="stable")[:max_keypoints])
+        limited = dict(features)
+        for k in ("keypoints", "scores", "scales", "oris"):
+            if k in features:
+                limited[k] = features[k][idxs]
+        if "descriptors" in features:
+            limited["descriptors"] = features["descriptors"][:, idxs]
+        return limited
+
+
+    # Loads the feature extractors and the matcher of the map config.
+    # Subclasses can override this to plug in other models with the same interface (e.g. the stub models of the synthetic benchmark).
+    def load_models(self, config):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        print(f"Device: {self.device}")
+        logger.info("Device: %s", self.device)
 
         self.feature_conf = extract_features.confs[config['feature_conf']]
-        print(f"Feature conf: {self.feature_conf}")
+        logger.info("Feature conf: %s", self.feature_conf)
 
         self.matcher_conf = match_features.confs[config['matcher_conf']]
-        print(f"Matcher conf: {self.matcher_conf}")
+        logger.info("Matcher conf: %s", self.matcher_conf)
 
         if config['retrieval_conf'] is not None:
             self.retrieval_conf = extract_features.confs[config['retrieval_conf']]
-            print(f"Retrieval conf: {self.retrieval_conf}")
+            logger.info("Retrieval conf: %s", self.retrieval_conf)
         else:
             self.retrieval_conf = None
 
@@ -145,36 +428,91 @@ class HlocLocalizer():
         matcher_module = dynamic_load(matchers, self.matcher_conf['model']['name'])
         self.matcher = matcher_module(self.matcher_conf['model']).eval().to(self.device)
 
+        # Optional quantized and TorchScript models for the CPU inference
+        set_inference_threads(config.get('inference_threads'), config.get('inference_interop_threads'))
+        inference_backend = config.get('inference_backend', kDefaultInferenceBackend)
+        if inference_backend not in kInferenceBackends:
+            raise ValueError(f"unknown inference backend {inference_backend}, must be one of {kInferenceBackends}")
+        self.inference_precisions = load_precisions(config.get('inference_precision'))
+        quantize = any(precision != "float32" for precision in self.inference_precisions.values())
+        if (quantize or inference_backend == "torchscript") and self.device != 'cpu':
+            logger.warning("The inference precision and backend are only used on the CPU, using the float32 eager models on %s", self.device)
+            self.inference_precisions = load_precisions(None)
+        elif quantize or inference_backend == "torchscript":
+            validation_data = self.validation_inputs()
+            if quantize:
+                self.quantize_models(validation_data)
+            if inference_backend == "torchscript":
+                self.compile_models(config, validation_data)
+
+
+    # Returns the validation inputs of the local extractor, the global extractor and the matcher.
+    # NOTE: the inputs of the extractors cover landscape and portrait images and batches (of the micro-batching),
+    # the matcher inputs are the features of the example images and of a shifted copy
+    def validation_inputs(self):
+        local_data = self.example_inputs(self.feature_conf)
+        global_data = self.example_inputs(self.retrieval_conf) if self.retrieval_conf is not None else []
+        features = [pred for pred, _ in self.extract_features_local_batch([self.unbatched(data) for data in local_data[:2]])]
+        shifted = {"image": torch.roll(local_data[0]["image"], shifts=(24, 40), dims=(2, 3)), "original_size": local_data[0]["original_size"]}
+        shifted_features = self.extract_features_local_batch([self.unbatched(shifted)])[0][0]
+        pairs = [(features[0], shifted_features), (features[1], features[0])]
+        return {
+            "local": [{"image": data["image"]} for data in local_data],
+            "global": [{"image": data["image"]} for data in global_data],
+            "matcher": [self.matcher_input({**self.matcher_features(f0, "0"), **self.matcher_features(f1, "1")}) for f0, f1 in pairs],
+        }
 
-        # Load map (reconstruction)
-        map_path = Path(config['reconstruction_path']) # / 'models' / '0'
-        if not map_path.exists() or not map_path.is_dir():
-            raise FileNotFoundError(f"map path {str(map_path)} does not exist")
-        print(f"Map path: {str(map_path)}")
-        self.reconstruction = pycolmap.Reconstruction()
-        self.reconstruction.read(str(map_path))
-
-        self.map_image_names = [i.name for i in self.reconstruction.images.values()]
-        if len(self.map_image_names) == 0:
-            raise ValueError("Could not find any map images.")
 
-        self.db_name_to_id = {img.name: i for i, img in self.reconstruction.images.items()}
+    # Replaces the models with their lower precision versions of the inference_precision of the map config.
+    # The models that keep float32 (not supported by the model or the CPU) are marked in self.inference_precisions.
+    def quantize_models(self, validation_data):
+        models = {"local": ("feature_extractor", self.feature_conf), "matcher": ("matcher", self.matcher_conf)}
+        if self.retrieval_conf is not None:
+            models["global"] = ("global_feature_extractor", self.retrieval_conf)
+        for network, (attribute, conf) in models.items():
+            model = getattr(self, attribute)
+            quantized = quantize_model(model, f"{network}_{conf['model']['name']}", self.inference_precisions[network], validation_data[network])
+            if quantized is model:
+                self.inference_precisions[network] = "float32"
+            setattr(self, attribute, quantized)
+
+
+    # Replaces the models with their TorchScript versions (cached in inference_cache_dir) where they match the eager models
+    def compile_models(self, config, validation_data):
+        cache_dir = Path(config.get('inference_cache_dir') or Path(torch.hub.get_dir()) / 'openvps_torchscript')
+        precisions = self.inference_precisions
+        self.feature_extractor = compile_model(self.feature_extractor, "local_" + self.feature_conf['model']['name'],
+            {**self.feature_conf, "precision": precisions["local"]}, validation_data["local"], cache_dir)
+        if self.retrieval_conf is not None:
+            self.global_feature_extractor = compile_model(self.global_feature_extractor, "global_" + self.retrieval_conf['model']['name'],
+                {**self.retrieval_conf, "precision": precisions["global"]}, validation_data["global"], cache_dir)
+        self.matcher = compile_model(self.matcher, "matcher_" + self.matcher_conf['model']['name'],
+            {**self.matcher_conf, "precision": precisions["matcher"]}, validation_data["matcher"], cache_dir)
+
+
+    # Returns example inputs of the extractor conf: a landscape image, a portrait image and a batch of two landscape images
+    def example_inputs(self, conf):
+        preproc_conf = self.preprocessing_conf(conf)
+        size = preproc_conf.get("resize_max") or 1024
+        channels = 1 if preproc_conf.get("grayscale", False) else 3
+        height, width = size * 3 // 4, size
+        return [
+            {"image": example_image(height, width, channels), "original_size": (width, height)},
+            {"image": example_image(width, height, channels, seed=1), "original_size": (height, width)},
+            {"image": example_image(height, width, channels, batch_size=2, seed=2), "original_size": (width, height)},
+        ]
 
-        # Load map local features
-        local_features_path = Path(config['reconstruction_path']) / 'features.h5'
-        self.load_map_local_features(local_features_path)
 
-        # Load map global features
-        global_features_path = Path(config['reconstruction_path']) / 'global_features.h5'
-        if global_features_path.exists():
-            self.load_map_global_features(global_features_path)
+    # Converts a batched example input into the preprocessed image format of extract_features_local_batch()
+    def unbatched(self, data):
+        return {"image": data["image"][0].numpy(), "original_size": np.array(data["original_size"])}
 
 
     def load_map_transform(self, map_transform_path:Path):
         try:
             with open(str(map_transform_path), 'r') as file:
                 data = json.load(file)
-                self.map_to_ENU_transform = data['matrix']
+                map_to_ENU_transform = np.asarray(data['matrix'], dtype=np.float64)
 
                 # We convert from graphics convention (X right, Y up, Z backwards) to ENU convention (X/E right, Y/N forward, Z/U up)
                 # rotation around X with +90deg
@@ -184,24 +522,43 @@ class HlocLocalizer():
                     [0, 1, 0, 0],
                     [0, 0, 0, 1]
                 ])
-                self.map_to_ENU_transform = np.matmul(graphics_to_robotics_transform, self.map_to_ENU_transform)
+                map_to_ENU_transform = np.matmul(graphics_to_robotics_transform, map_to_ENU_transform)
 
                 ref_lat = data['latitude']
                 ref_lon = data['longitude']
                 ref_h = data['height']
-                self.map_geodetic_ref = Position(ref_lat, ref_lon, ref_h)
-            print(f"Successfully loaded map transform from {map_transform_path}")
+                self.set_map_transform(map_to_ENU_transform, Position(ref_lat, ref_lon, ref_h))
+            logger.info("Successfully loaded map transform from %s", map_transform_path)
             return True
         except:
-            print(f"Could not load map transform from {map_transform_path}")
+            logger.error("Could not load map transform from %s", map_transform_path)
             return False
 
 
 
-    def export_map(self):
-        export_path = Path(self.config["reconstruction_path"]) / 'sparse.ply'
-        self.reconstruction.export_PLY(str(export_path))
-        print(f"Exported map to {str(export_path)}")
+    # Sets the map to ENU transform and the geodetic reference of the map, and precomputes everything the pose conversions need,
+    # so converting a pose is only a few small matrix products
+    def set_map_transform(self, map_to_ENU_transform, map_geodetic_ref: Position):
+        map_to_ENU_transform = np.asarray(map_to_ENU_transform, dtype=np.float64)
+        self.ENU_to_map_transform = np.linalg.inv(map_to_ENU_transform)
+        # NOTE: the map to ENU transform might contain a scale
+        self.map_scale = np.cbrt(abs(np.linalg.det(map_to_ENU_transform[:3,:3])))
+        self.map_tangent_frame = LocalTangentFrame(map_geodetic_ref.lat, map_geodetic_ref.lon, map_geodetic_ref.h)
+        self.map_to_ENU_transform = map_to_ENU_transform
+        self.map_geodetic_ref = map_geodetic_ref
+
+
+    # Exports the 3D points of the map as a PLY file next to the reconstruction.
+    # frame is one of map_export.kExportFrames; the georeferenced frames (enu, ecef, geodetic) use the map transform.
+    def export_map(self, frame="map"):
+        if frame == "map":
+            export_path = Path(self.config["reconstruction_path"]) / 'sparse.ply'
+            self.reconstruction.export_PLY(str(export_path))
+        else:
+            export_path = Path(self.config["reconstruction_path"]) / f'sparse_{frame}.ply'
+            export_point_cloud(self.reconstruction, export_path, frame, self.map_to_ENU_transform, self.map_tangent_frame)
+        logger.info("Exported map to %s", export_path)
+        return export_path
 
 
     def camera_from_parameters(self, width, height, camera_parameters: CameraParameters):
@@ -214,17 +571,78 @@ class HlocLocalizer():
         return camera
 
 
+    # Returns the largest image size that the feature extractors work with, or None if any of them uses the full resolution.
+    # Query images larger than this can be downscaled already at decoding.
+    def get_max_image_size(self):
+        confs = [self.feature_conf]
+        if self.retrieval_conf is not None:
+            confs.append(self.retrieval_conf)
+        max_size = 0
+        for conf in confs:
+            preproc_conf = conf["preprocessing"] if conf["preprocessing"] is not None else {}
+            if not preproc_conf.get("resize_max"):
+                return None
+            max_size = max(max_size, preproc_conf["resize_max"])
+        return max_size
+
+
+    # Returns False if all feature extractors work on grayscale images, so the query images can be decoded directly to grayscale
+    def requires_color_image(self):
+        confs = [self.feature_conf]
+        if self.retrieval_conf is not None:
+            confs.append(self.retrieval_conf)
+        for conf in confs:
+            preproc_conf = conf["preprocessing"] if conf["preprocessing"] is not None else {}
+            if not preproc_conf.get("grayscale", False):
+                return True
+        return False
+
+
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/utils/io.py
     def load_map_local_features(self, local_features_path:Path):
-        print(f"Loading map local features from: {str(local_features_path)}")
+        logger.info("Loading map local features from: %s", local_features_path)
         # NOTE(soeroesg): we do not load all local features into GPU nor into RAM because they are huge.
         # We only open the file here and we will load the necessary features later on the fly.
+        self.local_features_path = local_features_path
         self.map_local_descriptors = h5py.File(local_features_path, 'r')
 
 
+    # Closes the HDF5 file of the map local features, e.g. in the parent process before forking the server workers.
+    # NOTE: open HDF5 files must not be shared across processes, each worker reopens the file with reinit_after_fork()
+    def close_map_files(self):
+        if getattr(self, "map_local_descriptors", None) is not None:
+            self.map_local_descriptors.close()
+            self.map_local_descriptors = None
+
+
+    # Reinitializes the per-process state in a forked worker process. The reconstruction, the global descriptors and the
+    # models are inherited from the parent (shared copy-on-write), but the HDF5 file is reopened, and the threads of the parent
+    # (micro-batching) do not exist in the child, so the batching has to be enabled again.
+    def reinit_after_fork(self):
+        self.tracking_lock = threading.Lock()
+        self.local_batcher = None
+        self.global_batcher = None
+        if getattr(self, "local_features_path", None) is not None:
+            self.map_local_descriptors = h5py.File(self.local_features_path, 'r')
+
+
+    def load_map_image_poses(self):
+        # NOTE: we keep the camera centres and viewing directions of the map images in arrays
+        # (in the same order as map_image_names) so that we can select images near a prior pose quickly
+        centers = []
+        directions = []
+        for name in self.map_image_names:
+            image = self.reconstruction.images[self.db_name_to_id[name]]
+            pose_c2m = image.cam_from_world.inverse().matrix()
+            centers.append(pose_c2m[:3,3])
+            directions.append(pose_c2m[:3,2]) # the camera looks along its Z axis in vision convention
+        self.map_image_centers = np.array(centers)
+        self.map_image_directions = np.array(directions)
+
+
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/pairs_from_retrieval.py
     def load_map_global_features(self, global_features_path:Path):
-        print(f"Loading map global features from: {str(global_features_path)}")
+        logger.info("Loading map global features from: %s", global_features_path)
         # NOTE(soeroesg): we load all global features into RAM because they are used often
         key="global_descriptor"
         with h5py.File(global_features_path, 'r') as fd:
@@ -284,43 +702,105 @@ class HlocLocalizer():
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/extract_features.py
     @torch.no_grad()
     def extract_features_global(self, data):
-        # NOTE(soeroesg): data["image"] must be wrapped into an array and into a tensor
-        #pred = self.global_feature_extractor({"image": data["image"].to(self.device, non_blocking=True)})
-        pred = self.global_feature_extractor({"image": torch.from_numpy(np.array([data["image"]])).to(self.device, non_blocking=True)})
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
-        #print(pred)
+        if self.global_batcher is not None:
+            return self.global_batcher(data)[None]
+        return self.extract_features_global_batch([data])
+
+
+    # NOTE: the images are grouped by their preprocessed size and each group runs in a single batched forward pass.
+    # Returns the global descriptors of all images as a tensor in the input order.
+    @torch.no_grad()
+    def extract_features_global_batch(self, data_list):
         key="global_descriptor"
-        desc = torch.from_numpy( np.array([pred[key].__array__()]) ).float()
+        descs = [None] * len(data_list)
+        for idxs in self.group_by_image_size(data_list):
+            images = torch.from_numpy(np.stack([data_list[i]["image"] for i in idxs]))
+            pred = self.global_feature_extractor({"image": images.to(self.device, non_blocking=True)})
+            pred_desc = pred[key].cpu().numpy()
+            for b, i in enumerate(idxs):
+                descs[i] = pred_desc[b]
+        desc = torch.from_numpy(np.stack(descs, 0)).float()
         return desc
 
+
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/extract_features.py
     @torch.no_grad()
     def extract_features_local(self, data):
-        # NOTE(soeroesg): data["image"] must be wrapped into an array and into a tensor
-        #pred = self.feature_extractor({"image": data["image"].to(self.device, non_blocking=True)}) # original hloc
-        pred = self.feature_extractor({"image": torch.from_numpy(np.array([data["image"]])).to(self.device, non_blocking=True)}) # soeroesg
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
-
-        # NOTE(soeroesg): data["original_size"] must be wrapped into an array and into a tensor
-        #pred["image_size"] = original_size = data["original_size"][0].numpy() # original hloc
-        pred["image_size"] = original_size = torch.from_numpy(np.array([data["original_size"]]))[0].numpy() # soeroesg
-        if "keypoints" in pred:
-            # NOTE(soeroesg): for reading the size, we don't need to wrap it again
-            size = np.array(data["image"].shape[-2:][::-1])
-            scales = (original_size / size).astype(np.float32)
-            pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
-            if "scales" in pred:
-                pred["scales"] *= scales.mean()
-            # add keypoint uncertainties scaled to the original resolution
-            uncertainty = getattr(self.feature_extractor, "detection_noise", 1) * scales.mean()
-
-        return pred, uncertainty
+        if self.local_batcher is not None:
+            return self.local_batcher(data)
+        return self.extract_features_local_batch([data])[0]
+
+
+    # NOTE: the images are grouped by their preprocessed size and each group runs in a single batched forward pass.
+    # Returns the (features, uncertainty) tuples in the input order.
+    @torch.no_grad()
+    def extract_features_local_batch(self, data_list):
+        results = [None] * len(data_list)
+        for idxs in self.group_by_image_size(data_list):
+            images = torch.from_numpy(np.stack([data_list[i]["image"] for i in idxs]))
+            #pred = self.feature_extractor({"image": data["image"].to(self.device, non_blocking=True)}) # original hloc
+            pred_batch = self.feature_extractor({"image": images.to(self.device, non_blocking=True)})
+            for b, i in enumerate(idxs):
+                data = data_list[i]
+                pred = {k: v[b].cpu().numpy() for k, v in pred_batch.items()}
+
+                #pred["image_size"] = original_size = data["original_size"][0].numpy() # original hloc
+                pred["image_size"] = original_size = np.array(data["original_size"])
+                uncertainty = 1
+                if "keypoints" in pred:
+                    # NOTE(soeroesg): for reading the size, we don't need to wrap it again
+                    size = np.array(data["image"].shape[-2:][::-1])
+                    scales = (original_size / size).astype(np.float32)
+                    pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
+                    if "scales" in pred:
+                        pred["scales"] *= scales.mean()
+                    # add keypoint uncertainties scaled to the original resolution
+                    uncertainty = getattr(self.feature_extractor, "detection_noise", 1) * scales.mean()
+                results[i] = (pred, uncertainty)
+        return results
+
+
+    # Enables the micro-batching of the feature extraction across concurrent localizations (running in different threads).
+    # The images that arrive within max_delay seconds are extracted together, grouped by their preprocessed size.
+    def enable_batching(self, max_delay=0.002, max_batch_size=kMaxExtractionBatchSize):
+        self.disable_batching()
+        self.local_batcher = MicroBatcher(self.extract_features_local_batch, max_batch_size, max_delay, "local", self.map_id)
+        if self.retrieval_conf is not None:
+            self.global_batcher = MicroBatcher(lambda data_list: list(self.extract_features_global_batch(data_list)),
+                max_batch_size, max_delay, "global", self.map_id)
+
+
+    def disable_batching(self):
+        local_batcher, global_batcher = self.local_batcher, self.global_batcher
+        self.local_batcher = None
+        self.global_batcher = None
+        for batcher in (local_batcher, global_batcher):
+            if batcher is not None:
+                batcher.stop()
+
+
+    # Groups the indices of the preprocessed images by image size, so that each group can be stacked into one batch
+    def group_by_image_size(self, data_list, max_batch_size=kMaxExtractionBatchSize):
+        groups = defaultdict(list)
+        for i, data in enumerate(data_list):
+            groups[data["image"].shape].append(i)
+        batches = []
+        for idxs in groups.values():
+            for b in range(0, len(idxs), max_batch_size):
+                batches.append(idxs[b:b+max_batch_size])
+        return batches
 
 
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/pairs_from_retrieval.py
     @torch.no_grad()
     def pairs_from_retrieval(self, query_global_descriptor, num_matched=20):
-        sim = torch.einsum("id,jd->ij", query_global_descriptor.to(self.device), self.map_global_descriptors.to(self.device))
+        return self.pairs_from_retrieval_batch(query_global_descriptor, num_matched)[0]
+
+
+    # Returns the list of retrieved map image names for each query descriptor (each row of query_global_descriptors)
+    @torch.no_grad()
+    def pairs_from_retrieval_batch(self, query_global_descriptors, num_matched=20):
+        sim = torch.einsum("id,jd->ij", query_global_descriptors.to(self.device), self.map_global_descriptors.to(self.device))
 
         invalid = np.full(shape=sim.shape, fill_value=False)
         # NOTE(soeroesg): no self-matching can happen in live case. This must be a matrix with the same size as the similarity scores
@@ -329,44 +809,108 @@ class HlocLocalizer():
         pairs = pairs_from_retrieval.pairs_from_score_matrix(sim, invalid, num_matched, min_score=0)
 
         #pairs = [(query_names[i], db_names[j]) for i, j in pairs] # original hloc
-        pairs = [self.map_image_names[j] for i, j in pairs] # soeroesg: adapted because we have only a single query
+        pairs_per_query = [[] for _ in range(sim.shape[0])]
+        for i, j in pairs:
+            pairs_per_query[i].append(self.map_image_names[j])
+        return pairs_per_query
+
+
+    # Converts a GeoPose into a camera-to-map pose. This is the inverse of the map -> ENU -> geodetic conversion in localize()
+    def geopose_to_map_pose(self, geopose: GeoPose) -> np.ndarray:
+        tvec_enu = self.map_tangent_frame.geodetic_to_enu(geopose.position.lat, geopose.position.lon, geopose.position.h)
+        q = geopose.quaternion
+        rot_enu_rob = Rotation.from_quat([q.x, q.y, q.z, q.w])
+        rot_enu_cv = rot_enu_rob * kRotationCvToRob.inv()
+
+        pose_c2enu = np.eye(4)
+        pose_c2enu[:3,:3] = rot_enu_cv.as_matrix()
+        pose_c2enu[:3,3] = tvec_enu
+        pose_c2m = np.matmul(self.ENU_to_map_transform, pose_c2enu)
+        return pose_c2m
+
+
+    # Selects the map images whose camera centres and viewing directions are close to the prior pose.
+    # The images are returned sorted by their distance to the prior.
+    def pairs_from_prior(self, prior_geopose: GeoPose, num_matched=20):
+        pose_c2m = self.geopose_to_map_pose(prior_geopose)
+
+        # NOTE: the map to ENU transform might contain a scale, so we convert the distance threshold into map units
+        max_distance = self.prior_max_distance / self.map_scale
+
+        prior_center = pose_c2m[:3,3]
+        prior_direction = pose_c2m[:3,2] / np.linalg.norm(pose_c2m[:3,2])
+        distances = np.linalg.norm(self.map_image_centers - prior_center, axis=1)
+        cos_angles = np.matmul(self.map_image_directions, prior_direction)
+
+        candidates = np.where((distances <= max_distance) & (cos_angles >= np.cos(np.radians(self.prior_max_angle))))[0]
+        candidates = candidates[np.argsort(distances[candidates])][:num_matched]
+        pairs = [self.map_image_names[j] for j in candidates]
         return pairs
 
 
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/match_features.py
+    # NOTE: ref_features can be an OrderedDict that caches the loaded reference features between calls,
+    # e.g. when a batch of queries is matched against overlapping reference images
+    # NOTE: prefetcher can be a RefFeaturePrefetcher started by the caller for (a superset of) ref_pairs.
+    # Otherwise the features of the reference images that are not cached are read in the background while matching.
     @torch.no_grad()
-    def match_features(self, query_features, ref_pairs):
+    def match_features(self, query_features, ref_pairs, ref_features=None, prefetcher=None):
+        own_prefetcher = None
+        if prefetcher is None and self.prefetch_ref_features and len(ref_pairs) > 1:
+            ref_names = list(dict.fromkeys(n for n in ref_pairs if ref_features is None or n not in ref_features))
+            if len(ref_names) > 0:
+                own_prefetcher = prefetcher = self.start_ref_feature_prefetcher(ref_names)
+        try:
+            return self.match_features_impl(query_features, ref_pairs, ref_features, prefetcher)
+        finally:
+            if own_prefetcher is not None:
+                own_prefetcher.stop()
+
+
+    # Starts reading the local features of the given map images in the background
+    def start_ref_feature_prefetcher(self, ref_names, max_prefetched=kMaxPrefetchedRefFeatures):
+        return RefFeaturePrefetcher(self.load_ref_features_timed, ref_names, max_prefetched)
+
+
+    def load_ref_features_timed(self, ref_name):
+        with time_stage(self.map_id, "hdf5_read"):
+            return self.load_ref_features(ref_name)
+
+
+    def match_features_impl(self, query_features, ref_pairs, ref_features, prefetcher):
 
         # code pulled out from FeaturePairsDataset
         results = {}
+        query_data = self.matcher_features(query_features, "0")
         for ref_name in ref_pairs:
-            data = {}
-            grp = query_features
-            for k, v in grp.items():
-                data[k + "0"] = torch.from_numpy(v.__array__()).float()
-            data["image0"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
-
-
-            grp = self.map_local_descriptors[ref_name]
-            for k, v in grp.items():
-                data[k + "1"] = torch.from_numpy(v.__array__()).float()
-            data["image1"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
-
-            # NOTE(soeroesg): we are not using the Torch DataLoader, so we need to wrap them into a tensor ourselves
-            data2 = {
-                #k: v if k.startswith("image") else v.to(self.device, non_blocking=True) for k, v in data.items() # original hloc
-                k: torch.from_numpy(np.array([v])) if k.startswith("image") else torch.from_numpy(np.array([v])).to(self.device, non_blocking=True) for k, v in data.items() # soeroesg
-            }
-            pred = self.matcher(data2)
-            #print(pred)
+            data = dict(query_data)
 
-            # NOTE(soerosg): extract from GPU
-            ret = {}
-            matches = pred["matches0"][0].cpu().short().numpy()
-            ret["matches0"] = matches
-            if "matching_scores0" in pred:
-                scores = pred["matching_scores0"][0].cpu().half().numpy()
-                ret["matching_scores0"] =scores
+            if ref_features is not None and ref_name in ref_features:
+                ref_features.move_to_end(ref_name)
+                data.update(ref_features[ref_name])
+            else:
+                if prefetcher is not None and prefetcher.is_next(ref_name):
+                    with time_stage(self.map_id, "prefetch_wait"):
+                        ref_data = prefetcher.get(ref_name)
+                else:
+                    ref_data = self.load_ref_features_timed(ref_name)
+                if ref_features is not None:
+                    ref_features[ref_name] = ref_data
+                    while len(ref_features) > kMaxCachedRefFeatures:
+                        ref_features.popitem(last=False)
+                data.update(ref_data)
+
+            with time_stage(self.map_id, "matching"):
+                pred = self.matcher(self.matcher_input(data))
+                #print(pred)
+
+                # NOTE(soerosg): extract from GPU
+                ret = {}
+                matches = pred["matches0"][0].cpu().short().numpy()
+                ret["matches0"] = matches
+                if "matching_scores0" in pred:
+                    scores = pred["matching_scores0"][0].cpu().half().numpy()
+                    ret["matching_scores0"] =scores
 
             # NOTE(soeroesg): instead of writing into a file, we collect and return the results here
             pair = names_to_pair(self.kQueryImageName, ref_name)
@@ -374,6 +918,29 @@ class HlocLocalizer():
 
         return results
 
+    # Reads the local features of a map image from the HDF5 file
+    def load_ref_features(self, ref_name):
+        return self.matcher_features(self.map_local_descriptors[ref_name], "1")
+
+
+    # Converts the local features of an image (dict or HDF5 group) into the matcher inputs with the given suffix ("0" or "1")
+    def matcher_features(self, features, suffix):
+        data = {}
+        for k, v in features.items():
+            data[k + suffix] = torch.from_numpy(v.__array__()).float()
+        data["image" + suffix] = torch.empty((1,) + tuple(features["image_size"].__array__())[::-1])
+        return data
+
+
+    # Adds the batch dimension to the matcher inputs and moves them to the device
+    def matcher_input(self, data):
+        # NOTE(soeroesg): we are not using the Torch DataLoader, so we need to wrap them into a tensor ourselves
+        return {
+            #k: v if k.startswith("image") else v.to(self.device, non_blocking=True) for k, v in data.items() # original hloc
+            k: torch.from_numpy(np.array([v])) if k.startswith("image") else torch.from_numpy(np.array([v])).to(self.device, non_blocking=True) for k, v in data.items() # soeroesg
+        }
+
+
     # code adapted from https://github.com/cvg/Hierarchical-Localization/blob/master/hloc/utils/io.py
     # refactored signature that features are passed instead of file name of features database
     def get_keypoints(self, query_local_descriptors) -> np.ndarray:
@@ -404,7 +971,7 @@ class HlocLocalizer():
         #kpq = get_keypoints(features_path, qname) # original hloc
         kpq = self.get_keypoints(query_local_descriptors) # soeroesg
 
-        kpq += 0.5  # COLMAP coordinates
+        kpq = kpq + 0.5  # COLMAP coordinates (NOTE: not in-place, the query keypoints are reused for every cluster)
 
         kp_idx_to_3D = defaultdict(list)
         kp_idx_to_3D_to_db = defaultdict(lambda: defaultdict(list))
@@ -412,7 +979,7 @@ class HlocLocalizer():
         for i, db_id in enumerate(db_ids):
             image = self.reconstruction.images[db_id]
             if image.num_points3D == 0:
-                print(f"No 3D points found for {image.name}.")
+                logger.debug("No 3D points found for %s.", image.name)
                 continue
             points3D_ids = np.array(
                 [p.point3D_id if p.has_point3D() else -1 for p in image.points2D]
@@ -437,10 +1004,13 @@ class HlocLocalizer():
 
         # NOTE(soeroesg): pycolmap API changed and the absolute_pose_estimation got removed/renamed.
         # Therefore we cannot simply use the QueryLocalizer, but instead we created QueryLocalizerNew
-        ret = localizer.localize(kpq, mkp_idxs, mp3d_ids, query_camera)
+        with time_stage(self.map_id, "pnp"):
+            ret = localizer.localize(kpq, mkp_idxs, mp3d_ids, query_camera)
 
         if ret is not None:
             ret["camera"] = query_camera
+            ret["keypoint_idxs"] = mkp_idxs
+            ret["points3D_ids"] = mp3d_ids
 
         # mostly for logging and post-processing
         mkp_to_3D_to_db = [
@@ -459,56 +1029,387 @@ class HlocLocalizer():
 
 
     # NOTE(soeroesg): new code, inspired by hloc.localize_sfm, but this can run online
-    def localize(self, query_image, camera_parameters: CameraParameters) -> GeoPose | None:
+    # NOTE: if a fresh prior pose is given, the reference images are selected around the prior
+    # and the global feature extraction and retrieval are skipped
+    # NOTE: profile is the name of a quality/latency profile (the default profile of the map if None)
+    def localize(self, query_image, camera_parameters: CameraParameters, prior_geopose: GeoPose | None = None, profile=None) -> GeoPose | None:
+        ret, _ = self.localize_in_map(query_image, camera_parameters, prior_geopose, profile)
+        if ret is None:
+            return None
+        return self.geopose_from_cam_from_world(ret["cam_from_world"])
+
+
+    # Same as localize() but returns the pose hypotheses of the best covisibility clusters (at most max_hypotheses),
+    # ranked by their number of inliers, with the accuracy estimated from the covariance of the pose refinement.
+    # The first hypothesis is the pose that localize() returns. The list is empty if the query could not be localized.
+    def localize_hypotheses(self, query_image, camera_parameters: CameraParameters, prior_geopose: GeoPose | None = None, max_hypotheses=None, profile=None) -> List[PoseHypothesis]:
+        ret, _ = self.localize_in_map(query_image, camera_parameters, prior_geopose, profile)
+        if ret is None:
+            return []
+        hypotheses = ret["hypotheses"][:max_hypotheses]
+        geoPoses = self.geoposes_from_cam_from_worlds([h["cam_from_world"] for h in hypotheses])
+        return [PoseHypothesis(geoPose, self.accuracy_from_covariance(h["cam_from_world"], h.get("covariance")), h["num_inliers"])
+                for geoPose, h in zip(geoPoses, hypotheses)]
+
 
-        print("Camera model parsing...")
+    # Localizes the query image in the map and returns the PnP result (in map coordinates) and the query features
+    def localize_in_map(self, query_image, camera_parameters: CameraParameters, prior_geopose: GeoPose | None = None, profile=None):
+        profile = self.get_profile(profile)
+        logger.debug("Profile: %s", profile.name)
+
+        logger.debug("Camera model parsing...")
         # NOTE(soeroesg): we do not have EXIF as we do not have a photo file :(
         # camera = pycolmap.infer_camera_from_image(query_image)
         query_camera = self.camera_from_parameters(width=query_image.shape[1], height=query_image.shape[0], camera_parameters=camera_parameters)
-        print(query_camera)
+        diagnostics_logger.debug("Query camera: %s", query_camera)
 
         # Local feature extraction
-        print("Local feature extraction...")
-        if self.feature_conf["preprocessing"] is not None:
-            preproc_conf = self.feature_conf["preprocessing"]
-        else:
-            preproc_conf = {}
-        print(preproc_conf)
-        query_image_data = self.extract_features_preprocess(query_image, preproc_conf)
-        query_local_descriptors, query_local_descriptors_uncertainty = self.extract_features_local(query_image_data)
+        logger.debug("Local feature extraction...")
+        preproc_conf = self.preprocessing_conf(self.feature_conf, profile)
+        diagnostics_logger.debug("Preprocessing conf: %s", preproc_conf)
+        with time_stage(self.map_id, "preprocess"):
+            query_image_data = self.extract_features_preprocess(query_image, preproc_conf)
+        with time_stage(self.map_id, "local_extraction"):
+            query_local_descriptors, query_local_descriptors_uncertainty = self.extract_features_local(query_image_data)
+        query_local_descriptors = self.limit_keypoints(query_local_descriptors, profile.max_keypoints)
         #print(query_local_descriptors)
         del query_image_data
+        if len(query_local_descriptors["keypoints"]) == 0:
+            logger.debug("No keypoints in the query image.")
+            count_failure(self.map_id, "no_keypoints")
+            return None, query_local_descriptors
+
+        ref_pairs = self.select_ref_pairs(query_image, prior_geopose, profile)
+
+        if self.localization_engine == "direct":
+            ret = self.pose_from_direct_matching(query_image, query_camera, query_local_descriptors, ref_pairs, profile)
+            return ret, query_local_descriptors
+
+        # Cascade matching (optional): the learned matcher only runs if the mutual nearest neighbour matches give no confident pose
+        ref_features = None
+        if profile.cascade_matching and self.covisibility_clustering:
+            ref_features = OrderedDict()
+            ret = self.pose_from_cascade_matching(query_image, query_camera, query_local_descriptors, ref_pairs, ref_features, profile)
+            if ret is not None:
+                return ret, query_local_descriptors
 
-        # Global feature extraction (optional)
-        print("Global feature extraction (optional)...")
-        if self.retrieval_conf is not None:
-            if self.retrieval_conf["preprocessing"] is not None:
-                preproc_conf = self.retrieval_conf["preprocessing"]
+        if profile.adaptive_matching and self.covisibility_clustering:
+            ret = self.pose_from_adaptive_matching(query_image, query_camera, query_local_descriptors, ref_pairs, profile, ref_features)
+            return ret, query_local_descriptors
+
+        # Matches
+        logger.debug("Local feature matching...")
+        query_ref_matches = self.match_features(query_local_descriptors, ref_pairs, ref_features)
+
+        ret = self.pose_from_matches(query_image, query_camera, query_local_descriptors, ref_pairs, query_ref_matches, profile=profile)
+        return ret, query_local_descriptors
+
+
+    # NOTE: batch version of localize(). The feature extraction runs in batched forward passes, the retrieval
+    # in one similarity computation, and the reference features are read only once for the queries that share them.
+    # Returns a GeoPose (or None) for each query image.
+    def localize_batch(self, query_images, camera_parameters_list: List[CameraParameters], prior_geoposes: List[GeoPose | None] | None = None, profile=None) -> List[GeoPose | None]:
+        profile = self.get_profile(profile)
+        num_queries = len(query_images)
+        if prior_geoposes is None:
+            prior_geoposes = [None] * num_queries
+
+        query_cameras = [self.camera_from_parameters(width=query_image.shape[1], height=query_image.shape[0], camera_parameters=camera_parameters)
+            for query_image, camera_parameters in zip(query_images, camera_parameters_list)]
+
+        # Local feature extraction
+        logger.debug("Local feature extraction for %d images...", num_queries)
+        preproc_conf = self.preprocessing_conf(self.feature_conf, profile)
+        query_local_descriptors = []
+        for b in range(0, num_queries, kMaxExtractionBatchSize):
+            with time_stage(self.map_id, "preprocess"):
+                data_list = [self.extract_features_preprocess(query_image, preproc_conf) for query_image in query_images[b:b+kMaxExtractionBatchSize]]
+            with time_stage(self.map_id, "local_extraction"):
+                query_local_descriptors += [self.limit_keypoints(pred, profile.max_keypoints) for pred, _ in self.extract_features_local_batch(data_list)]
+            del data_list
+
+        # Map image selection around the prior poses (optional)
+        ref_pairs = []
+        for prior_geopose in prior_geoposes:
+            pairs = []
+            if prior_geopose is not None:
+                with time_stage(self.map_id, "prior_selection"):
+                    pairs = self.pairs_from_prior(prior_geopose, profile.num_retrieved)
+                if len(pairs) < self.prior_min_candidates:
+                    pairs = []
+            ref_pairs.append(pairs)
+
+        # Global feature extraction and map image retrieval for the queries without a usable prior
+        retrieval_idxs = [i for i in range(num_queries) if len(ref_pairs[i]) == 0]
+        if len(retrieval_idxs) > 0:
+            if self.retrieval_conf is not None:
+                logger.debug("Global feature extraction and retrieval for %d images...", len(retrieval_idxs))
+                preproc_conf = self.preprocessing_conf(self.retrieval_conf, profile)
+                query_global_descriptors = []
+                for b in range(0, len(retrieval_idxs), kMaxExtractionBatchSize):
+                    with time_stage(self.map_id, "preprocess"):
+                        data_list = [self.extract_features_preprocess(query_images[i], preproc_conf) for i in retrieval_idxs[b:b+kMaxExtractionBatchSize]]
+                    with time_stage(self.map_id, "global_extraction"):
+                        query_global_descriptors.append(self.extract_features_global_batch(data_list))
+                    del data_list
+                with time_stage(self.map_id, "retrieval"):
+                    retrieved_pairs = self.pairs_from_retrieval_batch(torch.cat(query_global_descriptors, 0), profile.num_retrieved)
+                for i, pairs in zip(retrieval_idxs, retrieved_pairs):
+                    ref_pairs[i] = pairs
             else:
-                preproc_conf = {}
-            print(preproc_conf)
-            query_image_data = self.extract_features_preprocess(query_image, preproc_conf)
-            query_global_descriptor = self.extract_features_global(query_image_data)
-            #print(query_global_descriptor)
-        del query_image_data
+                # NOTE: how do we choose which map frames to match with? Let's use all the db images.
+                all_pairs = [image.name for image in self.reconstruction.images.values()]
+                for i in retrieval_idxs:
+                    ref_pairs[i] = all_pairs
+
+        # Matching and pose estimation
+        # NOTE: queries with the same most similar map image are processed after each other, so that the cached reference features are reused
+        logger.debug("Local feature matching and localization...")
+        order = sorted(range(num_queries), key=lambda i: ref_pairs[i][0] if len(ref_pairs[i]) > 0 else "")
+        ref_features = OrderedDict()
+        cam_from_worlds = {}
+        for i in order:
+            ret = None
+            if self.localization_engine == "direct":
+                ret = self.pose_from_direct_matching(query_images[i], query_cameras[i], query_local_descriptors[i], ref_pairs[i], profile)
+                if ret is not None:
+                    cam_from_worlds[i] = ret["cam_from_world"]
+                continue
+            if profile.cascade_matching and self.covisibility_clustering:
+                ret = self.pose_from_cascade_matching(query_images[i], query_cameras[i], query_local_descriptors[i], ref_pairs[i], ref_features, profile)
+            if ret is None and profile.adaptive_matching and self.covisibility_clustering:
+                ret = self.pose_from_adaptive_matching(query_images[i], query_cameras[i], query_local_descriptors[i], ref_pairs[i], profile, ref_features)
+            elif ret is None:
+                query_ref_matches = self.match_features(query_local_descriptors[i], ref_pairs[i], ref_features)
+                ret = self.pose_from_matches(query_images[i], query_cameras[i], query_local_descriptors[i], ref_pairs[i], query_ref_matches, profile=profile)
+            if ret is not None:
+                cam_from_worlds[i] = ret["cam_from_world"]
+
+        geoPoses = [None] * num_queries
+        localized_idxs = list(cam_from_worlds.keys())
+        for i, geoPose in zip(localized_idxs, self.geoposes_from_cam_from_worlds([cam_from_worlds[i] for i in localized_idxs])):
+            geoPoses[i] = geoPose
+        logger.info("Localized %d of %d images.", sum(g is not None for g in geoPoses), num_queries)
+        return geoPoses
+
 
-        # Map image retrieval (optional)
-        print("Map image retrieval...")
+    # Selects the map images to match the query with: the images near the prior pose if given, otherwise the retrieved ones
+    def select_ref_pairs(self, query_image, prior_geopose: GeoPose | None = None, profile: LocalizationProfile | None = None):
+        num_retrieved = profile.num_retrieved if profile is not None else self.num_retrieved
+        # Map image selection around the prior pose (optional)
         ref_pairs = []
-        if self.retrieval_conf is not None:
-            ref_pairs = self.pairs_from_retrieval(query_global_descriptor, 20)
-            print(f"Retrieval found {len(ref_pairs)} image pairs in the map.")
-        else:
-            # NOTE: how do we choose which map frames to match with? Let's use all the db images.
-            ref_pairs = [image.name for image in self.reconstruction.images.values()]
-            print(f"Skipped retreival, took all {len(ref_pairs)} images from the map.")
+        if prior_geopose is not None:
+            logger.debug("Map image selection from prior pose...")
+            with time_stage(self.map_id, "prior_selection"):
+                ref_pairs = self.pairs_from_prior(prior_geopose, num_retrieved)
+            logger.debug("Prior pose selected %d images from the map.", len(ref_pairs))
+            if len(ref_pairs) < self.prior_min_candidates:
+                logger.debug("Too few images near the prior pose, falling back to retrieval.")
+                ref_pairs = []
+
+        if len(ref_pairs) == 0:
+            # Global feature extraction (optional)
+            logger.debug("Global feature extraction (optional)...")
+            if self.retrieval_conf is not None:
+                preproc_conf = self.preprocessing_conf(self.retrieval_conf, profile)
+                diagnostics_logger.debug("Preprocessing conf: %s", preproc_conf)
+                with time_stage(self.map_id, "preprocess"):
+                    query_image_data = self.extract_features_preprocess(query_image, preproc_conf)
+                with time_stage(self.map_id, "global_extraction"):
+                    query_global_descriptor = self.extract_features_global(query_image_data)
+                #print(query_global_descriptor)
+                del query_image_data
+
+            # Map image retrieval (optional)
+            logger.debug("Map image retrieval...")
+            if self.retrieval_conf is not None:
+                with time_stage(self.map_id, "retrieval"):
+                    ref_pairs = self.pairs_from_retrieval(query_global_descriptor, num_retrieved)
+                logger.debug("Retrieval found %d image pairs in the map.", len(ref_pairs))
+            else:
+                # NOTE: how do we choose which map frames to match with? Let's use all the db images.
+                ref_pairs = [image.name for image in self.reconstruction.images.values()]
+                logger.debug("Skipped retreival, took all %d images from the map.", len(ref_pairs))
+        return ref_pairs
+
+
+    # Matches the reference images one by one in the order of ref_pairs (most similar or closest to the prior first)
+    # and attempts PnP as soon as a covisibility cluster has enough 2D-3D correspondences. When a pose is confident,
+    # the remaining images are not matched anymore. Otherwise all images get matched, and the result is the same as
+    # with pose_from_matches() on all of them.
+    # NOTE: the features of the map images that are in ref_features (e.g. read by the cascade matching) are not read again
+    def pose_from_adaptive_matching(self, query_image, query_camera, query_local_descriptors, ref_pairs, profile: LocalizationProfile | None = None, ref_features=None):
+        qname = self.kQueryImageName
+        db_ids = [self.db_name_to_id[n] for n in ref_pairs if n in self.db_name_to_id]
+        with time_stage(self.map_id, "clustering"):
+            clusters = self.select_clusters(do_covisibility_clustering(db_ids, self.reconstruction), profile)
+        cluster_idxs = {db_id: c for c, cluster_ids in enumerate(clusters) for db_id in cluster_ids}
+        # NOTE: the images outside the selected clusters are not matched
+        ref_pairs = [n for n in ref_pairs if n in self.db_name_to_id and self.db_name_to_id[n] in cluster_idxs]
+
+        localizer = self.query_localizer(profile)
+        query_ref_matches = {}
+        matched_ids = set()
+        num_correspondences = defaultdict(int)
+        next_attempt = defaultdict(lambda: self.adaptive_min_correspondences)
+        # NOTE: the features are read only a few images ahead, and the reading is stopped if the matching stops early
+        prefetcher = None
+        ref_names = [n for n in dict.fromkeys(ref_pairs) if ref_features is None or n not in ref_features]
+        if self.prefetch_ref_features and len(ref_names) > 0:
+            prefetcher = self.start_ref_feature_prefetcher(ref_names, kAdaptiveMaxPrefetchedRefFeatures)
+        try:
+            for ref_name in ref_pairs:
+                query_ref_matches.update(self.match_features(query_local_descriptors, [ref_name], ref_features, prefetcher))
+                if ref_name not in self.db_name_to_id:
+                    continue
+                db_id = self.db_name_to_id[ref_name]
+                matched_ids.add(db_id)
+
+                c = cluster_idxs[db_id]
+                num_correspondences[c] += self.num_correspondences(query_ref_matches, db_id)
+                if num_correspondences[c] < next_attempt[c]:
+                    continue
+                next_attempt[c] = num_correspondences[c] * kAdaptiveAttemptGrowth
+                cluster_ids = [i for i in clusters[c] if i in matched_ids]
+                ret, _ = self.pose_from_cluster(localizer, qname, query_camera, cluster_ids, query_local_descriptors, query_ref_matches)
+                if ret is not None and ret["num_inliers"] >= self.adaptive_confident_inliers:
+                    logger.debug("Confident pose with %d inliers after matching %d of %d images.", ret["num_inliers"], len(matched_ids), len(ref_pairs))
+                    matched_pairs = [n for n in ref_pairs if n in self.db_name_to_id and self.db_name_to_id[n] in matched_ids]
+                    matched_clusters = [[i for i in cluster_ids if i in matched_ids] for cluster_ids in clusters]
+                    matched_clusters = [cluster_ids for cluster_ids in matched_clusters if len(cluster_ids) > 0]
+                    return self.pose_from_matches(query_image, query_camera, query_local_descriptors, matched_pairs, query_ref_matches, matched_clusters, profile)
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+
+        return self.pose_from_matches(query_image, query_camera, query_local_descriptors, ref_pairs, query_ref_matches, clusters, profile)
+
+
+    # Direct 2D-3D matching: the query keypoints are matched with the descriptors of the 3D points observed by the
+    # reference images (per covisibility cluster), without matching image pairs, and the pose is estimated from these matches
+    def pose_from_direct_matching(self, query_image, query_camera, query_local_descriptors, ref_pairs, profile: LocalizationProfile | None = None):
+        clusters = None
+        if self.covisibility_clustering:
+            db_ids = [self.db_name_to_id[n] for n in dict.fromkeys(ref_pairs) if n in self.db_name_to_id]
+            with time_stage(self.map_id, "clustering"):
+                clusters = self.select_clusters(do_covisibility_clustering(db_ids, self.reconstruction), profile)
+        cluster_pose = lambda localizer, cluster_ids: self.pose_from_direct_cluster(localizer, query_camera, cluster_ids, query_local_descriptors)
+        return self.pose_from_matches(query_image, query_camera, query_local_descriptors, ref_pairs, None, clusters, profile, cluster_pose)
+
+
+    # Matches the query keypoints with the 3D points observed by the images of the cluster and estimates the pose.
+    # Returns the PnP result and the log, like pose_from_cluster().
+    def pose_from_direct_cluster(self, localizer: QueryLocalizerNew, query_camera: pycolmap.Camera, db_ids: List[int], query_local_descriptors):
+        kpq = self.get_keypoints(query_local_descriptors) + 0.5 # COLMAP coordinates
+        with time_stage(self.map_id, "direct_matching"):
+            rows = self.point_index.rows_of_images(db_ids)
+            keypoint_idxs, points3D_ids, _ = self.point_index.match(query_local_descriptors["descriptors"].__array__(), rows,
+                self.direct_num_assigned_words, self.direct_ratio_threshold)
+        keypoint_idxs = keypoint_idxs.tolist()
+        points3D_ids = points3D_ids.tolist()
+
+        with time_stage(self.map_id, "pnp"):
+            ret = localizer.localize(kpq, keypoint_idxs, points3D_ids, query_camera)
+        if ret is not None:
+            ret["camera"] = query_camera
+            ret["keypoint_idxs"] = keypoint_idxs
+            ret["points3D_ids"] = points3D_ids
+
+        log = {
+            "db": db_ids,
+            "PnP_ret": ret,
+            "keypoints_query": kpq[keypoint_idxs],
+            "points3D_ids": points3D_ids,
+            "points3D_xyz": None,
+            "num_matches": len(keypoint_idxs),
+            "num_candidate_points": len(rows),
+        }
+        return ret, log
+
+
+    # First stage of the cascade matching: matches the query with all reference images by mutual nearest neighbours with
+    # ratio test (in batched similarity computations instead of one learned matcher pass per image) and estimates the pose.
+    # Returns the pose if a covisibility cluster has at least cascade_confident_inliers inliers, otherwise None, and then
+    # the learned matcher has to run. The features of the map images are kept in ref_features for the learned matcher.
+    def pose_from_cascade_matching(self, query_image, query_camera, query_local_descriptors, ref_pairs, ref_features, profile: LocalizationProfile | None = None):
+        qname = self.kQueryImageName
+        ref_pairs = [n for n in dict.fromkeys(ref_pairs) if n in self.db_name_to_id]
+        if len(ref_pairs) == 0:
+            return None
+        ref_data = [self.cached_ref_features(ref_name, ref_features) for ref_name in ref_pairs]
+
+        with time_stage(self.map_id, "nn_matching"):
+            query_descriptors = torch.from_numpy(query_local_descriptors["descriptors"].__array__()).float().to(self.device)
+            nn_matches = mutual_nn_match_batch(query_descriptors, [data["descriptors1"].to(self.device) for data in ref_data], self.cascade_ratio_threshold)
+            query_ref_matches = {}
+            for ref_name, (matches, scores) in zip(ref_pairs, nn_matches):
+                query_ref_matches[names_to_pair(qname, ref_name)] = {"matches0": matches.cpu().short().numpy(), "matching_scores0": scores.cpu().half().numpy()}
+
+        with time_stage(self.map_id, "clustering"):
+            clusters = self.select_clusters(do_covisibility_clustering([self.db_name_to_id[n] for n in ref_pairs], self.reconstruction), profile)
+        localizer = self.query_localizer(profile)
+        # NOTE: the largest clusters first, the pose is estimated again from all clusters once one is confident
+        for cluster_ids in sorted(clusters, key=len, reverse=True):
+            ret, _ = self.pose_from_cluster(localizer, qname, query_camera, cluster_ids, query_local_descriptors, query_ref_matches)
+            if ret is not None and ret["num_inliers"] >= self.cascade_confident_inliers:
+                logger.debug("Confident pose with %d inliers from the mutual nearest neighbour matches.", ret["num_inliers"])
+                count_cascade(self.map_id, "nearest_neighbour")
+                return self.pose_from_matches(query_image, query_camera, query_local_descriptors, ref_pairs, query_ref_matches, clusters, profile)
+        count_cascade(self.map_id, "learned_matcher")
+        return None
+
+
+    # Returns the local features of a map image in the matcher input format, from ref_features or from the HDF5 file
+    def cached_ref_features(self, ref_name, ref_features):
+        if ref_name in ref_features:
+            ref_features.move_to_end(ref_name)
+            return ref_features[ref_name]
+        ref_data = self.load_ref_features_timed(ref_name)
+        ref_features[ref_name] = ref_data
+        while len(ref_features) > kMaxCachedRefFeatures:
+            ref_features.popitem(last=False)
+        return ref_data
+
+
+    # Number of matches of the query with the map image that have a 3D point
+    def num_correspondences(self, query_ref_matches, db_id):
+        image = self.reconstruction.images[db_id]
+        if image.num_points3D == 0:
+            return 0
+        matches, _ = self.get_matches(query_ref_matches, self.kQueryImageName, image.name)
+        has_point3D = np.array([p.has_point3D() for p in image.points2D])
+        return int(np.count_nonzero(has_point3D[matches[:, 1]]))
+
+
+    # Keeps the max_clusters largest covisibility clusters of the profile
+    def select_clusters(self, clusters, profile: LocalizationProfile | None = None):
+        if profile is None or not profile.max_clusters or len(clusters) <= profile.max_clusters:
+            return clusters
+        return sorted(clusters, key=len, reverse=True)[:profile.max_clusters]
+
+
+    # PnP solver with the RANSAC and refinement options of the localization
+    def query_localizer(self, profile: LocalizationProfile | None = None):
+        refine_intrinsics = profile.refine_focal_length if profile is not None else True
+        localizer_conf = {
+            'estimation': {'ransac': {'max_error': 12}},
+            'refinement': {'refine_focal_length': refine_intrinsics, 'refine_extra_params': refine_intrinsics},
+            'return_covariance': True,
+        }
+        # NOTE(soeroesg): pycolmap API changed and the absolute_pose_estimation got removed/renamed.
+        # Therefore we cannot simply use the QueryLocalizer, but instead we created QueryLocalizerNew
+        return QueryLocalizerNew(self.reconstruction, localizer_conf)
+
+
+    # Estimates the query pose from the matches with the reference images (optionally per covisibility cluster)
+    # NOTE: clusters can be given if the covisibility clustering of the reference images was already done
+    # NOTE: cluster_pose(localizer, db_ids) can replace pose_from_cluster() with the image matches (e.g. the direct 2D-3D matching)
+    def pose_from_matches(self, query_image, query_camera, query_local_descriptors, ref_pairs, query_ref_matches, clusters=None, profile: LocalizationProfile | None = None,
+            cluster_pose=None):
         db_names = ref_pairs # use another name to be consistent with the rest of the original code
 
-        # Matches
-        print("Local feature matching...")
-        query_ref_matches = self.match_features(query_local_descriptors, ref_pairs)
         logs = {
-            "preproc_conf": preproc_conf,
+            "preproc_conf": self.preprocessing_conf(self.feature_conf, profile),
             "feature_conf": self.config['feature_conf'],
             "matcher_conf": self.config['matcher_conf'],
             "retrieval_conf": self.config['retrieval_conf'],
@@ -516,47 +1417,54 @@ class HlocLocalizer():
             "loc": {},
         }
 
-        print("Localization...")
-        localizer_conf = {
-            'estimation': {'ransac': {'max_error': 12}},
-            'refinement': {'refine_focal_length': True, 'refine_extra_params': True},
-        }
-        # NOTE(soeroesg): pycolmap API changed and the absolute_pose_estimation got removed/renamed.
-        # Therefore we cannot simply use the QueryLocalizer, but instead we created QueryLocalizerNew
-        localizer = QueryLocalizerNew(self.reconstruction, localizer_conf)
+        logger.debug("Localization...")
+        localizer = self.query_localizer(profile)
 
         db_ids = []
         for n in db_names:
             if n not in self.db_name_to_id:
-                print(f"WARNING: Image {n} was retrieved but not in database")
+                logger.warning("Image %s was retrieved but not in database", n)
                 continue
             db_ids.append(self.db_name_to_id[n])
 
         cam_from_world = {}
         qname = self.kQueryImageName
+        if cluster_pose is None:
+            cluster_pose = lambda localizer, cluster_ids: self.pose_from_cluster(localizer, qname, query_camera, cluster_ids, query_local_descriptors, query_ref_matches)
         if self.covisibility_clustering:
-            clusters = do_covisibility_clustering(db_ids, self.reconstruction)
+            if clusters is None:
+                with time_stage(self.map_id, "clustering"):
+                    clusters = self.select_clusters(do_covisibility_clustering(db_ids, self.reconstruction), profile)
             best_inliers = 0
             best_cluster = None
             logs_clusters = []
             for i, cluster_ids in enumerate(clusters):
                 #ret, log = pose_from_cluster(lcalizer, qname, qcam, cluster_ids, features_path, matches_path) # original hloc
-                ret, log = self.pose_from_cluster(localizer, qname, query_camera, cluster_ids, query_local_descriptors, query_ref_matches) # soeroesg
+                ret, log = cluster_pose(localizer, cluster_ids) # soeroesg
                 if ret is not None and ret["num_inliers"] > best_inliers:
                     best_cluster = i
                     best_inliers = ret["num_inliers"]
                 logs_clusters.append(log)
+            ret = None
             if best_cluster is not None:
                 ret = logs_clusters[best_cluster]["PnP_ret"]
                 cam_from_world[qname] = ret["cam_from_world"]
-                print(f'Found {ret["num_inliers"]} inlier correspondences for query {qname}.')
+                logger.debug("Found %d inlier correspondences for query %s.", ret["num_inliers"], qname)
+                observe_inliers(self.map_id, ret["num_inliers"])
 
                 # Reject if too few inlier points
-                kMinNumInliers = 20
-                if ret["num_inliers"] < kMinNumInliers:
-                    print(f'Rejecting solution due to low number of inliers')
+                if ret["num_inliers"] < self.min_num_inliers:
+                    logger.debug("Rejecting solution due to low number of inliers")
+                    count_failure(self.map_id, "too_few_inliers")
                     return None
 
+                # The poses of the other clusters are kept as alternative hypotheses, ranked by their number of inliers
+                other_rets = [log["PnP_ret"] for j, log in enumerate(logs_clusters) if j != best_cluster and log["PnP_ret"] is not None]
+                cluster_rets = [ret] + sorted(other_rets, key=lambda r: r["num_inliers"], reverse=True)
+                ret["hypotheses"] = [self.hypothesis_from_ret(r) for r in cluster_rets[:self.max_hypotheses] if r["num_inliers"] >= self.min_num_inliers]
+            else:
+                count_failure(self.map_id, "no_pose" if len(db_ids) > 0 else "no_reference_images")
+
             logs["loc"][qname] = {
                 "db": db_ids,
                 "best_cluster": best_cluster,
@@ -565,17 +1473,20 @@ class HlocLocalizer():
             }
         else:
             #ret, log = pose_from_cluster(localizer, qname, qcam, db_ids, features_path, matches_path) # original hloc
-            ret, log = self.pose_from_cluster(localizer, qname, query_camera, db_ids, query_local_descriptors, query_ref_matches) # soeroesg
+            ret, log = cluster_pose(localizer, db_ids) # soeroesg
             if ret is not None:
                 cam_from_world[qname] = ret["cam_from_world"]
+                observe_inliers(self.map_id, ret["num_inliers"])
             else:
                 closest = self.reconstruction.images[db_ids[0]]
                 cam_from_world[qname] = closest.cam_from_world
+                ret = {"cam_from_world": closest.cam_from_world, "num_inliers": 0, "camera": query_camera}
+            ret["hypotheses"] = [self.hypothesis_from_ret(ret)]
             log["covisibility_clustering"] = self.covisibility_clustering
             logs["loc"][qname] = log
 
+        diagnostics_logger.debug("Localization logs: %s", logs)
         if self.debug:
-            print(logs)
             # For debugging purposes, we visualize the query camera pose in the point cloud map
             # We create a copy of the map point cloud, insert the query image into it, and export it in colmap format
             map_dir = Path(self.config['reconstruction_path'])
@@ -587,7 +1498,7 @@ class HlocLocalizer():
             test_model.write_text(test_model_dir)
             test_model_images_txt_path = test_model_dir / 'images.txt'
             cv2.imwrite(str(test_model_dir/'query.png'), query_image)
-            print(f"Writing poses to {str(test_model_images_txt_path)}...")
+            logger.debug("Writing poses to %s...", test_model_images_txt_path)
             with open(str(test_model_images_txt_path), "w") as f:
                 for query, t in cam_from_world.items():
                     qvec = " ".join(map(str, t.rotation.quat[[3, 0, 1, 2]]))
@@ -595,46 +1506,165 @@ class HlocLocalizer():
                     name = query.split("/")[-1]
                     f.write(f"1 {qvec} {tvec} 1 {name}\n\n")
 
-        geoPoses = [] # sometimes we get multiple hypotheses
-        for qname, t in cam_from_world.items():
-            # Note: t is of type pycolmap.Rigid3d
-            pose_c2m = np.eye(4)
-            pose_c2m[:3,:4] = t.inverse().matrix()
+        return ret
 
-            if self.debug:
-                tvec_c2m = pose_c2m[:3,3]
-                print(f"tvec_map: {tvec_c2m}")
-                euler_c2m = Rotation.from_matrix(pose_c2m[:3,:3]).as_euler(seq='xyz', degrees=True)
-                print(f"euler_map: {euler_c2m}")
+
+    # The pose, the number of inliers and the covariance of a PnP result, without the per-correspondence data
+    def hypothesis_from_ret(self, ret):
+        return {"cam_from_world": ret["cam_from_world"], "num_inliers": ret["num_inliers"], "covariance": ret.get("covariance")}
+
+
+    # Estimates the accuracy of a pose from the 6x6 covariance of the pose refinement.
+    # The covariance is w.r.t. the rotation and translation of cam_from_world, assuming a standard deviation of one pixel
+    # for the keypoints. It is propagated to the camera center (c = -R^T t) and converted into meters.
+    # The accuracy is the root mean square of the standard deviations of the 3 position components and the 3 rotation angles.
+    def accuracy_from_covariance(self, cam_from_world: pycolmap.Rigid3d, covariance) -> GeoPoseAccuracy:
+        if covariance is None or not np.all(np.isfinite(covariance)):
+            return GeoPoseAccuracy()
+        # NOTE: the rotation is refined on the quaternion manifold of Ceres, whose tangent vector is half of the rotation vector
+        scale = np.diag([2.0, 2.0, 2.0, 1.0, 1.0, 1.0])
+        covariance = np.matmul(np.matmul(scale, covariance), scale)
+        matrix = cam_from_world.matrix()
+        rotation_t = matrix[:3,:3].T
+        t = matrix[:3,3]
+        t_cross = np.array([
+            [0.0, -t[2], t[1]],
+            [t[2], 0.0, -t[0]],
+            [-t[1], t[0], 0.0]
+        ])
+        jacobian = np.hstack([-np.matmul(rotation_t, t_cross), -rotation_t])
+        position_covariance = np.matmul(np.matmul(jacobian, covariance), jacobian.T)
+        position = np.sqrt(max(np.trace(position_covariance), 0.0) / 3.0) * self.map_scale
+        orientation = np.degrees(np.sqrt(max(np.trace(covariance[:3,:3]), 0.0) / 3.0))
+        return GeoPoseAccuracy(position=float(position), orientation=float(orientation))
+
+
+    # NOTE: tracking mode for consecutive frames of the same session (e.g. the same device).
+    # The inlier 3D points of the previous frame are projected into the new frame with the previous pose
+    # and matched only against the nearby keypoints. If the tracking is lost, we fall back to localize_in_map().
+    def track(self, session_id: str, query_image, camera_parameters: CameraParameters, prior_geopose: GeoPose | None = None, profile=None) -> GeoPose | None:
+        with self.tracking_lock:
+            state = self.tracking_states.pop(session_id, None)
+        if state is not None and time.monotonic() - state.timestamp > self.tracking_max_gap:
+            logger.debug("Tracking session %s expired.", session_id)
+            state = None
+
+        ret = None
+        if state is not None:
+            with time_stage(self.map_id, "tracking"):
+                ret, query_local_descriptors = self.track_frame(state, query_image, camera_parameters, self.get_profile(profile))
+            if ret is None:
+                logger.debug("Tracking lost in session %s, relocalizing...", session_id)
+                count_failure(self.map_id, "tracking_lost")
+
+        if ret is None:
+            ret, query_local_descriptors = self.localize_in_map(query_image, camera_parameters, prior_geopose, profile)
+            if ret is None:
+                return None
+            if "inlier_mask" in ret:
+                # convert the 3D point ids to coordinates so that the tracking does not depend on the ids anymore
+                ret["points3D"] = np.array([self.reconstruction.points3D[j].xyz for j in ret["points3D_ids"]]).reshape(-1, 3)
+
+        if "inlier_mask" in ret:
+            inliers = np.array(ret["inlier_mask"], dtype=bool)
+            keypoint_idxs = np.array(ret["keypoint_idxs"], dtype=np.int64)[inliers]
+            state = TrackingState(ret["cam_from_world"], ret["points3D"][inliers],
+                query_local_descriptors["descriptors"][:, keypoint_idxs])
+            with self.tracking_lock:
+                self.tracking_states[session_id] = state
+                while len(self.tracking_states) > kMaxTrackingSessions:
+                    self.tracking_states.popitem(last=False)
+
+        return self.geopose_from_cam_from_world(ret["cam_from_world"])
+
+
+    # Tracks the points of the previous frame in the new frame, with the image size, keypoint and refinement limits of the profile
+    def track_frame(self, state: TrackingState, query_image, camera_parameters: CameraParameters, profile: LocalizationProfile | None = None):
+        query_camera = self.camera_from_parameters(width=query_image.shape[1], height=query_image.shape[0], camera_parameters=camera_parameters)
+
+        preproc_conf = self.preprocessing_conf(self.feature_conf, profile)
+        query_image_data = self.extract_features_preprocess(query_image, preproc_conf)
+        query_local_descriptors, _ = self.extract_features_local(query_image_data)
+        query_local_descriptors = self.limit_keypoints(query_local_descriptors, profile.max_keypoints if profile is not None else None)
+        del query_image_data
+
+        kpq = query_local_descriptors["keypoints"] + 0.5 # COLMAP coordinates
+        # NOTE: e.g. dark frames have no keypoints
+        if len(kpq) == 0 or len(state.points3D) == 0:
+            return None, query_local_descriptors
+
+        # Project the tracked points into the new frame with the previous pose
+        # NOTE: we ignore the lens distortion here, the search radius has to cover it
+        cam_from_world = state.cam_from_world.matrix()
+        points_cam = np.matmul(state.points3D, cam_from_world[:3,:3].T) + cam_from_world[:3,3]
+        in_front = points_cam[:,2] > 0
+        projections = np.matmul(points_cam, query_camera.calibration_matrix().T)
+        projections = projections[:,:2] / np.maximum(projections[:,2:], 1e-6)
+
+        # Match each projected point to the most similar keypoint within the search radius
+        sq_distances = np.sum((projections[:,None,:] - kpq[None,:,:]) ** 2, axis=-1)
+        similarities = np.matmul(state.descriptors.T, query_local_descriptors["descriptors"])
+        invalid = (sq_distances > self.tracking_search_radius ** 2) | ~in_front[:,None]
+        similarities[invalid] = -np.inf
+        best_keypoints = np.argmax(similarities, axis=1)
+        best_similarities = similarities[np.arange(len(best_keypoints)), best_keypoints]
+        point_idxs = np.where(best_similarities >= self.tracking_min_similarity)[0]
+
+        # Keep only the most similar point for each keypoint
+        point_idxs = point_idxs[np.argsort(-best_similarities[point_idxs])]
+        _, unique = np.unique(best_keypoints[point_idxs], return_index=True)
+        point_idxs = point_idxs[unique]
+        keypoint_idxs = best_keypoints[point_idxs]
+
+        if len(point_idxs) < self.tracking_min_inliers:
+            return None, query_local_descriptors
+
+        localizer = self.query_localizer(profile)
+        ret = localizer.localize_points(kpq[keypoint_idxs], state.points3D[point_idxs], query_camera)
+        if ret is None or ret["num_inliers"] < self.tracking_min_inliers:
+            return None, query_local_descriptors
+
+        ret["camera"] = query_camera
+        ret["keypoint_idxs"] = keypoint_idxs
+        ret["points3D"] = state.points3D[point_idxs]
+        return ret, query_local_descriptors
+
+
+    def geopose_from_cam_from_world(self, cam_from_world: pycolmap.Rigid3d) -> GeoPose:
+        if self.debug:
+            pose_c2m = np.eye(4)
+            pose_c2m[:3,:4] = cam_from_world.inverse().matrix()
+            diagnostics_logger.debug("tvec_map: %s", pose_c2m[:3,3])
+            euler_c2m = Rotation.from_matrix(pose_c2m[:3,:3]).as_euler(seq='xyz', degrees=True)
+            diagnostics_logger.debug("euler_map: %s", euler_c2m)
+        return self.geoposes_from_cam_from_worlds([cam_from_world])[0]
+
+
+    # Converts camera poses in the map into GeoPoses, all at once with the precomputed map transforms
+    def geoposes_from_cam_from_worlds(self, cam_from_worlds: List[pycolmap.Rigid3d]) -> List[GeoPose]:
+        if len(cam_from_worlds) == 0:
+            return []
+        with time_stage(self.map_id, "geo_conversion"):
+            poses_c2m = np.tile(np.eye(4), (len(cam_from_worlds), 1, 1))
+            for pose_c2m, cam_from_world in zip(poses_c2m, cam_from_worlds):
+                pose_c2m[:3,:4] = cam_from_world.inverse().matrix()
 
             # Multiply with map to ENU transform
-            pose_c2enu = np.matmul(self.map_to_ENU_transform, pose_c2m)
-            tvec_enu = pose_c2enu[:3,3]
-            #quat_enu = Rotation.from_matrix(pose_c2enu[:3,:3]).as_quat() # This is still in vision convention, camera looking upwards
+            poses_c2enu = np.matmul(self.map_to_ENU_transform, poses_c2m)
+            tvecs_enu = poses_c2enu[:,:3,3]
             # We have to convert the orientation from computer vision (X right, Y down, Z forward) to robotics convention (X forward, Y left, Z up)
-            rot_enu_cv = Rotation.from_matrix(pose_c2enu[:3,:3])
-            rot_cv_to_rob = Rotation.from_matrix([
-                [0.0,-1.0, 0.0],
-                [0.0, 0.0,-1.0],
-                [1.0, 0.0, 0.0]
-            ])
-            rot_enu_rob = rot_enu_cv * rot_cv_to_rob
-            quat_enu = rot_enu_rob.as_quat()
+            rots_enu_rob = np.matmul(poses_c2enu[:,:3,:3], kRotationMatrixCvToRob)
+            quats_enu = Rotation.from_matrix(rots_enu_rob).as_quat()
 
             if self.debug:
-                print(f"tvec_enu: {tvec_enu}")
-                print(f"quat_enu: {quat_enu}")
-                euler_enu = Rotation.from_quat(quat_enu).as_euler(seq='xyz', degrees=True)
-                print(f"euler_enu: {euler_enu}")
-
-            # convert to geopose using the reference position of the map
-            lat, lon, h = enu_to_geodetic(tvec_enu[0], tvec_enu[1], tvec_enu[2],
-                    self.map_geodetic_ref.lat, self.map_geodetic_ref.lon, self.map_geodetic_ref.h)
+                diagnostics_logger.debug("tvec_enu: %s", tvecs_enu)
+                diagnostics_logger.debug("quat_enu: %s", quats_enu)
+                euler_enu = Rotation.from_quat(quats_enu).as_euler(seq='xyz', degrees=True)
+                diagnostics_logger.debug("euler_enu: %s", euler_enu)
 
-            geoPose = GeoPose(position=Position(lat, lon, h), quaternion=Quaternion(quat_enu[0], quat_enu[1], quat_enu[2], quat_enu[3]))
-            geoPoses.append(geoPose)
+            # convert to geoposes using the reference position of the map
+            lats, lons, hs = self.map_tangent_frame.enu_to_geodetic(tvecs_enu)
 
-        if len(geoPoses) == 0:
-            return None
-        print(f"Found {len(geoPoses)} pose hypotheses. Returning the first one.")
-        return geoPoses[0]
+            geoPoses = [GeoPose(position=Position(float(lat), float(lon), float(h)), quaternion=Quaternion(*(float(v) for v in quat)))
+                        for lat, lon, h, quat in zip(lats, lons, hs, quats_enu)]
+            return geoPoses
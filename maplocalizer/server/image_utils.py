@@ -0,0 +1,226 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+import math
+import numpy as np
+import cv2
+
+from oscp.geoposeprotocol import CameraModel, CameraParameters, ImageFormat, ImageOrientation
+
+
+# Parameter layout of the Colmap camera models (see https://colmap.github.io/cameras.html)
+# "simple": f, cx, cy, ...
+# "pinhole": fx, fy, cx, cy, ...
+kCameraModelLayouts = {
+    CameraModel.SIMPLE_PINHOLE: "simple",
+    CameraModel.PINHOLE: "pinhole",
+    CameraModel.SIMPLE_RADIAL: "simple",
+    CameraModel.RADIAL: "simple",
+    CameraModel.OPENCV: "pinhole",
+    CameraModel.OPENCV_FISHEYE: "pinhole",
+    CameraModel.FULL_OPENCV: "pinhole",
+    CameraModel.FOV: "pinhole",
+    CameraModel.SIMPLE_RADIAL_FISHEYE: "simple",
+    CameraModel.RADIAL_FISHEYE: "simple",
+    CameraModel.THIN_PRISM_FISHEYE: "pinhole",
+}
+
+# Indices of the tangential distortion parameters (p1, p2) and of the thin prism parameters (sx1, sy1).
+# These are the only distortion parameters that change when the image is rotated or mirrored.
+kCameraModelTangentialIdxs = {
+    CameraModel.OPENCV: (6, 7),
+    CameraModel.FULL_OPENCV: (6, 7),
+    CameraModel.THIN_PRISM_FISHEYE: (6, 7),
+}
+kCameraModelThinPrismIdxs = {
+    CameraModel.THIN_PRISM_FISHEYE: (10, 11),
+}
+
+# OpenCV can decode JPEG images directly at 1/2, 1/4 or 1/8 resolution (DCT scaling), which is much faster than full decoding
+kReducedColorFlags = {
+    1: cv2.IMREAD_COLOR_BGR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+kReducedGrayscaleFlags = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+# Reads the image size from the header of a JPEG file without decoding it.
+# Returns (width, height) or None if the data is not a JPEG image.
+def get_jpeg_size(data: bytes):
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i+1]
+        if marker == 0xFF: # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8: # markers without length
+            i += 2
+            continue
+        # the start of frame markers contain the image size (0xC4, 0xC8 and 0xCC are other markers)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i+5:i+7], 'big')
+            width = int.from_bytes(data[i+7:i+9], 'big')
+            return width, height
+        length = int.from_bytes(data[i+2:i+4], 'big')
+        i += 2 + length
+    return None
+
+
+# Returns the largest JPEG reduction factor (1, 2, 4 or 8) so that the reduced image is still not smaller than max_size
+def get_jpeg_reduction_factor(width, height, max_size):
+    if max_size is None:
+        return 1
+    for factor in (8, 4, 2):
+        if math.ceil(max(width, height) / factor) >= max_size:
+            return factor
+    return 1
+
+
+# Decodes an encoded image (JPG, PNG, ...) into a BGR image, or into a grayscale image if grayscale is True.
+# If max_size is given and the image is a JPEG larger than max_size, the image is decoded at a reduced resolution.
+# Returns the image and the scale factors in x and y direction w.r.t. the original resolution.
+def decode_image(data: bytes, max_size=None, grayscale=False):
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    factor = 1
+    jpeg_size = get_jpeg_size(data)
+    if jpeg_size is not None:
+        factor = get_jpeg_reduction_factor(jpeg_size[0], jpeg_size[1], max_size)
+
+    flags = kReducedGrayscaleFlags[factor] if grayscale else kReducedColorFlags[factor]
+    image = cv2.imdecode(buffer, flags)
+    if image is None or factor == 1:
+        return image, 1.0, 1.0
+
+    # NOTE: OpenCV applies the EXIF orientation while decoding, so the original size might be rotated
+    width, height = jpeg_size
+    if (image.shape[1] > image.shape[0]) != (width > height):
+        width, height = height, width
+    return image, image.shape[1] / width, image.shape[0] / height
+
+
+# Scales the intrinsics of a camera after the image was resized by scale_x and scale_y.
+# The distortion parameters of the Colmap camera models are defined on normalized coordinates and do not change.
+def scale_camera_parameters(camera_parameters: CameraParameters, scale_x, scale_y) -> CameraParameters:
+    if camera_parameters.model not in kCameraModelLayouts:
+        raise ValueError(f"Cannot scale the parameters of camera model {camera_parameters.model}")
+
+    params = list(camera_parameters.modelParams)
+    if kCameraModelLayouts[camera_parameters.model] == "simple":
+        params[0] *= (scale_x + scale_y) / 2.0 # f
+        params[1] *= scale_x # cx
+        params[2] *= scale_y # cy
+    else:
+        params[0] *= scale_x # fx
+        params[1] *= scale_y # fy
+        params[2] *= scale_x # cx
+        params[3] *= scale_y # cy
+
+    return CameraParameters(model=camera_parameters.model, modelParams=params,
+        minMaxDepth=camera_parameters.minMaxDepth, minMaxDisparity=camera_parameters.minMaxDisparity)
+
+
+# Wraps a raw GRAY8 or RGBA32 buffer into an image without decoding. size is (width, height).
+# GRAY8 buffers are used without copying if a grayscale image is requested.
+# Returns a BGR image, or a grayscale image if grayscale is True.
+def decode_raw_image(data: bytes, image_format: ImageFormat, size, grayscale=False):
+    width, height = int(size[0]), int(size[1])
+    num_channels = 1 if image_format == ImageFormat.GRAY8 else 4
+    if width <= 0 or height <= 0 or len(data) != width * height * num_channels:
+        raise ValueError(f"The image size {width}x{height} does not match the {image_format.value} buffer of {len(data)} bytes")
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if image_format == ImageFormat.GRAY8:
+        image = buffer.reshape((height, width))
+        if not grayscale:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    else:
+        image = buffer.reshape((height, width, 4))
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2GRAY if grayscale else cv2.COLOR_RGBA2BGR)
+    return image
+
+
+# Rotates the intrinsics of a camera by 90 degree steps counter-clockwise (same convention as rotate_intrinsics() of the MapBuilder).
+# In normalized coordinates the rotation by 90 degrees is x' = y, y' = -x, so besides the focal lengths and the principal point,
+# the tangential and thin prism distortion parameters also change.
+# Returns the new camera parameters and the new image size.
+def rotate_camera_parameters(camera_parameters: CameraParameters, degrees, width, height):
+    if camera_parameters.model not in kCameraModelLayouts:
+        raise ValueError(f"Cannot rotate the parameters of camera model {camera_parameters.model}")
+    if degrees % 90 != 0:
+        raise ValueError("Rotation degrees must be a multiple of 90")
+
+    params = list(camera_parameters.modelParams)
+    for _ in range((degrees // 90) % 4):
+        if kCameraModelLayouts[camera_parameters.model] == "simple":
+            params[1], params[2] = params[2], width - params[1] # cx, cy
+        else:
+            params[0], params[1] = params[1], params[0] # fx, fy
+            params[2], params[3] = params[3], width - params[2] # cx, cy
+        if camera_parameters.model in kCameraModelTangentialIdxs:
+            p1, p2 = kCameraModelTangentialIdxs[camera_parameters.model]
+            params[p1], params[p2] = -params[p2], params[p1]
+        if camera_parameters.model in kCameraModelThinPrismIdxs:
+            sx1, sy1 = kCameraModelThinPrismIdxs[camera_parameters.model]
+            params[sx1], params[sy1] = params[sy1], -params[sx1]
+        width, height = height, width
+
+    return CameraParameters(model=camera_parameters.model, modelParams=params,
+        minMaxDepth=camera_parameters.minMaxDepth, minMaxDisparity=camera_parameters.minMaxDisparity), width, height
+
+
+# Mirrors the intrinsics of a camera horizontally. In normalized coordinates this is x' = -x.
+def mirror_camera_parameters(camera_parameters: CameraParameters, width) -> CameraParameters:
+    if camera_parameters.model not in kCameraModelLayouts:
+        raise ValueError(f"Cannot mirror the parameters of camera model {camera_parameters.model}")
+
+    params = list(camera_parameters.modelParams)
+    if kCameraModelLayouts[camera_parameters.model] == "simple":
+        params[1] = width - params[1] # cx
+    else:
+        params[2] = width - params[2] # cx
+    if camera_parameters.model in kCameraModelTangentialIdxs:
+        _, p2 = kCameraModelTangentialIdxs[camera_parameters.model]
+        params[p2] = -params[p2]
+    if camera_parameters.model in kCameraModelThinPrismIdxs:
+        sx1, _ = kCameraModelThinPrismIdxs[camera_parameters.model]
+        params[sx1] = -params[sx1]
+
+    return CameraParameters(model=camera_parameters.model, modelParams=params,
+        minMaxDepth=camera_parameters.minMaxDepth, minMaxDisparity=camera_parameters.minMaxDisparity)
+
+
+# Brings the image upright according to the image orientation of the camera reading:
+# first the image is mirrored horizontally (if mirrored), then rotated counter-clockwise by the given degrees.
+# The camera parameters are transformed consistently. Returns the new image and camera parameters.
+def apply_image_orientation(image, camera_parameters: CameraParameters, orientation: ImageOrientation):
+    degrees = int(round(orientation.rotation)) % 360
+    if degrees % 90 != 0:
+        raise ValueError(f"Unsupported image rotation {orientation.rotation}, it must be a multiple of 90 degrees")
+
+    if orientation.mirrored:
+        camera_parameters = mirror_camera_parameters(camera_parameters, image.shape[1])
+        image = cv2.flip(image, 1)
+
+    if degrees != 0:
+        camera_parameters, _, _ = rotate_camera_parameters(camera_parameters, degrees, image.shape[1], image.shape[0])
+        rotations = {90: cv2.ROTATE_90_COUNTERCLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_CLOCKWISE}
+        image = cv2.rotate(image, rotations[degrees])
+
+    return image, camera_parameters
@@ -0,0 +1,308 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Optional TorchScript inference backend for CPU deployments.
+# The eager hloc modules (feature extractor, retrieval network, matcher) are traced with example inputs once, and the traced
+# graphs are cached as TorchScript files. At load time the graph is frozen and optimized for inference (constant folding,
+# conv-batchnorm fusion, oneDNN kernels), and its outputs are compared with the eager model on validation inputs of
+# different image sizes and batch sizes. If the export fails or the outputs differ (e.g. because of data-dependent control
+# flow that tracing cannot capture, like the early stopping of LightGlue), the eager model is used.
+#
+# The models can also run at a lower precision on the CPU: int8 quantizes the weights of the linear layers (e.g. the
+# attention and MLP layers of LightGlue) and quantizes their inputs dynamically, bf16 stores the weights of the convolutions
+# in bfloat16 and runs the convolutions and matrix products in bfloat16 (on CPUs with native bfloat16 support).
+
+import copy
+import hashlib
+import io
+import json
+import time
+from pathlib import Path
+
+import torch
+
+from log_utils import get_logger
+
+logger = get_logger("inference")
+
+
+kInferenceBackends = ("eager", "torchscript")
+kDefaultInferenceBackend = "eager"
+kParityRtol = 1e-3
+kParityAtol = 1e-3
+
+kInferencePrecisions = ("float32", "int8", "bf16")
+kDefaultInferencePrecision = "float32"
+kNetworks = ("local", "global", "matcher") # local feature extractor, global feature extractor (retrieval), matcher
+
+
+# Calls a TorchScript module with the interface of the eager hloc module.
+# If split_batches is true, the images of a batch are run one by one and the outputs are concatenated, for the graphs
+# that were traced with one image and contain a loop over the batch (which the tracer unrolls).
+# NOTE: the other attributes (e.g. detection_noise of the extractors) are read from the eager module
+class TorchScriptModel:
+
+    def __init__(self, script_module, eager_model, split_batches=False):
+        self.script_module = script_module
+        self.eager_model = eager_model
+        self.split_batches = split_batches
+
+    def __call__(self, data):
+        if not self.split_batches or "image" not in data or data["image"].shape[0] == 1:
+            return dict(self.script_module(data))
+        preds = [dict(self.script_module({**data, "image": image[None]})) for image in data["image"]]
+        merged = {}
+        for k, v in preds[0].items():
+            if isinstance(v, (list, tuple)):
+                merged[k] = tuple(x for pred in preds for x in pred[k])
+            else:
+                merged[k] = torch.cat([pred[k] for pred in preds], 0)
+        return merged
+
+    def __getattr__(self, name):
+        return getattr(self.eager_model, name)
+
+
+# Converts the list outputs (one tensor per image of the batch, e.g. the keypoints) into tuples, which the tracer supports
+class TraceAdapter(torch.nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, data):
+        return {k: tuple(v) if isinstance(v, list) else v for k, v in self.model(data).items()}
+
+
+# Runs the model with the convolutions and matrix products in bfloat16 and returns the floating point outputs in float32
+class BFloat16Model(torch.nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, data):
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            pred = self.model(data)
+        return {k: to_float32(v) for k, v in pred.items()}
+
+    # NOTE: the other attributes (e.g. detection_noise of the extractors) are read from the wrapped model
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.model, name)
+
+
+def to_float32(value):
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.is_floating_point() else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_float32(v) for v in value)
+    return value
+
+
+# Converts the weights of the convolutions of the model in place
+def set_conv_dtype(model, dtype):
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv1d, torch.nn.Conv2d)):
+            module.to(dtype)
+
+
+# Returns the precision of each network (see kNetworks) from the inference_precision of the map config,
+# which is either one precision for all networks or a dict of precisions per network
+def load_precisions(precision_config):
+    if precision_config is None:
+        precision_config = kDefaultInferencePrecision
+    if isinstance(precision_config, str):
+        precisions = {network: precision_config for network in kNetworks}
+    else:
+        unknown = [network for network in precision_config if network not in kNetworks]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown networks {unknown} in the inference precision, must be in {kNetworks}")
+        precisions = {network: precision_config.get(network, kDefaultInferencePrecision) for network in kNetworks}
+    for network, precision in precisions.items():
+        if precision not in kInferencePrecisions:
+            raise ValueError(f"unknown inference precision {precision} of the {network} network, must be one of {kInferencePrecisions}")
+    return precisions
+
+
+# Returns True if the CPU supports bfloat16 natively (e.g. AVX512-BF16 or AMX), otherwise bfloat16 is slower than float32
+def bf16_supported():
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+# Returns the size of the weights of the model in megabytes
+def weights_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / (1024.0 * 1024.0)
+
+
+# Returns the model at the given precision (float32, int8 or bf16), or the float32 model if the precision is not supported
+# by the model or the CPU, or if the lower precision model fails on validation_data (a list of input dicts)
+def quantize_model(model, name: str, precision: str, validation_data):
+    if precision not in kInferencePrecisions:
+        raise ValueError(f"unknown inference precision {precision}, must be one of {kInferencePrecisions}")
+    if precision == "float32":
+        return model
+    if precision == "int8" and not any(type(m) is torch.nn.Linear for m in model.modules()):
+        logger.warning("The %s model has no linear layers to quantize to int8, keeping float32", name)
+        return model
+    if precision == "bf16" and not bf16_supported():
+        logger.warning("The CPU does not support bfloat16 natively, keeping the %s model in float32", name)
+        return model
+
+    size = weights_size_mb(model)
+    expected, _ = run_timed(model, validation_data)
+    if precision == "int8":
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        # NOTE: a copy is converted, the conversion back to float32 would not restore the lost precision of the weights
+        bf16_model = copy.deepcopy(model)
+        set_conv_dtype(bf16_model, torch.bfloat16)
+        quantized = BFloat16Model(bf16_model)
+
+    try:
+        actual, _ = run_timed(quantized, validation_data)
+        errors = quantization_errors(expected, actual)
+    except Exception as e:
+        logger.warning("The %s %s model failed on the validation inputs (%s), keeping float32", precision, name, e)
+        return model
+    logger.info("Using the %s %s model: weights %.1f MB instead of %.1f MB, relative output errors on the validation inputs %s",
+        precision, name, weights_size_mb(quantized), size, {k: round(v, 4) for k, v in errors.items()})
+    return quantized
+
+
+# Returns the largest relative error of each floating point output of the lower precision model (where the shapes match),
+# or raises ValueError if the outputs have other keys or are not finite.
+# NOTE: the keypoints and matches may differ, their effect on the localization is measured with the benchmark
+def quantization_errors(expected, actual):
+    errors = {}
+    for pred_expected, pred_actual in zip(expected, actual):
+        if pred_expected.keys() != pred_actual.keys():
+            raise ValueError(f"the outputs {sorted(pred_actual.keys())} differ from {sorted(pred_expected.keys())}")
+        for k, v in pred_actual.items():
+            values = v if isinstance(v, (list, tuple)) else [v]
+            values_expected = pred_expected[k] if isinstance(pred_expected[k], (list, tuple)) else [pred_expected[k]]
+            for value, value_expected in zip(values, values_expected):
+                if not isinstance(value, torch.Tensor) or not value.is_floating_point():
+                    continue
+                if not torch.isfinite(value).all():
+                    raise ValueError(f"the output {k} is not finite")
+                if value.shape == value_expected.shape and value.numel() > 0:
+                    error = ((value - value_expected).norm() / value_expected.norm().clamp(min=1e-12)).item()
+                    errors[k] = max(errors.get(k, 0.0), error)
+    return errors
+
+
+# Returns the TorchScript file of the model in the cache folder. The name depends on the conf and the torch version.
+def export_path(cache_dir: Path, name: str, conf):
+    key = json.dumps({"conf": conf, "torch": torch.__version__}, sort_keys=True, default=str)
+    return cache_dir / f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pt"
+
+
+# Loads the traced model from the cache or traces it with the example input and stores it in the cache
+def load_or_trace(model, example_data, path: Path):
+    if path.exists():
+        logger.info("Loading TorchScript model from %s", path)
+        return torch.jit.load(str(path), map_location="cpu")
+    logger.info("Tracing model into %s", path)
+    with torch.no_grad():
+        traced = torch.jit.trace(TraceAdapter(model).eval(), (example_data,), strict=False, check_trace=False)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(traced, str(path))
+    return traced
+
+
+# Returns True if the outputs have the same structure and shapes and their values are close
+def outputs_match(expected, actual, rtol=kParityRtol, atol=kParityAtol):
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and expected.keys() == actual.keys() and \
+            all(outputs_match(expected[k], actual[k], rtol, atol) for k in expected)
+    if isinstance(expected, (list, tuple)):
+        return isinstance(actual, (list, tuple)) and len(expected) == len(actual) and \
+            all(outputs_match(e, a, rtol, atol) for e, a in zip(expected, actual))
+    if isinstance(expected, torch.Tensor):
+        if not isinstance(actual, torch.Tensor) or expected.shape != actual.shape:
+            return False
+        if expected.is_floating_point():
+            return torch.allclose(expected.float(), actual.float(), rtol=rtol, atol=atol)
+        return torch.equal(expected, actual)
+    return expected == actual
+
+
+# Runs the model on the inputs and returns the outputs and the total time in seconds
+def run_timed(model, data_list):
+    outputs = []
+    t_start = time.perf_counter()
+    with torch.no_grad():
+        for data in data_list:
+            outputs.append(dict(model(data)))
+    return outputs, time.perf_counter() - t_start
+
+
+# Returns the TorchScript version of the model (frozen and optimized if that keeps the parity), or the eager model
+# if the export fails or the outputs on validation_data (a list of input dicts, the first one is used for tracing) differ.
+def compile_model(model, name: str, conf, validation_data, cache_dir: Path, optimize=True):
+    try:
+        traced = load_or_trace(model, validation_data[0], export_path(cache_dir, name, conf))
+    except Exception:
+        logger.exception("Could not export the %s model, using the eager model", name)
+        return model
+
+    expected, eager_time = run_timed(model, validation_data)
+    candidates = []
+    if optimize:
+        try:
+            candidates.append(("optimized", torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))))
+        except Exception as e:
+            logger.info("Could not optimize the %s model: %s", name, e)
+    candidates.append(("traced", traced.eval()))
+
+    for variant, script_module in candidates:
+        for split_batches in (False, True):
+            script_model = TorchScriptModel(script_module, model, split_batches)
+            description = f"{variant}{' (one image at a time)' if split_batches else ''} TorchScript {name} model"
+            try:
+                # NOTE: run twice, the first runs of TorchScript modules profile and optimize the graph
+                run_timed(script_model, validation_data)
+                actual, script_time = run_timed(script_model, validation_data)
+            except Exception as e:
+                logger.info("The %s failed on the validation inputs: %s", description, e)
+                continue
+            if not outputs_match(expected, actual):
+                logger.info("The outputs of the %s differ from the eager model", description)
+                continue
+            logger.info("Using the %s: %.1f ms instead of %.1f ms (eager) on the validation inputs",
+                description, script_time * 1000.0, eager_time * 1000.0)
+            return script_model
+
+    logger.warning("No TorchScript version of the %s model matches the eager model, using the eager model", name)
+    return model
+
+
+# Returns a deterministic textured image (batch, channels, height, width) in [0, 1] for the tracing and validation
+def example_image(height, width, channels=1, batch_size=1, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    coarse = torch.rand((batch_size, channels, max(height // 16, 2), max(width // 16, 2)), generator=generator)
+    fine = torch.rand((batch_size, channels, height, width), generator=generator)
+    smooth = torch.nn.functional.interpolate(coarse, size=(height, width), mode="bilinear", align_corners=False)
+    return (0.8 * smooth + 0.2 * fine).clamp(0.0, 1.0)
+
+
+# Sets the number of threads of the CPU inference (the intra-op threads, and the inter-op threads if they can still be set)
+def set_inference_threads(num_threads, num_interop_threads=None):
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            logger.warning("The inter-op threads can only be set before the first parallel work, keeping %d", torch.get_num_interop_threads())
+    logger.info("Inference threads: %d intra-op, %d inter-op", torch.get_num_threads(), torch.get_num_interop_threads())
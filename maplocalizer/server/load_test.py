@@ -0,0 +1,212 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+# Open-loop load test of the localization endpoint.
+# The requests are sent at the target rate regardless of the responses (like independent clients do), so the queueing
+# in the server shows up in the latencies. With multiple rates, each rate runs for the given duration and the first rate
+# that the server cannot sustain is reported as the saturation point.
+#
+# Example usage
+# python server/load_test.py --url http://localhost:8000/localize/geopose --images /path/to/images --rates 1,2,4,8 --duration 30
+# python server/load_test.py --url ... --query_model /path/to/sparse --images /path/to/images --rates 5 --prior_fraction 0.5
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import cv2
+import httpx
+import numpy as np
+
+from benchmark_utils import latency_summary, load_queries
+from gpp_client import kAcceptHeader, make_geopose_request
+from oscp.geopose import GeoPose
+from oscp.geoposeprotocol import CameraModel, CameraParameters
+
+
+kImageExtensions = (".jpg", ".jpeg", ".JPG", ".JPEG")
+
+
+class LoadTestImage:
+
+    def __init__(self, name, data, width, height, camera_parameters):
+        self.name = name
+        self.data = data # JPG bytes
+        self.width = width
+        self.height = height
+        self.camera_parameters = camera_parameters
+
+
+# Reads the JPG images of a folder. Without a Colmap model, the intrinsics are guessed from the image size.
+def load_images(images_path: Path, query_model_path: Path | None = None, focal_length_factor=1.2):
+    images = []
+    if query_model_path is not None:
+        for query in load_queries(query_model_path, images_path):
+            with open(query.image_path, "rb") as f:
+                images.append(LoadTestImage(query.name, f.read(), query.width, query.height, query.camera_parameters))
+        return images
+
+    for image_path in sorted(images_path.iterdir()):
+        if image_path.suffix not in kImageExtensions:
+            continue
+        with open(image_path, "rb") as f:
+            data = f.read()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            continue
+        height, width = image.shape[:2]
+        focal_length = focal_length_factor * max(width, height)
+        camera_parameters = CameraParameters(model=CameraModel.PINHOLE,
+            modelParams=[focal_length, focal_length, width / 2.0, height / 2.0])
+        images.append(LoadTestImage(image_path.name, data, width, height, camera_parameters))
+    return images
+
+
+class LoadTestResult:
+
+    def __init__(self):
+        self.status_codes = defaultdict(int)
+        self.latencies = []
+        self.success_latencies = []
+        self.num_sent = 0
+
+
+async def send_request(client: httpx.AsyncClient, url, image: LoadTestImage, result: LoadTestResult, prior_geoposes,
+        prior_fraction, geolocation, timeout):
+    prior_geopose = prior_geoposes.get(image.name) if random.random() < prior_fraction else None
+    gppRequest = make_geopose_request(image.data, (image.width, image.height), image.camera_parameters,
+        prior_geopose=prior_geopose, geolocation=geolocation)
+    body = gppRequest.toJson()
+
+    t_start = time.perf_counter()
+    try:
+        response = await client.post(url, content=body, timeout=timeout,
+            headers={"Content-Type": "application/json", "Accept": kAcceptHeader})
+        status = str(response.status_code)
+    except httpx.TimeoutException:
+        response = None
+        status = "timeout"
+    except httpx.HTTPError:
+        response = None
+        status = "connection_error"
+    seconds = time.perf_counter() - t_start
+
+    result.status_codes[status] += 1
+    result.latencies.append(seconds)
+    if response is not None and response.status_code == 200:
+        result.success_latencies.append(seconds)
+        # the next requests with the same image can use this pose as a prior, like a client that localized recently
+        try:
+            prior_geoposes[image.name] = GeoPose.fromJson(response.json()["geopose"])
+        except (ValueError, KeyError):
+            pass
+
+
+# Sends requests at the target rate for the given duration and waits for the outstanding responses
+async def run_rate(url, images, rate, duration, poisson=False, prior_fraction=0.0, geolocation=None, timeout=30.0,
+        max_connections=1000):
+    result = LoadTestResult()
+    prior_geoposes = {}
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    async with httpx.AsyncClient(limits=limits) as client:
+        tasks = []
+        t_start = time.perf_counter()
+        t_next = t_start
+        i = 0
+        while t_next < t_start + duration:
+            delay = t_next - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            image = images[i % len(images)]
+            tasks.append(asyncio.create_task(send_request(client, url, image, result, prior_geoposes,
+                prior_fraction, geolocation, timeout)))
+            result.num_sent += 1
+            i += 1
+            t_next += random.expovariate(rate) if poisson else 1.0 / rate
+        t_send_end = time.perf_counter()
+        await asyncio.gather(*tasks)
+        t_end = time.perf_counter()
+
+    num_errors = sum(n for status, n in result.status_codes.items() if status not in ("200", "404"))
+    return {
+        "target_rate": rate,
+        "sent_rate": result.num_sent / (t_send_end - t_start),
+        "throughput": len(result.success_latencies) / (t_end - t_start),
+        "completed_rate": len(result.latencies) / (t_end - t_start),
+        "num_sent": result.num_sent,
+        "error_rate": num_errors / max(result.num_sent, 1),
+        "status_codes": dict(result.status_codes),
+        "latency_ms": latency_summary(result.latencies),
+        "success_latency_ms": latency_summary(result.success_latencies),
+    }
+
+
+# A rate is sustained if the server completes the requests at the rate they are sent, without errors and within the latency limit
+def is_saturated(report, max_latency_ms, max_error_rate):
+    latency = report["latency_ms"]
+    return (report["completed_rate"] < 0.9 * report["sent_rate"]
+        or report["error_rate"] > max_error_rate
+        or latency.get("p95", 0.0) > max_latency_ms)
+
+
+async def run_load_test(url, images, rates, duration, poisson=False, prior_fraction=0.0, geolocation=None, timeout=30.0,
+        max_latency_ms=2000.0, max_error_rate=0.05):
+    reports = []
+    saturation_rate = None
+    for rate in rates:
+        report = await run_rate(url, images, rate, duration, poisson, prior_fraction, geolocation, timeout)
+        report["saturated"] = is_saturated(report, max_latency_ms, max_error_rate)
+        reports.append(report)
+        latency = report["latency_ms"]
+        print(f"rate {rate:7.2f}/s: sent {report['sent_rate']:7.2f}/s  completed {report['completed_rate']:7.2f}/s  "
+              f"localized {report['throughput']:7.2f}/s  p50 {latency.get('p50', 0):8.1f} ms  p95 {latency.get('p95', 0):8.1f} ms  "
+              f"errors {100.0 * report['error_rate']:5.1f}%  {report['status_codes']}")
+        if report["saturated"]:
+            saturation_rate = rate
+            break
+    return {"url": url, "duration_s": duration, "rates": reports, "saturation_rate": saturation_rate}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open-loop load test of the OpenVPS MapLocalizer")
+    parser.add_argument("--url", type=str, default="http://localhost:8000/localize/geopose")
+    parser.add_argument("--images", type=str, required=True, help="folder of JPG query images")
+    parser.add_argument("--query_model", type=str, default=None, help="optional Colmap model with the cameras of the images")
+    parser.add_argument("--rates", type=str, default="1,2,4,8,16", help="target request rates (requests/s), tried in this order")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per rate")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times instead of a fixed interval")
+    parser.add_argument("--prior_fraction", type=float, default=0.0, help="fraction of requests with the last pose of the same image as prior")
+    parser.add_argument("--geolocation", type=str, default=None, help="optional geolocation reading as lat,lon,alt,accuracy")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--max_latency_ms", type=float, default=2000.0, help="p95 latency above which a rate counts as saturated")
+    parser.add_argument("--max_error_rate", type=float, default=0.05)
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    images = load_images(Path(args.images), Path(args.query_model) if args.query_model is not None else None)
+    if len(images) == 0:
+        print("Error: no images found in " + args.images)
+        exit(-1)
+    print(f"{len(images)} images")
+
+    rates = [float(r) for r in args.rates.split(",")]
+    geolocation = tuple(float(v) for v in args.geolocation.split(",")) if args.geolocation is not None else None
+    report = asyncio.run(run_load_test(args.url, images, rates, args.duration, args.poisson, args.prior_fraction,
+        geolocation, args.timeout, args.max_latency_ms, args.max_error_rate))
+    if report["saturation_rate"] is not None:
+        print(f"Saturated at {report['saturation_rate']} requests/s")
+    else:
+        print("Not saturated at the tested rates")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
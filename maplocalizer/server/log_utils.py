@@ -0,0 +1,118 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Logging of the localizer.
+# The records are put into a queue and written by a background thread, so a slow log sink does not block the requests.
+# Each record carries the id of the request it belongs to. The verbose diagnostics (camera, configs, intermediate results)
+# are logged with the "openvps.diagnostics" logger, only for a sampled fraction of the requests.
+
+import atexit
+import os
+import contextvars
+import logging
+import logging.handlers
+import queue
+import random
+import uuid
+
+
+kLoggerName = "openvps"
+kDiagnosticsLoggerName = "openvps.diagnostics"
+kLogFormat = "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+request_sampled_var = contextvars.ContextVar("request_sampled", default=True)
+
+_sample_rate = 1.0
+_listener = None
+
+
+# Adds the id of the current request to the log records
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+# Drops the records of the requests that were not sampled
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        return request_sampled_var.get()
+
+
+# Configures the openvps loggers with a non-blocking queue handler. Can be called again to change the settings.
+# sample_rate is the fraction of requests whose verbose diagnostics are logged.
+def setup_logging(level="INFO", sample_rate=1.0):
+    global _sample_rate, _listener
+    _sample_rate = sample_rate
+
+    logger = logging.getLogger(kLoggerName)
+    logger.setLevel(level if isinstance(level, int) else level.upper())
+    logger.propagate = False
+
+    if _listener is None:
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        # NOTE: the request id is read in the calling thread, before the record is queued
+        queue_handler.addFilter(RequestIdFilter())
+        logger.addHandler(queue_handler)
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(kLogFormat))
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        logging.getLogger(kDiagnosticsLoggerName).addFilter(SamplingFilter())
+
+
+# Restarts the background writer in a forked child process, where the thread of the parent does not exist
+def restart_logging_after_fork():
+    global _listener
+    if _listener is None:
+        return
+    logger = logging.getLogger(kLoggerName)
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    for log_filter in list(logging.getLogger(kDiagnosticsLoggerName).filters):
+        if isinstance(log_filter, SamplingFilter):
+            logging.getLogger(kDiagnosticsLoggerName).removeFilter(log_filter)
+    _listener = None
+    setup_logging(logger.level, _sample_rate)
+
+os.register_at_fork(after_in_child=restart_logging_after_fork)
+
+
+# Sets the correlation id of the current request (a new random id if none is given) and decides whether its diagnostics are logged.
+# The id is stored in a context variable, so it is also visible in the threads started with the copied context.
+def start_request(request_id: str | None = None):
+    if request_id is None or request_id == "":
+        request_id = uuid.uuid4().hex[:12]
+    request_id_var.set(request_id)
+    request_sampled_var.set(random.random() < _sample_rate)
+    return request_id
+
+
+# Replaces the correlation id of the current request, e.g. with the id of the GeoPoseRequest once it is parsed
+def set_request_id(request_id: str):
+    request_id_var.set(request_id)
+
+
+def get_logger(name: str):
+    return logging.getLogger(f"{kLoggerName}.{name}")
+
+
+def get_diagnostics_logger():
+    return logging.getLogger(kDiagnosticsLoggerName)
+
+
+# Returns whether the diagnostics of the current request are logged, so that expensive diagnostics are only built if needed
+# NOTE: the SamplingFilter would drop the records of the unsampled requests only after they were built
+def diagnostics_enabled():
+    return get_diagnostics_logger().isEnabledFor(logging.DEBUG) and request_sampled_var.get()
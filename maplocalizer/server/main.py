@@ -10,15 +10,20 @@ from fastapi import FastAPI, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 
 import time
-from oscp.geoposeprotocol import GeoPoseRequest, GeoPoseResponse, verify_version_header
+import math
+import anyio
+from oscp.geoposeprotocol import GeoPoseRequest, GeoPoseResponse, GeoPoseAccuracy, CameraReading, ImageFormat, verify_version_header
 import base64
 
-# Note: large numpy and cv2 are only used for decoding the image, but this could be solved with simpler libs too
-import numpy as np
-import cv2
+from image_utils import decode_image, decode_raw_image, scale_camera_parameters, apply_image_orientation
 
 from hloc_localizer import HlocLocalizer
 from dummy_localizer import DummyLocalizer
+from admission import AdmissionController
+from result_cache import ResultCache, query_key
+from map_export import kExportFrames
+from metrics import time_stage, count_request, observe_request_latency, count_profile, count_cache, export_metrics
+from log_utils import setup_logging, start_request, set_request_id, get_logger, get_diagnostics_logger, diagnostics_enabled
 
 import env
 from functools import lru_cache
@@ -48,8 +53,83 @@ mapConfigs[kDummyMapId] = {}
 localizers[kDummyMapId] = DummyLocalizer()
 currentMapId = kDummyMapId
 
+setup_logging("DEBUG" if get_settings().debug else get_settings().logLevel, get_settings().logSampleRate)
+logger = get_logger("server")
+diagnostics_logger = get_diagnostics_logger()
+
 # print the env file
-print(get_settings())
+logger.info(get_settings())
+
+# The localizations run in worker threads, so that the event loop keeps accepting requests and the feature extraction
+# of concurrent requests can be batched. The limiter bounds the number of concurrent localizations (and the GPU memory).
+localizationLimiter = anyio.CapacityLimiter(get_settings().localizationThreads)
+
+# The admission control rejects or downgrades the requests that cannot be localized within their deadline
+admissionController = AdmissionController(get_settings().localizationThreads, get_settings().maxQueuedLocalizations)
+
+# Short-lived cache of the results of identical queries (e.g. retries of the clients)
+resultCache = None
+if get_settings().resultCacheTtl > 0:
+    resultCache = ResultCache(get_settings().resultCacheTtl / 1000.0, get_settings().resultCacheSize)
+
+
+# Runs a blocking localization function in a worker thread
+# NOTE: anyio copies the context into the thread, so the request id is also logged from there
+# NOTE: if latencyKey (map id, profile) is given, the localization time is recorded for the admission control
+async def run_localization(func, *args, latencyKey=None):
+    def run():
+        t_start = time.perf_counter()
+        result = func(*args)
+        if latencyKey is not None:
+            admissionController.observe_latency(*latencyKey, time.perf_counter() - t_start)
+        return result
+    return await anyio.to_thread.run_sync(run, limiter=localizationLimiter)
+
+
+# Number of localizations that are running or waiting for a worker thread
+def get_localization_load():
+    return localizationLimiter.borrowed_tokens + localizationLimiter.statistics().tasks_waiting
+
+
+# Returns the name of the quality/latency profile for a request and an error message (None on success).
+# The requested profile is used if given. Otherwise the load profile is used under load and the default profile of the map (None) if not.
+def select_profile(localizer: HlocLocalizer, requestedProfile: str | None):
+    if requestedProfile is not None:
+        if requestedProfile not in localizer.profiles:
+            return None, f"Unknown profile {requestedProfile}, must be one of {list(localizer.profiles.keys())}"
+        return requestedProfile, None
+    threshold = get_settings().loadProfileThreshold
+    if threshold > 0 and get_localization_load() >= threshold and get_settings().loadProfile in localizer.profiles:
+        logger.debug("Under load, using the %s profile", get_settings().loadProfile)
+        return get_settings().loadProfile, None
+    return None, None
+
+
+# Returns the time left until the deadline of the request (in seconds) or None if there is no deadline.
+# The deadline is given in milliseconds by the request (query parameter) or by the requestDeadline setting.
+def get_time_budget(deadline: float | None, tRequestStart: float):
+    if deadline is None:
+        deadline = get_settings().requestDeadline
+    if deadline <= 0:
+        return None
+    return deadline / 1000.0 - (time.perf_counter() - tRequestStart)
+
+
+# Returns the GeoPose of the most recent prior pose of the request if it is fresh enough, otherwise None
+def get_fresh_prior_geopose(gppRequest: GeoPoseRequest):
+    maxAge = get_settings().priorPoseMaxAge
+    if maxAge <= 0:
+        return None
+    freshestPriorPose = None
+    for priorPose in gppRequest.priorPoses:
+        age = gppRequest.timestamp - priorPose.timestamp
+        if age < 0 or age > maxAge:
+            continue
+        if freshestPriorPose is None or priorPose.timestamp > freshestPriorPose.timestamp:
+            freshestPriorPose = priorPose
+    if freshestPriorPose is None:
+        return None
+    return freshestPriorPose.geopose
 
 
 @app.get("/")
@@ -60,7 +140,14 @@ def read_root():
 # TODO: change to POST. We have it as GET for now so that it can be triggered simply from a browser
 @app.get('/load_map/{id}')
 async def load_map(id:str, response: Response):
-    print("Loading map: " + str(id))
+    result, response.status_code = load_map_by_id(id)
+    return result
+
+
+# Loads the map with the given id and makes it the current map. Returns the response content and the status code.
+# NOTE: enableBatching is False in the parent process of the pre-fork server (serve.py), the workers enable it after the fork
+def load_map_by_id(id:str, enableBatching=True):
+    logger.info("Loading map: %s", id)
     # NOTE: in the future, we can check whether this ID belongs to an HLoc map or other type of map, and load accordingly
 
     # check whether map with this id exists
@@ -74,14 +161,13 @@ async def load_map(id:str, response: Response):
     global allMapIdsAndPaths
     allMapIdsAndPaths = HlocLocalizer.get_all_map_ids_and_paths(mapsRootDir)
     if not id in allMapIdsAndPaths.keys():
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return {"ERROR":f"There is no map with id {id}"}
+        return {"ERROR":f"There is no map with id {id}"}, status.HTTP_400_BAD_REQUEST
 
     global currentMapId
     # check whether already loaded
     if id in mapConfigs.keys() and id in localizers.keys():
         currentMapId = id # it was already loaded, now make it current
-        return {"STATUS":f"Already loaded map {id}"}
+        return {"STATUS":f"Already loaded map {id}"}, status.HTTP_200_OK
 
     try:
         mapPath = allMapIdsAndPaths[id]
@@ -89,23 +175,36 @@ async def load_map(id:str, response: Response):
         transformPath = mapPath / 'transform.json'
         mapConfig = HlocLocalizer.load_map_config(configPath, mapsRootDirDocker, mapsRootDir)
         if mapConfig is None:
-            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-            return {"ERROR":f"Failed to load map config {id}"}
+            return {"ERROR":f"Failed to load map config {id}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
         mapConfigs[id] = mapConfig
 
-        localizer = HlocLocalizer(debug=get_settings().debug)
+        localizer = HlocLocalizer(debug=get_settings().debug, map_id=id)
         if not localizer.load_map_transform(transformPath):
             del mapConfigs[id]
-            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-            return {"ERROR":f"Failed to load map transform {id}"}
+            return {"ERROR":f"Failed to load map transform {id}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
         localizer.load_map(mapConfig)
+        if enableBatching:
+            enable_batching(localizer)
         localizers[id] = localizer
         currentMapId = id
-        return {"STATUS":f"Successfully loaded map {id}"}
+        return {"STATUS":f"Successfully loaded map {id}"}, status.HTTP_200_OK
     except:
-        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        return {"ERROR":f"Failed to load map {id}"}
+        logger.exception("Failed to load map %s", id)
+        return {"ERROR":f"Failed to load map {id}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def enable_batching(localizer: HlocLocalizer):
+    if get_settings().localizationThreads > 1 and get_settings().batchingMaxDelay >= 0:
+        localizer.enable_batching(get_settings().batchingMaxDelay / 1000.0)
+
+
+# Reinitializes the loaded maps in a forked worker process of the pre-fork server (serve.py)
+def reinit_after_fork():
+    for localizer in localizers.values():
+        if isinstance(localizer, HlocLocalizer):
+            localizer.reinit_after_fork()
+            enable_batching(localizer)
 
 
 # TODO: change to POST. We have it as GET for now so that it can be triggered simply from a browser
@@ -119,12 +218,35 @@ async def load_transform(id:str, response: Response):
         return {"ERROR":f"There is no map loaded with id {id}. Try to load it first."}
     mapPath = allMapIdsAndPaths[id]
     transformPath = mapPath / 'transform.json'
+    # NOTE: the cached geoposes were computed with the previous transform
+    if resultCache is not None:
+        resultCache.clear()
     if not localizers[id].load_map_transform(transformPath):
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"ERROR":f"Failed to load map transform {id}"}
     return {"STATUS":f"Successfully updated the transform of map {id}"}
 
 
+# Writes the 3D points of a loaded map as a PLY file next to its reconstruction.
+# frame is one of map, enu, ecef, geodetic; the georeferenced frames use the map transform.
+# TODO: change to POST. We have it as GET for now so that it can be triggered simply from a browser
+@app.get('/export_map/{id}')
+def export_map(id:str, response: Response, frame:str = "map"):
+    if not id in localizers.keys():
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"ERROR":f"There is no map loaded with id {id}. Try to load it first."}
+    if not frame in kExportFrames:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"ERROR":f"Unknown export frame {frame}, must be one of {', '.join(kExportFrames)}"}
+    try:
+        exportPath = localizers[id].export_map(frame)
+        return {"STATUS":f"Exported map {id} to {exportPath}"}
+    except:
+        logger.exception("Failed to export map %s", id)
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"ERROR":f"Failed to export map {id}"}
+
+
 # TODO: change to POST. We have it as GET for now so that it can be triggered simply from a browser
 @app.get('/unload_map/{id}')
 async def unload_map(id:str):
@@ -132,7 +254,12 @@ async def unload_map(id:str):
     if id in mapConfigs:
         del mapConfigs[id]
     if id in localizers:
+        if isinstance(localizers[id], HlocLocalizer):
+            localizers[id].disable_batching()
         del localizers[id]
+    # NOTE: the map may be rebuilt before it is loaded again
+    if resultCache is not None:
+        resultCache.clear()
     return {"STATUS":f"Unloaded map {id}"}
 
 
@@ -151,104 +278,354 @@ def read_main():
     return {"id": currentMapId}
 
 
+# State of the admission control: localizations in flight, queue depth, shed counts and average latencies
+@app.get("/admission")
+def read_admission():
+    return admissionController.status()
+
+
+# Prometheus metrics: per-stage latencies, request counts, inlier counts and failure reasons
+@app.get("/metrics")
+def metrics():
+    data, contentType = export_metrics()
+    return Response(content=data, media_type=contentType)
+
+
+# Verifies the protocol version in the Accept header. Returns an error message or None if the version is supported
+def check_version_header(request: Request):
+    success, versionMajor, versionMinor = verify_version_header(request.headers)
+    if not success:
+        return "The request has no or malformed Accept header. Add the header application/vnd.oscp+json;version=2.0"
+    logger.debug("Version: %s %s", versionMajor, versionMinor)
+    if versionMajor != 2 or versionMinor != 0:
+        return "This server supports only GPP v2.0"
+    return None
+
+
+# Decodes the image and the camera parameters of a camera reading.
+# Encoded images (JPG) larger than maxImageSize are decoded at reduced resolution if possible, and the camera parameters are scaled accordingly.
+# Raw GRAY8 and RGBA32 images are used as they are. If grayscale is True, the image is converted directly to grayscale.
+# Finally the image is brought upright according to the image orientation.
+# Returns the image, the camera parameters and an error message (None on success)
+def decode_camera_reading(cameraReading: CameraReading, maxImageSize=None, grayscale=False):
+    if cameraReading.imageBytes is None:
+        return None, None, "Request has no image"
+
+    queryImageData = base64.b64decode(cameraReading.imageBytes)
+
+    scaleX, scaleY = 1.0, 1.0
+    if cameraReading.imageFormat in (ImageFormat.GRAY8, ImageFormat.RGBA32):
+        if cameraReading.size is None or len(cameraReading.size) != 2:
+            return None, None, f"Request has no image size for image format {cameraReading.imageFormat.value}"
+        try:
+            queryImage = decode_raw_image(queryImageData, cameraReading.imageFormat, cameraReading.size, grayscale)
+        except ValueError as e:
+            return None, None, str(e)
+    elif cameraReading.imageFormat == ImageFormat.DEPTH:
+        return None, None, "Depth images are not supported"
+    else:
+        queryImage, scaleX, scaleY = decode_image(queryImageData, maxImageSize, grayscale)
+    if queryImage is None:
+        return None, None, "Could not decode image"
+
+    # Get and decode the camera parameters
+    if cameraReading.params is None:
+        return None, None, "Request has no camera parameters"
+
+    cameraParameters = cameraReading.params
+    try:
+        # NOTE: if the image got resized, we need to resize the camera parameters too
+        if scaleX != 1.0 or scaleY != 1.0:
+            cameraParameters = scale_camera_parameters(cameraParameters, scaleX, scaleY)
+        if cameraReading.imageOrientation is not None:
+            queryImage, cameraParameters = apply_image_orientation(queryImage, cameraParameters, cameraReading.imageOrientation)
+    except ValueError as e:
+        return None, None, str(e)
+
+    return queryImage, cameraParameters, None
+
+
+# Returns the localizer of the current map and an error message (None on success)
+def get_current_localizer():
+    global currentMapId
+    if currentMapId == kDummyMapId:
+        return None, "No map is loaded. Load a map with /load_map/{id} first."
+    if not currentMapId in localizers:
+        raise RuntimeError(f"Could not find localizer with id {currentMapId}")
+    return localizers[currentMapId], None
+
+
+# NOTE: with hypotheses=k (query parameter), the response contains also the pose hypotheses of the k best covisibility clusters
+# in the "hypotheses" field, each with its geopose, accuracy and numInliers. The first hypothesis is the returned geopose.
+# NOTE: with profile=fast|balanced|accurate (query parameter), the localization runs with the given quality/latency profile.
+# Without it, the default profile of the map is used, or the load profile if the server is under load.
+# NOTE: with deadline=ms (query parameter, default: the requestDeadline setting), the request is downgraded to a cheaper
+# profile if its expected latency exceeds the deadline, or rejected with 503 if no profile fits.
 @app.post('/localize/geopose')
-async def localize(request: Request, response: Response):
+async def localize(request: Request, response: Response, hypotheses: int = 0, profile: str | None = None, deadline: float | None = None):
+    t_request_start = time.perf_counter()
+    start_request()
     try:
 
         # First verify the protocol version from the Accept header
-        success, versionMajor, versionMinor = verify_version_header(request.headers)
-        if not success:
-            errorMessage = "The request has no or malformed Accept header. Add the header application/vnd.oscp+json;version=2.0"
-            print(errorMessage)
-            response.status_code = status.HTTP_400_BAD_REQUEST
-            return {"ERROR" : errorMessage}
-        if get_settings().debug:
-            print(f"Version: {versionMajor} {versionMinor}")
-        if versionMajor != 2 or versionMinor != 0:
-            errorMessage = "This server supports only GPP v2.0"
-            print(errorMessage)
+        errorMessage = check_version_header(request)
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize", "bad_request")
             response.status_code = status.HTTP_400_BAD_REQUEST
             return {"ERROR" : errorMessage}
 
         jRequest = await request.json()
 
         gppRequest = GeoPoseRequest.fromJson(jRequest)
+        if gppRequest.id:
+            set_request_id(gppRequest.id)
 
         # Get and decode the image
         if len(gppRequest.sensorReadings.cameraReadings) < 1:
             errorMessage = "Request has no camera readings"
-            print(errorMessage)
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize", "bad_request")
             response.status_code = status.HTTP_400_BAD_REQUEST
             return {"ERROR": errorMessage}
 
-        if gppRequest.sensorReadings.cameraReadings[0].imageBytes is None:
-            response.status_code = status.HTTP_400_BAD_REQUEST
-            errorMessage = "Request has no image"
-            print(errorMessage)
+        localizer, errorMessage = get_current_localizer()
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize", "no_map")
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
             return {"ERROR": errorMessage}
 
-        queryImageData = base64.b64decode(gppRequest.sensorReadings.cameraReadings[0].imageBytes)
-
-        queryImageBuffer = np.frombuffer(queryImageData, dtype=np.uint8)
-        queryImage = cv2.imdecode(queryImageBuffer, cv2.IMREAD_COLOR_BGR)
-        if queryImage is None:
+        profileName, errorMessage = select_profile(localizer, profile)
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize", "bad_request")
             response.status_code = status.HTTP_400_BAD_REQUEST
-            errorMessage = "Could not decode image"
-            print(errorMessage)
             return {"ERROR": errorMessage}
+        profileName = profileName or localizer.default_profile
 
-        # Get and decode the camera parameters
-        if gppRequest.sensorReadings.cameraReadings[0].params is None:
+        with time_stage(currentMapId, "decode"):
+            queryImage, cameraParameters, errorMessage = decode_camera_reading(gppRequest.sensorReadings.cameraReadings[0], localizer.get_max_image_size(), not localizer.requires_color_image())
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize", "bad_request")
             response.status_code = status.HTTP_400_BAD_REQUEST
-            errorMessage = "Request has no camera parameters"
-            print(errorMessage)
             return {"ERROR": errorMessage}
 
-        cameraParameters = gppRequest.sensorReadings.cameraReadings[0].params
-        # NOTE: if the image gets resized, we need to resize the camera parameters too
-
-        if get_settings().debug:
-            print(cameraParameters)
+        if diagnostics_enabled():
+            diagnostics_logger.debug("Camera parameters: %s", cameraParameters)
             gppRequest.sensorReadings.cameraReadings[0].imageBytes = "DELETED" # Delete the image content before logging
-            print()
-            print(gppRequest.toJson())
+            diagnostics_logger.debug("Request: %s", gppRequest.toJson())
 
-        global currentMapId
-        if currentMapId ==kDummyMapId:
-            errorMessage = "No map is loaded. Load a map with /load_map/{id} first."
-            print(errorMessage)
-            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-            return {"ERROR": errorMessage}
-
-        if not currentMapId in localizers:
-            raise RuntimeError(f"Could not find localizer with id {currentMapId}")
-        localizer = localizers[currentMapId]
+        priorGeoPose = get_fresh_prior_geopose(gppRequest)
+        if priorGeoPose is not None:
+            logger.debug("Using prior pose: %s", priorGeoPose)
 
+        # Identical queries are answered from the result cache or wait for the identical localization in flight
+        # NOTE: not in tracking mode, where the result depends on the previous frames of the session
         t_start = time.perf_counter()
-        estimatedGeoPose = localizer.localize(queryImage, cameraParameters)
+        cacheKey = None
+        cacheSource = None
+        queryCacheKey = lambda profileName: query_key(queryImage, currentMapId, cameraParameters, profileName, priorGeoPose, max(hypotheses, 1))
+        if resultCache is not None and not get_settings().tracking:
+            cacheKey = queryCacheKey(profileName)
+            cachedResult, cacheSource = await resultCache.lookup(cacheKey)
+            count_cache(currentMapId, cacheSource or "miss")
+        if cacheSource is not None:
+            logger.debug("Result of an identical query (%s)", cacheSource)
+            poseHypotheses = cachedResult
+            estimatedGeoPose = poseHypotheses[0].geopose if len(poseHypotheses) > 0 else None
+        else:
+            admission = admissionController.admit(currentMapId, profileName, localizer.profiles.keys(), get_time_budget(deadline, t_request_start),
+                get_settings().loadProfile if get_settings().loadProfile in localizer.profiles else None)
+            if not admission.admitted:
+                errorMessage = f"Request {gppRequest.id} rejected: {admission.reason}"
+                logger.info(errorMessage)
+                count_request(currentMapId, "localize", "shed")
+                response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+                response.headers["Retry-After"] = str(max(math.ceil(admission.expected_latency or 1.0), 1))
+                return {"ERROR": errorMessage}
+            if admission.profile is not None:
+                logger.debug("Downgraded from the %s to the %s profile to meet the deadline", profileName, admission.profile)
+                profileName = admission.profile
+                # NOTE: the result is cached under the profile that actually runs, not the requested one,
+                # and an identical query of that profile may already be cached or in flight
+                if cacheKey is not None:
+                    cacheKey = queryCacheKey(profileName)
+                    cachedResult, cacheSource = await resultCache.lookup(cacheKey)
+                    if cacheSource is not None:
+                        logger.debug("Result of an identical query of the %s profile (%s)", profileName, cacheSource)
+            count_profile(currentMapId, profileName)
+
+            latencyKey = (currentMapId, profileName)
+            with admissionController.track(currentMapId):
+                if get_settings().tracking:
+                    # NOTE: the GeoPoseProtocol has no session concept, so we identify the tracking session by the client address and the camera sensor
+                    clientHost = request.client.host if request.client is not None else ""
+                    sessionId = f"{clientHost}/{gppRequest.sensorReadings.cameraReadings[0].sensorId}"
+                    estimatedGeoPose = await run_localization(localizer.track, sessionId, queryImage, cameraParameters, priorGeoPose, profileName, latencyKey=latencyKey)
+                    poseHypotheses = []
+                else:
+                    localizeHypotheses = lambda: run_localization(localizer.localize_hypotheses, queryImage, cameraParameters, priorGeoPose, max(hypotheses, 1), profileName, latencyKey=latencyKey)
+                    if cacheSource is not None:
+                        poseHypotheses = cachedResult
+                    elif cacheKey is not None:
+                        poseHypotheses = await resultCache.compute(cacheKey, localizeHypotheses)
+                    else:
+                        poseHypotheses = await localizeHypotheses()
+                    estimatedGeoPose = poseHypotheses[0].geopose if len(poseHypotheses) > 0 else None
         t_end = time.perf_counter()
-        if get_settings().debug:
-            print(f"Elapsed time: {t_end - t_start} ms")
+        logger.debug("Elapsed time: %.1f ms", (t_end - t_start) * 1000.0)
         if estimatedGeoPose is None:
-            errorMessage = "Could not localize request {gppRequest.id}"
-            print(errorMessage)
+            errorMessage = f"Could not localize request {gppRequest.id}"
+            logger.info(errorMessage)
+            count_request(currentMapId, "localize", "not_localized")
+            observe_request_latency(currentMapId, "localize", time.perf_counter() - t_request_start)
             response.status_code = status.HTTP_404_NOT_FOUND
             return {"ERROR": errorMessage}
 
         gppResponse = GeoPoseResponse()
         gppResponse.id = gppRequest.id
         gppResponse.timestamp = gppRequest.timestamp
+        gppResponse.accuracy = poseHypotheses[0].accuracy if len(poseHypotheses) > 0 else GeoPoseAccuracy()
         gppResponse.geopose = estimatedGeoPose
+        if hypotheses > 0:
+            gppResponse.hypotheses = poseHypotheses
 
-        if get_settings().debug:
-            jResponse = gppResponse.toJson()
-            print()
-            print(jResponse)
-            print()
+        if diagnostics_enabled():
+            diagnostics_logger.debug("Response: %s", gppResponse.toJson())
 
+        count_request(currentMapId, "localize", "ok")
+        observe_request_latency(currentMapId, "localize", time.perf_counter() - t_request_start)
         response.status_code = status.HTTP_200_OK
         return gppResponse
 
     except Exception as e:
+        logger.exception("Internal server error")
+        count_request(currentMapId, "localize", "error")
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"ERROR":"Internal server error: " + str(e)}
+
+
+# NOTE: the body is either a list of GeoPoseRequests (the first camera reading of each request is localized)
+# or a single GeoPoseRequest with multiple camera readings (each camera reading is localized).
+# The response is a list with a GeoPoseResponse or an error for each image, in the same order.
+# NOTE: the profile query parameter selects the quality/latency profile of all images, as in /localize/geopose.
+@app.post('/localize/geopose/batch')
+async def localize_batch(request: Request, response: Response, profile: str | None = None):
+    t_request_start = time.perf_counter()
+    start_request()
+    try:
+        errorMessage = check_version_header(request)
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize_batch", "bad_request")
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"ERROR" : errorMessage}
+
+        jRequest = await request.json()
+
+        # collect (request, camera reading, timestamp) for each image
+        items = []
+        if isinstance(jRequest, list):
+            for jItem in jRequest:
+                gppRequest = GeoPoseRequest.fromJson(jItem)
+                cameraReading = None
+                if len(gppRequest.sensorReadings.cameraReadings) > 0:
+                    cameraReading = gppRequest.sensorReadings.cameraReadings[0]
+                items.append((gppRequest, cameraReading, gppRequest.timestamp))
+        else:
+            gppRequest = GeoPoseRequest.fromJson(jRequest)
+            for cameraReading in gppRequest.sensorReadings.cameraReadings:
+                items.append((gppRequest, cameraReading, cameraReading.timestamp))
+        if len(items) == 0:
+            errorMessage = "Request has no camera readings"
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize_batch", "bad_request")
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"ERROR": errorMessage}
+
+        localizer, errorMessage = get_current_localizer()
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize_batch", "no_map")
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return {"ERROR": errorMessage}
+
+        profileName, errorMessage = select_profile(localizer, profile)
+        if errorMessage is not None:
+            logger.warning(errorMessage)
+            count_request(currentMapId, "localize_batch", "bad_request")
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"ERROR": errorMessage}
+        profileName = profileName or localizer.default_profile
+
+        # NOTE: batch requests have no deadline, they are only rejected if too many localizations are queued
+        admission = admissionController.admit(currentMapId, profileName, localizer.profiles.keys(), endpoint="localize_batch")
+        if not admission.admitted:
+            errorMessage = f"Batch request rejected: {admission.reason}"
+            logger.info(errorMessage)
+            count_request(currentMapId, "localize_batch", "shed")
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            response.headers["Retry-After"] = "1"
+            return {"ERROR": errorMessage}
+        count_profile(currentMapId, profileName)
+
+        maxImageSize = localizer.get_max_image_size()
+        grayscale = not localizer.requires_color_image()
+        results = [None] * len(items)
+        validIdxs = []
+        queryImages = []
+        cameraParametersList = []
+        priorGeoPoses = []
+        for i, (gppRequest, cameraReading, _) in enumerate(items):
+            if cameraReading is None:
+                results[i] = {"ERROR": "Request has no camera readings"}
+                continue
+            with time_stage(currentMapId, "decode"):
+                queryImage, cameraParameters, errorMessage = decode_camera_reading(cameraReading, maxImageSize, grayscale)
+            if errorMessage is not None:
+                results[i] = {"ERROR": errorMessage}
+                continue
+            validIdxs.append(i)
+            queryImages.append(queryImage)
+            cameraParametersList.append(cameraParameters)
+            priorGeoPoses.append(get_fresh_prior_geopose(gppRequest))
+
+        t_start = time.perf_counter()
+        estimatedGeoPoses = []
+        if len(validIdxs) > 0:
+            with admissionController.track(currentMapId):
+                estimatedGeoPoses = await run_localization(localizer.localize_batch, queryImages, cameraParametersList, priorGeoPoses, profileName)
+        t_end = time.perf_counter()
+        logger.debug("Elapsed time for %d images: %.1f ms", len(validIdxs), (t_end - t_start) * 1000.0)
+
+        for i, estimatedGeoPose in zip(validIdxs, estimatedGeoPoses):
+            gppRequest, _, timestamp = items[i]
+            if estimatedGeoPose is None:
+                results[i] = {"ERROR": f"Could not localize request {gppRequest.id}"}
+                continue
+            gppResponse = GeoPoseResponse()
+            gppResponse.id = gppRequest.id
+            gppResponse.timestamp = timestamp
+            gppResponse.geopose = estimatedGeoPose
+            results[i] = gppResponse
+
+        # NOTE: the results are counted per image, the latency per batch request
+        for i, result in enumerate(results):
+            if isinstance(result, GeoPoseResponse):
+                count_request(currentMapId, "localize_batch", "ok")
+            elif i in validIdxs:
+                count_request(currentMapId, "localize_batch", "not_localized")
+            else:
+                count_request(currentMapId, "localize_batch", "bad_request")
+        observe_request_latency(currentMapId, "localize_batch", time.perf_counter() - t_request_start)
+
+        response.status_code = status.HTTP_200_OK
+        return results
+
+    except Exception as e:
+        logger.exception("Internal server error")
+        count_request(currentMapId, "localize_batch", "error")
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return {"ERROR":"Internal server error: " + str(e)}
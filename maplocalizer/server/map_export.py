@@ -0,0 +1,146 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+# Export of the 3D points of a map as a binary PLY point cloud, optionally georeferenced with the map transform.
+# The points are converted and written in chunks with vectorized NumPy operations, so large maps can be exported
+# without creating a Python object (GeoPose, Position, tuple) per point.
+#
+# Frames:
+#   map       coordinates of the reconstruction (same as pycolmap's export_PLY)
+#   enu       East-North-Up meters around the geodetic reference of the map
+#   ecef      Earth-centered Earth-fixed meters (WGS84), stored as double
+#   geodetic  latitude and longitude in degrees and height above the ellipsoid in meters, stored as double
+#
+# Example usage
+# python server/map_export.py --model /uploads/<dataset>/hlocMaps/<map>/reconstruction \
+#     --transform_file /uploads/<dataset>/hlocMaps/<map>/transform.json --frame ecef --output map_ecef.ply
+
+import argparse
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pycolmap
+
+from oscp.geopose_utils import LocalTangentFrame
+
+
+kExportFrames = ("map", "enu", "ecef", "geodetic")
+kExportChunkSize = 100000 # number of points converted and written at once
+
+kCoordinateNames = {
+    "map": ("x", "y", "z"),
+    "enu": ("x", "y", "z"),
+    "ecef": ("x", "y", "z"),
+    "geodetic": ("lat", "lon", "h"),
+}
+
+
+def point_cloud_dtype(frame):
+    # NOTE: ECEF and geodetic coordinates need double precision, float would round them to meters
+    coordinate_type = "<f4" if frame in ("map", "enu") else "<f8"
+    names = kCoordinateNames[frame]
+    return np.dtype([(names[0], coordinate_type), (names[1], coordinate_type), (names[2], coordinate_type),
+                     ("red", "u1"), ("green", "u1"), ("blue", "u1")])
+
+
+def ply_header(dtype: np.dtype, num_points):
+    ply_types = {"<f4": "float", "<f8": "double", "|u1": "uchar"}
+    lines = ["ply", "format binary_little_endian 1.0", f"element vertex {num_points}"]
+    for name in dtype.names:
+        lines.append(f"property {ply_types[dtype[name].str]} {name}")
+    lines.append("end_header")
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+# Yields the coordinates (N,3) and colors (N,3) of the 3D points in chunks
+def iter_point_chunks(reconstruction: pycolmap.Reconstruction, chunk_size=kExportChunkSize):
+    points = iter(reconstruction.points3D.values())
+    while True:
+        chunk = list(itertools.islice(points, chunk_size))
+        if len(chunk) == 0:
+            return
+        xyz = np.array([p.xyz for p in chunk], dtype=np.float64)
+        rgb = np.array([p.color for p in chunk], dtype=np.uint8)
+        yield xyz, rgb
+
+
+# Converts map coordinates (N,3) into the given frame.
+# map_to_ENU_transform is the 4x4 transform of the map (already in ENU convention) and tangent_frame the geodetic reference.
+def transform_points(xyz_map, frame, map_to_ENU_transform=None, tangent_frame: LocalTangentFrame | None = None):
+    if frame == "map":
+        return xyz_map
+    transform = np.asarray(map_to_ENU_transform, dtype=np.float64)
+    xyz_enu = np.matmul(xyz_map, transform[:3,:3].T) + transform[:3,3]
+    if frame == "enu":
+        return xyz_enu
+    xyz_ecef = tangent_frame.enu_to_ecef(xyz_enu)
+    if frame == "ecef":
+        return xyz_ecef
+    lat, lon, h = tangent_frame.enu_to_geodetic(xyz_enu)
+    return np.stack([lat, lon, h], axis=-1)
+
+
+# Writes the 3D points of the reconstruction into a binary PLY file in the given frame. Returns the number of points.
+def export_point_cloud(reconstruction: pycolmap.Reconstruction, output_path: Path, frame="map",
+        map_to_ENU_transform=None, tangent_frame: LocalTangentFrame | None = None, chunk_size=kExportChunkSize):
+    if frame not in kExportFrames:
+        raise ValueError(f"unknown export frame {frame}, must be one of {kExportFrames}")
+    if frame != "map" and map_to_ENU_transform is None:
+        raise ValueError(f"the {frame} export needs the map transform")
+    if frame in ("ecef", "geodetic") and tangent_frame is None:
+        raise ValueError(f"the {frame} export needs the geodetic reference of the map")
+
+    dtype = point_cloud_dtype(frame)
+    names = dtype.names
+    num_points = len(reconstruction.points3D)
+    with open(output_path, "wb") as f:
+        f.write(ply_header(dtype, num_points))
+        for xyz, rgb in iter_point_chunks(reconstruction, chunk_size):
+            coordinates = transform_points(xyz, frame, map_to_ENU_transform, tangent_frame)
+            vertices = np.empty(len(xyz), dtype=dtype)
+            vertices[names[0]] = coordinates[:,0]
+            vertices[names[1]] = coordinates[:,1]
+            vertices[names[2]] = coordinates[:,2]
+            vertices["red"] = rgb[:,0]
+            vertices["green"] = rgb[:,1]
+            vertices["blue"] = rgb[:,2]
+            f.write(vertices.tobytes())
+    return num_points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Georeferenced point cloud export of an OpenVPS map")
+    parser.add_argument("--model", type=str, required=True, help="Colmap model of the map (the reconstruction folder)")
+    parser.add_argument("--transform_file", type=str, default=None, help="transform.json of the map, required for all frames except map")
+    parser.add_argument("--frame", type=str, choices=kExportFrames, default="ecef")
+    parser.add_argument("--chunk_size", type=int, default=kExportChunkSize)
+    parser.add_argument("--output", type=str, required=True, help="output PLY file")
+    args = parser.parse_args()
+
+    map_to_ENU_transform = None
+    tangent_frame = None
+    if args.frame != "map":
+        if args.transform_file is None:
+            print(f"Error: the {args.frame} export needs --transform_file")
+            exit(-1)
+        # NOTE: imported here so that the map frame export works without the localizer dependencies
+        from hloc_localizer import HlocLocalizer
+        localizer = HlocLocalizer()
+        if not localizer.load_map_transform(Path(args.transform_file)):
+            print("Error: invalid transform file: " + args.transform_file)
+            exit(-1)
+        map_to_ENU_transform = localizer.map_to_ENU_transform
+        tangent_frame = localizer.map_tangent_frame
+
+    model_path = Path(args.model)
+    if not model_path.exists() or not model_path.is_dir():
+        print("Error: invalid model dir: " + str(model_path))
+        exit(-1)
+    reconstruction = pycolmap.Reconstruction(str(model_path))
+    num_points = export_point_cloud(reconstruction, Path(args.output), args.frame, map_to_ENU_transform, tangent_frame, args.chunk_size)
+    print(f"Exported {num_points} points ({args.frame}) to {args.output}")
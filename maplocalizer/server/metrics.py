@@ -0,0 +1,110 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Prometheus metrics of the localizer. They are exported on the /metrics endpoint of the server.
+
+from contextlib import contextmanager
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+
+# seconds, covering both the per-pair matching (milliseconds) and the full requests (seconds)
+kLatencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+kInlierBuckets = (0, 10, 20, 30, 50, 100, 200, 500, 1000, 2000)
+kBatchSizeBuckets = (1, 2, 3, 4, 6, 8, 12, 16)
+
+# Stages: decode, preprocess, local_extraction, global_extraction, prior_selection, retrieval, hdf5_read, prefetch_wait,
+# matching (per image pair), clustering, pnp (per cluster), tracking, geo_conversion
+stage_latency = Histogram("openvps_stage_latency_seconds", "Latency of the localization stages",
+    ["map_id", "stage"], buckets=kLatencyBuckets)
+request_latency = Histogram("openvps_request_latency_seconds", "End-to-end latency of the localization requests",
+    ["map_id", "endpoint"], buckets=kLatencyBuckets)
+requests_total = Counter("openvps_requests_total", "Number of localization requests by result",
+    ["map_id", "endpoint", "result"])
+failures_total = Counter("openvps_localization_failures_total", "Number of failed localizations by reason",
+    ["map_id", "reason"])
+inliers = Histogram("openvps_localization_inliers", "Number of PnP inliers of the best pose of each query",
+    ["map_id"], buckets=kInlierBuckets)
+batch_size = Histogram("openvps_extraction_batch_size", "Number of images in the forward passes of the micro-batched feature extraction",
+    ["map_id", "model"], buckets=kBatchSizeBuckets)
+shed_total = Counter("openvps_shed_requests_total", "Number of requests rejected or downgraded by the admission control",
+    ["map_id", "endpoint", "action"])
+in_flight = Gauge("openvps_localizations_in_flight", "Number of localizations running or waiting for a worker thread",
+    ["map_id"])
+queue_depth = Gauge("openvps_localization_queue_depth", "Number of localizations waiting for a worker thread",
+    ["map_id"])
+cache_total = Counter("openvps_result_cache_total", "Number of localization requests by result cache outcome",
+    ["map_id", "result"])
+profiles_total = Counter("openvps_profile_requests_total", "Number of localization requests by quality/latency profile",
+    ["map_id", "profile"])
+cascade_total = Counter("openvps_cascade_matching_total", "Number of cascade matchings by the stage that localized the query",
+    ["map_id", "stage"])
+
+
+# Callbacks that receive every stage measurement as (map_id, stage, seconds), e.g. to collect the raw latencies in benchmarks
+stage_observers = []
+
+
+# Measures the duration of the enclosed block as the given stage
+@contextmanager
+def time_stage(map_id: str, stage: str):
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t_start
+        stage_latency.labels(map_id, stage).observe(seconds)
+        for observer in stage_observers:
+            observer(map_id, stage, seconds)
+
+
+def count_request(map_id: str, endpoint: str, result: str):
+    requests_total.labels(map_id, endpoint, result).inc()
+
+
+def observe_request_latency(map_id: str, endpoint: str, seconds: float):
+    request_latency.labels(map_id, endpoint).observe(seconds)
+
+
+def count_failure(map_id: str, reason: str):
+    failures_total.labels(map_id, reason).inc()
+
+
+def observe_inliers(map_id: str, num_inliers: int):
+    inliers.labels(map_id).observe(num_inliers)
+
+
+def observe_batch_size(map_id: str, model: str, size: int):
+    batch_size.labels(map_id, model).observe(size)
+
+
+def count_shed(map_id: str, endpoint: str, action: str):
+    shed_total.labels(map_id, endpoint, action).inc()
+
+
+def set_in_flight(map_id: str, num_in_flight: int, num_queued: int):
+    in_flight.labels(map_id).set(num_in_flight)
+    queue_depth.labels(map_id).set(num_queued)
+
+
+def count_cache(map_id: str, result: str):
+    cache_total.labels(map_id, result).inc()
+
+
+def count_profile(map_id: str, profile: str):
+    profiles_total.labels(map_id, profile).inc()
+
+
+def count_cascade(map_id: str, stage: str):
+    cascade_total.labels(map_id, stage).inc()
+
+
+# Returns the metrics in the Prometheus text format and its content type
+def export_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,71 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Vectorized mutual nearest neighbour matching of local descriptors with Lowe's ratio test.
+# The query is matched with many reference descriptor sets in one batched similarity computation (instead of one
+# learned matcher pass per reference image). The descriptors are expected to be L2-normalized (SuperPoint, DISK, ALIKED,
+# RootSIFT), so the similarity is the dot product and the squared distance is 2 - 2 * similarity.
+
+import torch
+
+
+kDefaultRatioThreshold = 0.8 # the nearest neighbour must be closer than this ratio times the second nearest one
+kMaxSimilarityElements = 1 << 22 # maximum number of elements of one batched similarity matrix (16 MB in float32, cache friendly)
+
+
+# Matches the query descriptors (D, N) with each reference descriptor set (list of (D, M_i) tensors, on the same device).
+# Returns for each reference set the matches (N,) with the index of the matched reference descriptor or -1,
+# and the similarities (N,) of the matches (0 where unmatched).
+def mutual_nn_match_batch(query_descriptors: torch.Tensor, ref_descriptors, ratio_threshold=kDefaultRatioThreshold,
+        max_elements=kMaxSimilarityElements):
+    num_query = query_descriptors.shape[1]
+    if num_query == 0:
+        empty = query_descriptors.new_zeros((0,))
+        return [(empty.long(), empty) for _ in ref_descriptors]
+    results = []
+    start = 0
+    while start < len(ref_descriptors):
+        # group the reference sets so that the padded similarity matrix of the group stays below max_elements
+        end = start + 1
+        max_size = ref_descriptors[start].shape[1]
+        while end < len(ref_descriptors):
+            size = max(max_size, ref_descriptors[end].shape[1])
+            if num_query * size * (end + 1 - start) > max_elements:
+                break
+            max_size = size
+            end += 1
+        results += mutual_nn_match_group(query_descriptors, ref_descriptors[start:end], ratio_threshold)
+        start = end
+    return results
+
+
+def mutual_nn_match_group(query_descriptors: torch.Tensor, ref_descriptors, ratio_threshold):
+    dim, num_query = query_descriptors.shape
+    # NOTE: at least two columns, so that the second nearest neighbour exists (the padding never passes the checks)
+    max_size = max([d.shape[1] for d in ref_descriptors] + [2])
+    padded = query_descriptors.new_zeros((len(ref_descriptors), dim, max_size))
+    for i, d in enumerate(ref_descriptors):
+        padded[i, :, :d.shape[1]] = d
+
+    sim = torch.matmul(query_descriptors.T[None], padded)
+    for i, d in enumerate(ref_descriptors):
+        sim[i, :, d.shape[1]:] = -2.0 # below any similarity of unit vectors
+    top_sim, top_idx = sim.topk(2, dim=2)
+    nn_sim, nn_idx = top_sim[..., 0], top_idx[..., 0]
+
+    # ratio test on the distances: |q - r|^2 = 2 - 2 * sim
+    dist_sq = (2.0 - 2.0 * top_sim).clamp(min=0.0)
+    mask = dist_sq[..., 0] <= (ratio_threshold ** 2) * dist_sq[..., 1]
+    # mutual check: the match is also most similar to this query descriptor
+    # NOTE: compared by value, the maximum over the queries is much faster than the argmax along the strided dimension
+    mask &= nn_sim >= sim.amax(dim=1).gather(1, nn_idx)
+    mask &= nn_sim > -2.0
+
+    matches = torch.where(mask, nn_idx, torch.full_like(nn_idx, -1))
+    scores = torch.where(mask, nn_sim, torch.zeros_like(nn_sim))
+    return [(matches[i], scores[i]) for i in range(len(ref_descriptors))]
@@ -9,6 +9,8 @@
 
 import math
 
+import numpy as np
+
 a = 6378137.0000 # Earth radius in meters
 b = 6356752.3142 # Earth semiminor in meters
 f = (a - b) / a
@@ -131,3 +133,98 @@ def geodetic_to_enu(lat, lon, h, lat_ref, lon_ref, h_ref):
 def enu_to_geodetic(xEast, yNorth, zUp, lat_ref, lon_ref, h_ref):
     x, y, z = enu_to_ecef(xEast, yNorth, zUp, lat_ref, lon_ref, h_ref)
     return ecef_to_geodetic(x, y, z)
+
+
+# Vectorized versions of the conversions above. They accept arrays of N points (or scalars) and return arrays,
+# so batches of poses or point clouds are converted without a Python loop.
+
+# lat, lon in degrees, h in meters. Returns an array of shape (..., 3)
+def geodetic_to_ecef_array(lat, lon, h):
+    lamb = np.radians(np.asarray(lat, dtype=np.float64))
+    phi = np.radians(np.asarray(lon, dtype=np.float64))
+    h = np.asarray(h, dtype=np.float64)
+
+    sin_lambda = np.sin(lamb)
+    cos_lambda = np.cos(lamb)
+    nu = a / np.sqrt(1 - e_sq * sin_lambda * sin_lambda)
+
+    x = (h + nu) * cos_lambda * np.cos(phi)
+    y = (h + nu) * cos_lambda * np.sin(phi)
+    z = (h + (1 - e_sq) * nu) * sin_lambda
+    return np.stack(np.broadcast_arrays(x, y, z), axis=-1)
+
+
+# ecef is an array of shape (..., 3). Returns the arrays lat, lon (degrees) and h (meters)
+def ecef_to_geodetic_array(ecef):
+    ecef = np.asarray(ecef, dtype=np.float64)
+    x = ecef[..., 0]
+    y = ecef[..., 1]
+    z = ecef[..., 2]
+
+    e1_sq = 2 * f - f * f
+    e2_sq = e1_sq / (1 - e1_sq)
+    p = np.sqrt(x*x + y*y)
+    R = np.sqrt(p*p + z*z)
+
+    # parametric latitude (Bowring eqn.17), with atan2 so that the points on the minor axis are handled too
+    beta = np.arctan2(b * z * (1 + e2_sq * b / R), a * p)
+    sinBeta = np.sin(beta)
+    cosBeta = np.cos(beta)
+
+    # geodetic latitude (Bowring eqn.18)
+    latRad = np.arctan2(z + e2_sq * b * sinBeta * sinBeta * sinBeta, p - e1_sq * a * cosBeta * cosBeta * cosBeta)
+    lonRad = np.arctan2(y, x)
+
+    # height above ellipsoid (Bowring eqn.7)
+    sinLat = np.sin(latRad)
+    cosLat = np.cos(latRad)
+    nu = a / np.sqrt(1 - e1_sq * sinLat * sinLat)
+    height = p * cosLat + z * sinLat - (a * a / nu)
+
+    return np.degrees(latRad), np.degrees(lonRad), height
+
+
+# East-North-Up frame tangent to the ellipsoid at a reference point.
+# The ECEF origin and the rotation are computed once, so each conversion is a single matrix product.
+class LocalTangentFrame:
+
+    def __init__(self, lat0, lon0, h0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.h0 = h0
+
+        lamb = math.radians(lat0)
+        phi = math.radians(lon0)
+        sin_lambda = math.sin(lamb)
+        cos_lambda = math.cos(lamb)
+        sin_phi = math.sin(phi)
+        cos_phi = math.cos(phi)
+
+        self.origin_ecef = geodetic_to_ecef_array(lat0, lon0, h0)
+        # rows are the East, North and Up axes in ECEF coordinates
+        self.ecef_to_enu_rotation = np.array([
+            [-sin_phi, cos_phi, 0.0],
+            [-sin_lambda * cos_phi, -sin_lambda * sin_phi, cos_lambda],
+            [cos_lambda * cos_phi, cos_lambda * sin_phi, sin_lambda]])
+        self.enu_to_ecef_rotation = self.ecef_to_enu_rotation.T
+
+    # 4x4 rigid transform from ENU to ECEF coordinates
+    def enu_to_ecef_transform(self):
+        transform = np.eye(4)
+        transform[:3,:3] = self.enu_to_ecef_rotation
+        transform[:3,3] = self.origin_ecef
+        return transform
+
+    # enu is an array of shape (..., 3). Returns an array of the same shape
+    def enu_to_ecef(self, enu):
+        return np.matmul(np.asarray(enu, dtype=np.float64), self.ecef_to_enu_rotation) + self.origin_ecef
+
+    def ecef_to_enu(self, ecef):
+        return np.matmul(np.asarray(ecef, dtype=np.float64) - self.origin_ecef, self.enu_to_ecef_rotation)
+
+    def geodetic_to_enu(self, lat, lon, h):
+        return self.ecef_to_enu(geodetic_to_ecef_array(lat, lon, h))
+
+    # Returns the arrays lat, lon (degrees) and h (meters)
+    def enu_to_geodetic(self, enu):
+        return ecef_to_geodetic_array(self.enu_to_ecef(enu))
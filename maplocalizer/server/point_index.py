@@ -0,0 +1,238 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Descriptor index of the 3D points of a map for the direct 2D-3D matching.
+# Each 3D point gets one descriptor, the normalized mean of the descriptors of its observations in features.h5,
+# so the query keypoints can be matched with the 3D points directly instead of with the keypoints of whole map images
+# (most of which have no 3D point). The points are assigned to visual words (spherical k-means of the point descriptors),
+# and a query keypoint is only compared with the points of its nearest words.
+# Building the index reads all map features, so it is cached next to the map (point_index.h5) and rebuilt if the map changes.
+
+import json
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from log_utils import get_logger
+
+logger = get_logger("point_index")
+
+
+kPointIndexVersion = 1 # increase if the index format or the aggregation changes
+kDefaultNumWords = 256 # number of visual words
+kDefaultNumAssignedWords = 3 # number of nearest words of a query keypoint whose points are searched
+kDefaultRatioThreshold = 0.8 # the nearest point must be closer than this ratio times the second nearest one
+kKMeansIterations = 10
+kKMeansMaxSamples = 100000 # maximum number of point descriptors used to train the vocabulary
+kChunkSize = 65536 # number of descriptors per matrix product when assigning the words
+
+
+class PointIndex:
+
+    # point_ids (P,) 3D point ids, descriptors (P, D) normalized float16 descriptors, vocabulary (W, D) normalized word centres,
+    # words (P,) word of each point, image_ids (I,) and image_offsets (I+1,) and image_rows: the rows of the points observed
+    # by image_ids[i] are image_rows[image_offsets[i]:image_offsets[i+1]]
+    def __init__(self, point_ids, descriptors, vocabulary, words, image_ids, image_offsets, image_rows):
+        self.point_ids = point_ids
+        self.descriptors = descriptors
+        self.vocabulary = vocabulary
+        self.words = words
+        self.image_ids = image_ids
+        self.image_offsets = image_offsets
+        self.image_rows = image_rows
+        self.image_idxs = {int(image_id): i for i, image_id in enumerate(image_ids)}
+
+    def __len__(self):
+        return len(self.point_ids)
+
+    # Returns the rows of the points observed by the given images (sorted, without duplicates)
+    def rows_of_images(self, image_ids):
+        rows = [self.image_rows[self.image_offsets[i]:self.image_offsets[i + 1]] for i in
+            (self.image_idxs[image_id] for image_id in image_ids if image_id in self.image_idxs)]
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+    # Matches the query descriptors (D, N) with the points in the given rows. Each query keypoint is compared with the points
+    # of its num_assigned_words nearest words, and matched to the most similar one if it passes the ratio test.
+    # Each point is matched with at most one keypoint (the most similar).
+    # Returns the keypoint indices, the 3D point ids and the similarities of the matches.
+    def match(self, query_descriptors, rows, num_assigned_words=kDefaultNumAssignedWords, ratio_threshold=kDefaultRatioThreshold):
+        query = np.ascontiguousarray(np.asarray(query_descriptors, dtype=np.float32).T)
+        num_query = len(query)
+        if num_query == 0 or len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        # nearest words of the query keypoints
+        num_assigned_words = min(num_assigned_words, len(self.vocabulary))
+        word_sim = query @ self.vocabulary.T
+        query_words = np.argpartition(-word_sim, num_assigned_words - 1, axis=1)[:, :num_assigned_words]
+
+        # best and second best similarity of each keypoint over the points of its words
+        best_sim = np.full(num_query, -2.0, dtype=np.float32)
+        second_sim = np.full(num_query, -2.0, dtype=np.float32)
+        best_row = np.full(num_query, -1, dtype=np.int64)
+        row_words = self.words[rows]
+        order = np.argsort(row_words, kind="stable")
+        word_starts = np.searchsorted(row_words[order], np.arange(len(self.vocabulary) + 1))
+        query_idxs = np.repeat(np.arange(num_query), num_assigned_words)
+        assigned_words = query_words.reshape(-1)
+        for word in np.unique(assigned_words):
+            word_rows = rows[order[word_starts[word]:word_starts[word + 1]]]
+            if len(word_rows) == 0:
+                continue
+            word_query_idxs = query_idxs[assigned_words == word]
+            sim = query[word_query_idxs] @ self.descriptors[word_rows].astype(np.float32).T
+            nearest = np.argmax(sim, axis=1)
+            sim1 = sim[np.arange(len(sim)), nearest]
+            if sim.shape[1] > 1:
+                sim[np.arange(len(sim)), nearest] = -2.0
+                sim2 = sim.max(axis=1)
+            else:
+                sim2 = np.full(len(sim), -2.0, dtype=np.float32)
+            # merge with the best two of the other words
+            b1, b2 = best_sim[word_query_idxs], second_sim[word_query_idxs]
+            second_sim[word_query_idxs] = np.maximum(np.minimum(b1, sim1), np.maximum(b2, sim2))
+            better = sim1 > b1
+            best_sim[word_query_idxs] = np.where(better, sim1, b1)
+            best_row[word_query_idxs] = np.where(better, word_rows[nearest], best_row[word_query_idxs])
+
+        # ratio test on the distances of the unit vectors: |q - p|^2 = 2 - 2 * sim
+        dist1 = np.maximum(2.0 - 2.0 * best_sim, 0.0)
+        dist2 = np.maximum(2.0 - 2.0 * second_sim, 0.0)
+        keypoint_idxs = np.where((best_row >= 0) & (dist1 <= (ratio_threshold ** 2) * dist2))[0]
+
+        # one keypoint per point, the most similar
+        keypoint_idxs = keypoint_idxs[np.argsort(-best_sim[keypoint_idxs], kind="stable")]
+        _, first = np.unique(best_row[keypoint_idxs], return_index=True)
+        keypoint_idxs = np.sort(keypoint_idxs[first])
+        return keypoint_idxs, self.point_ids[best_row[keypoint_idxs]], best_sim[keypoint_idxs]
+
+
+# Returns the signature of the map that the cached index must match
+def index_signature(reconstruction, features_path: Path, num_words):
+    stat = features_path.stat()
+    return json.dumps({
+        "version": kPointIndexVersion,
+        "num_points": reconstruction.num_points3D(),
+        "num_images": reconstruction.num_images(),
+        "features_size": stat.st_size,
+        "features_mtime": stat.st_mtime,
+        "num_words": num_words,
+    }, sort_keys=True)
+
+
+# Loads the cached index of the map, or builds it from the reconstruction and the map features and caches it.
+# features is the open features.h5 of the map. If the cache cannot be written, the index is only kept in memory.
+def load_or_build_point_index(reconstruction, features, features_path: Path, cache_path: Path, num_words=kDefaultNumWords, seed=0):
+    signature = index_signature(reconstruction, features_path, num_words)
+    if cache_path.exists():
+        try:
+            index = load_point_index(cache_path, signature)
+            if index is not None:
+                logger.info("Loaded the descriptor index of %d points from %s", len(index), cache_path)
+                return index
+            logger.info("The descriptor index in %s is outdated, rebuilding it", cache_path)
+        except Exception:
+            logger.exception("Could not read the descriptor index from %s, rebuilding it", cache_path)
+
+    index = build_point_index(reconstruction, features, num_words, seed)
+    try:
+        save_point_index(index, cache_path, signature)
+        logger.info("Descriptor index written to %s", cache_path)
+    except OSError as e:
+        logger.warning("Could not write the descriptor index to %s: %s", cache_path, e)
+    return index
+
+
+def load_point_index(path: Path, signature):
+    with h5py.File(path, "r") as f:
+        if f.attrs.get("signature") != signature:
+            return None
+        return PointIndex(*(f[k][()] for k in ("point_ids", "descriptors", "vocabulary", "words", "image_ids", "image_offsets", "image_rows")))
+
+
+def save_point_index(index: PointIndex, path: Path, signature):
+    # NOTE: written to a temporary file first, so that concurrent loads never see a partial index
+    tmp_path = path.with_suffix(".tmp")
+    with h5py.File(tmp_path, "w") as f:
+        for k in ("point_ids", "descriptors", "vocabulary", "words", "image_ids", "image_offsets", "image_rows"):
+            f.create_dataset(k, data=getattr(index, k))
+        f.attrs["signature"] = signature
+    tmp_path.replace(path)
+
+
+# Aggregates the descriptors of the observations of each 3D point and builds the visual words
+def build_point_index(reconstruction, features, num_words=kDefaultNumWords, seed=0):
+    logger.info("Building the descriptor index of %d points...", reconstruction.num_points3D())
+    point_ids = np.array(sorted(reconstruction.points3D.keys()), dtype=np.int64)
+    sums = None
+    counts = np.zeros(len(point_ids), dtype=np.int64)
+    image_ids, image_offsets, image_rows = [], [0], []
+    for image_id, image in reconstruction.images.items():
+        idxs, ids = [], []
+        for i, p in enumerate(image.points2D):
+            if p.has_point3D():
+                idxs.append(i)
+                ids.append(p.point3D_id)
+        image_ids.append(image_id)
+        if len(idxs) == 0 or image.name not in features:
+            image_offsets.append(len(image_rows))
+            continue
+        rows = np.searchsorted(point_ids, np.array(ids, dtype=np.int64))
+        descriptors = features[image.name]["descriptors"].__array__()[:, idxs].T.astype(np.float32)
+        descriptors /= np.maximum(np.linalg.norm(descriptors, axis=1, keepdims=True), 1e-12)
+        if sums is None:
+            sums = np.zeros((len(point_ids), descriptors.shape[1]), dtype=np.float32)
+        np.add.at(sums, rows, descriptors)
+        np.add.at(counts, rows, 1)
+        image_rows.extend(rows.tolist())
+        image_offsets.append(len(image_rows))
+    if sums is None:
+        raise ValueError("none of the 3D points has features in features.h5")
+
+    # NOTE: the points without observations in features.h5 are dropped
+    observed = counts > 0
+    old_to_new = np.cumsum(observed) - 1
+    point_ids = point_ids[observed]
+    descriptors = sums[observed]
+    descriptors /= np.maximum(np.linalg.norm(descriptors, axis=1, keepdims=True), 1e-12)
+    image_rows = np.array(image_rows, dtype=np.int64)
+    image_rows = old_to_new[image_rows] # all rows of the images are observed
+
+    vocabulary = train_vocabulary(descriptors, min(num_words, len(descriptors)), seed)
+    words = assign_words(descriptors, vocabulary)
+    logger.info("Descriptor index: %d points, %d words, %.1f MB", len(point_ids), len(vocabulary), descriptors.size * 2 / (1024.0 * 1024.0))
+    return PointIndex(point_ids, descriptors.astype(np.float16), vocabulary, words,
+        np.array(image_ids, dtype=np.int64), np.array(image_offsets, dtype=np.int64), image_rows)
+
+
+# Spherical k-means of the (normalized) descriptors, returns the normalized word centres (W, D)
+def train_vocabulary(descriptors, num_words, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = descriptors
+    if len(samples) > kKMeansMaxSamples:
+        samples = samples[rng.choice(len(samples), kKMeansMaxSamples, replace=False)]
+    vocabulary = samples[rng.choice(len(samples), num_words, replace=False)].copy()
+    for _ in range(kKMeansIterations):
+        words = assign_words(samples, vocabulary)
+        sums = np.zeros_like(vocabulary)
+        np.add.at(sums, words, samples)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # NOTE: the empty words keep their centres
+        vocabulary = np.where(norms > 1e-12, sums / np.maximum(norms, 1e-12), vocabulary)
+    return vocabulary.astype(np.float32)
+
+
+def assign_words(descriptors, vocabulary):
+    words = np.empty(len(descriptors), dtype=np.int64)
+    for start in range(0, len(descriptors), kChunkSize):
+        chunk = descriptors[start:start + kChunkSize].astype(np.float32)
+        words[start:start + kChunkSize] = np.argmax(chunk @ vocabulary.T, axis=1)
+    return words
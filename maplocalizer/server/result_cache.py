@@ -0,0 +1,105 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Short-lived cache of the localization results, keyed by the content of the query.
+# Mobile clients retry on timeout and AR apps sometimes send the same frame again. The results of identical queries
+# (same decoded image, map, camera parameters and options) are kept for a short time, and concurrent identical queries
+# wait for the one localization in flight instead of running the pipeline again (coalescing).
+# NOTE: the cache lives in the event loop of the server, so it is not thread-safe.
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+kDefaultResultCacheSize = 256 # maximum number of cached results
+
+
+# Returns a fast hash of the decoded image and the other parts of the query (converted to strings)
+def query_key(image: np.ndarray, *parts):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((image.shape, image.dtype.str)).encode())
+    h.update(np.ascontiguousarray(image).data)
+    for part in parts:
+        h.update(b"\0" + str(part).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+
+    # ttl in seconds
+    def __init__(self, ttl, max_size=kDefaultResultCacheSize):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict() # key -> (expiry time, result)
+        self.pending = {} # key -> future of the localization in flight
+        self.generation = 0 # increased by clear()
+
+    # Returns the cached result or None, and whether it was found
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+        expiry, result = entry
+        if time.monotonic() > expiry:
+            del self.entries[key]
+            return None, False
+        return result, True
+
+    def put(self, key, result):
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    # Drops all cached results, e.g. when a map or its transform changes.
+    # The localizations in flight still answer their waiting queries, but their results are not cached.
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+    # Returns the cached result or waits for the identical localization in flight.
+    # Returns the result and how it was obtained ("hit" or "coalesced"), or (None, None) if the query must be localized.
+    async def lookup(self, key):
+        result, found = self.get(key)
+        if found:
+            return result, "hit"
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key]), "coalesced"
+        return None, None
+
+    # Localizes the query with the coroutine function compute and caches the result.
+    # The identical queries that arrive meanwhile wait for this result (or exception) in lookup().
+    # If an identical localization is already in flight, its result is awaited instead.
+    async def compute(self, key, compute):
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        future = asyncio.get_running_loop().create_future()
+        # NOTE: mark the exception as retrieved, because often nobody waits for it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.pending[key] = future
+        generation = self.generation
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            # NOTE: only the call that created the pending entry removes it
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if generation == self.generation:
+            self.put(key, result)
+        future.set_result(result)
+        return result
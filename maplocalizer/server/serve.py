@@ -0,0 +1,142 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Pre-fork multi-worker server.
+# The parent process loads the maps and the models once, then forks the uvicorn workers, which all accept the connections
+# of the same listening socket. The reconstructions, the global descriptors and the network weights are shared by the
+# workers copy-on-write, so N workers need about the memory of one, and a restarted worker is ready immediately.
+# The objects of the parent are frozen out of the garbage collector before forking (gc.freeze), otherwise the collections
+# in the workers would write into (and thereby copy) the shared pages. The HDF5 file of the map features is closed before
+# and reopened after the fork, because HDF5 handles must not be shared across processes.
+# The parent runs torch single-threaded, and each worker sets its number of threads after the fork: a worker forked after
+# the parent used the intra-op thread pool inherits a broken pool and deadlocks in its first parallel operation.
+# Therefore the maps served by serve.py must not set inference_threads or inference_interop_threads in their config.
+#
+# NOTE: CPU only. CUDA cannot be used in a forked process once it was initialized in the parent,
+# so on GPUs run one server per GPU with `fastapi run` instead.
+# NOTE: the maps are loaded at startup. /load_map and /unload_map only change the worker that receives them,
+# and the admission control, the result cache, the tracking sessions and the metrics are per worker.
+#
+# Example usage (from the maplocalizer folder, like `fastapi run`)
+# python server/serve.py --maps <map_id1>,<map_id2> --workers 4 --port 8000
+
+import argparse
+import gc
+import os
+import signal
+import time
+
+# NOTE: the GPUs are hidden before torch is imported, so that neither the parent nor the workers initialize CUDA
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import torch
+import uvicorn
+
+import main
+from log_utils import get_logger
+
+logger = get_logger("serve")
+
+
+def run_worker(config: uvicorn.Config, sock, torch_threads):
+    main.reinit_after_fork()
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(config: uvicorn.Config, sock, torch_threads):
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_worker(config, sock, torch_threads)
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    logger.info("Started worker %d", pid)
+    return pid
+
+
+def serve(args):
+    # NOTE: single-threaded in the parent, so that no intra-op thread pool exists at the fork (see above)
+    torch.set_num_threads(1)
+
+    # Load the maps and the models once in the parent
+    for mapId in [m for m in args.maps.split(",") if m != ""]:
+        result, statusCode = main.load_map_by_id(mapId, enableBatching=False)
+        if statusCode != 200:
+            logger.error("Could not load map %s: %s", mapId, result)
+            exit(-1)
+        if torch.get_num_threads() != 1:
+            logger.warning("The config of map %s sets inference_threads, which must not be used with serve.py (the workers may deadlock). "
+                "Use --torch_threads instead.", mapId)
+            torch.set_num_threads(1)
+    for localizer in main.localizers.values():
+        if isinstance(localizer, main.HlocLocalizer):
+            localizer.close_map_files()
+
+    config = uvicorn.Config(main.app, host=args.host, port=args.port, proxy_headers=args.proxy_headers,
+        forwarded_allow_ips=args.forwarded_allow_ips, log_config=None)
+    sock = config.bind_socket()
+    sock.set_inheritable(True)
+
+    torch_threads = args.torch_threads
+    if torch_threads is None:
+        torch_threads = max((os.cpu_count() or 1) // args.workers, 1)
+
+    # NOTE: the objects of the parent are moved to the permanent generation, which the collections of the workers do not visit
+    gc.collect()
+    gc.freeze()
+
+    workers = {spawn_worker(config, sock, torch_threads) for _ in range(args.workers)}
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Restart the workers that exit unexpectedly
+    while len(workers) > 0:
+        try:
+            pid, waitStatus = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if stopping:
+            continue
+        logger.warning("Worker %d exited with status %d, restarting", pid, os.waitstatus_to_exitcode(waitStatus))
+        time.sleep(args.restart_delay)
+        workers.add(spawn_worker(config, sock, torch_threads))
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-fork multi-worker OpenVPS MapLocalizer (CPU only)")
+    parser.add_argument("--maps", type=str, required=True, help="ids of the maps to load, separated by commas (the last one is the current map)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--torch_threads", type=int, default=None, help="intra-op threads of each worker (default: CPU cores / workers)")
+    parser.add_argument("--proxy_headers", action="store_true")
+    parser.add_argument("--forwarded_allow_ips", type=str, default=None)
+    parser.add_argument("--restart_delay", type=float, default=1.0, help="seconds before a crashed worker is restarted")
+    serve(parser.parse_args())
@@ -0,0 +1,302 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+# This script benchmarks the localizer on a synthetic map with stub models, so it runs on plain CPUs without model weights.
+# It generates a synthetic scene (3D points on the walls of a room and cameras inside), writes the map as a Colmap text model
+# with features.h5 and global_features.h5 like the MapBuilder does, and synthetic query images with known poses.
+# The stub extractors look up the precomputed features of the query images and the stub matcher is a mutual nearest neighbor
+# matcher, so the rest of the pipeline (HDF5 reads, retrieval, correspondences, clustering, PnP, geo-conversion) runs as usual.
+#
+# Example usage
+# python server/synthetic_benchmark.py --num_map_images 100 --num_queries 50 --concurrency 2 --output synthetic.json
+
+import argparse
+import hashlib
+import json
+import tempfile
+from pathlib import Path
+
+import cv2
+import h5py
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation
+
+from benchmark import run_benchmark, print_report, kDefaultThresholds
+from benchmark_utils import Query
+from hloc_localizer import HlocLocalizer
+from log_utils import setup_logging
+from oscp.geoposeprotocol import CameraModel, CameraParameters
+
+
+kImageWidth = 640
+kImageHeight = 480
+kFocalLength = 500.0
+kRoomSize = (30.0, 20.0, 4.0) # meters, the points lie on the walls, the floor and the ceiling
+kMaxViewDistance = 25.0
+kKeypointNoise = 0.5 # pixels
+kDescriptorNoise = 0.2 # relative to the unit descriptors
+
+kStubPreprocessing = {"grayscale": True, "resize_max": None}
+
+
+# Looks up precomputed predictions by the content of the preprocessed image
+def image_key(image: np.ndarray):
+    return hashlib.sha1(np.ascontiguousarray(image, dtype=np.float32).tobytes()).hexdigest()
+
+
+# Stub of a local feature extractor. Returns the precomputed keypoints, scores and descriptors of the registered images.
+class StubLocalExtractor:
+
+    def __init__(self):
+        self.predictions = {}
+
+    def register(self, image_data, keypoints, descriptors):
+        self.predictions[image_key(image_data)] = {
+            "keypoints": torch.from_numpy(keypoints.astype(np.float32)),
+            "scores": torch.ones(len(keypoints)),
+            "descriptors": torch.from_numpy(descriptors.astype(np.float32)),
+        }
+
+    def __call__(self, data):
+        preds = [self.predictions[image_key(image.numpy())] for image in data["image"].cpu()]
+        return {k: torch.stack([p[k] for p in preds]) for k in preds[0]}
+
+
+# Stub of a global feature extractor (retrieval). Returns the precomputed global descriptors of the registered images.
+class StubGlobalExtractor:
+
+    def __init__(self):
+        self.descriptors = {}
+
+    def register(self, image_data, global_descriptor):
+        self.descriptors[image_key(image_data)] = torch.from_numpy(global_descriptor.astype(np.float32))
+
+    def __call__(self, data):
+        return {"global_descriptor": torch.stack([self.descriptors[image_key(image.numpy())] for image in data["image"].cpu()])}
+
+
+# Mutual nearest neighbor matcher with the same interface as the hloc matchers
+class StubMatcher:
+
+    def __init__(self, min_score=0.8):
+        self.min_score = min_score
+
+    def __call__(self, data):
+        sim = torch.einsum("bdn,bdm->bnm", data["descriptors0"], data["descriptors1"])
+        scores0, matches0 = sim.max(2)
+        matches1 = sim.max(1).indices
+        mutual = torch.gather(matches1, 1, matches0) == torch.arange(matches0.shape[1], device=matches0.device)[None]
+        valid = mutual & (scores0 > self.min_score)
+        return {
+            "matches0": torch.where(valid, matches0, torch.full_like(matches0, -1)),
+            "matching_scores0": torch.where(valid, scores0, torch.zeros_like(scores0)),
+        }
+
+
+# NOTE: the stub models are created with the localizer, so that the query images can be registered before the map is loaded
+class StubHlocLocalizer(HlocLocalizer):
+
+    def __init__(self, debug=False, map_id=""):
+        super().__init__(debug, map_id)
+        self.feature_extractor = StubLocalExtractor()
+        self.global_feature_extractor = StubGlobalExtractor()
+        self.matcher = StubMatcher()
+
+    def load_models(self, config):
+        self.device = "cpu"
+        self.feature_conf = {"model": {"name": "stub"}, "preprocessing": kStubPreprocessing}
+        self.matcher_conf = {"model": {"name": "stub"}}
+        self.retrieval_conf = {"model": {"name": "stub"}, "preprocessing": kStubPreprocessing}
+
+    # NOTE: the stub extractors look up the predictions by the content of the full resolution image,
+    # so the image size limit of the profiles is ignored
+    def preprocessing_conf(self, conf, profile=None):
+        return super().preprocessing_conf(conf)
+
+
+class SyntheticScene:
+
+    def __init__(self, num_points, descriptor_dim, rng: np.random.Generator):
+        self.rng = rng
+        # sample the points on the 6 faces of the room, proportionally to their area
+        sx, sy, sz = kRoomSize
+        areas = np.array([sy*sz, sy*sz, sx*sz, sx*sz, sx*sy, sx*sy])
+        faces = rng.choice(6, size=num_points, p=areas / areas.sum())
+        points = rng.uniform(0, 1, size=(num_points, 3)) * np.array(kRoomSize)
+        for face, (axis, value) in enumerate([(0, 0), (0, sx), (1, 0), (1, sy), (2, 0), (2, sz)]):
+            points[faces == face, axis] = value
+        self.points3D = points
+        descriptors = rng.normal(size=(num_points, descriptor_dim))
+        self.descriptors = descriptors / np.linalg.norm(descriptors, axis=1, keepdims=True)
+        self.camera_parameters = CameraParameters(model=CameraModel.PINHOLE,
+            modelParams=[kFocalLength, kFocalLength, kImageWidth / 2.0, kImageHeight / 2.0])
+
+    # Random camera-to-world pose inside the room, looking roughly horizontally
+    def random_pose(self):
+        center = self.rng.uniform(0.2, 0.8, size=3) * np.array(kRoomSize)
+        center[2] = self.rng.uniform(1.2, 2.0)
+        yaw = self.rng.uniform(0, 2 * np.pi)
+        pitch = self.rng.uniform(-0.2, 0.2)
+        forward = np.array([np.cos(yaw) * np.cos(pitch), np.sin(yaw) * np.cos(pitch), np.sin(pitch)])
+        right = np.cross(forward, [0, 0, 1])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        pose_c2w = np.eye(4)
+        pose_c2w[:3,:3] = np.stack([right, down, forward], axis=1)
+        pose_c2w[:3,3] = center
+        return pose_c2w
+
+    # Projects the points into the camera and returns the ids of the visible points and their Colmap image coordinates
+    def observe(self, pose_c2w):
+        pose_w2c = np.linalg.inv(pose_c2w)
+        points_cam = np.matmul(self.points3D, pose_w2c[:3,:3].T) + pose_w2c[:3,3]
+        z = points_cam[:,2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u = kFocalLength * points_cam[:,0] / z + kImageWidth / 2.0
+            v = kFocalLength * points_cam[:,1] / z + kImageHeight / 2.0
+        visible = (z > 0.5) & (z < kMaxViewDistance) & (u >= 0) & (u < kImageWidth) & (v >= 0) & (v < kImageHeight)
+        ids = np.where(visible)[0]
+        return ids, np.stack([u[ids], v[ids]], axis=1)
+
+    # Synthetic features of a view: noisy observations of the visible points, filled up with random distractors.
+    # Returns the keypoints (hloc coordinates), descriptors (DxN), the point ids (-1 for distractors) and the global descriptor.
+    def features(self, pose_c2w, num_keypoints):
+        ids, uv = self.observe(pose_c2w)
+        if len(ids) > num_keypoints:
+            keep = self.rng.choice(len(ids), size=num_keypoints, replace=False)
+            ids, uv = ids[keep], uv[keep]
+        num_distractors = num_keypoints - len(ids)
+        uv = uv + self.rng.normal(scale=kKeypointNoise, size=uv.shape)
+        uv = np.concatenate([uv, self.rng.uniform(0, 1, size=(num_distractors, 2)) * [kImageWidth, kImageHeight]])
+        descriptor_dim = self.descriptors.shape[1]
+        noise = self.rng.normal(scale=kDescriptorNoise / np.sqrt(descriptor_dim), size=(len(ids), descriptor_dim))
+        descriptors = np.concatenate([self.descriptors[ids] + noise, self.rng.normal(size=(num_distractors, descriptor_dim))])
+        descriptors /= np.linalg.norm(descriptors, axis=1, keepdims=True)
+        point_ids = np.concatenate([ids, -np.ones(num_distractors, dtype=np.int64)])
+
+        global_descriptor = self.descriptors[ids].sum(axis=0) if len(ids) > 0 else np.zeros(self.descriptors.shape[1])
+        global_descriptor /= max(np.linalg.norm(global_descriptor), 1e-6)
+        # NOTE: hloc keypoints are 0.5 pixel off from the Colmap convention
+        return uv - 0.5, descriptors.T, point_ids, global_descriptor
+
+
+def write_colmap_text_model(model_dir: Path, scene: SyntheticScene, map_views):
+    model_dir.mkdir(parents=True, exist_ok=True)
+    fx, fy, cx, cy = scene.camera_parameters.modelParams
+    with open(model_dir / "cameras.txt", "w") as f:
+        f.write(f"1 PINHOLE {kImageWidth} {kImageHeight} {fx} {fy} {cx} {cy}\n")
+
+    tracks = {}
+    with open(model_dir / "images.txt", "w") as f:
+        for image_id, (name, pose_c2w, keypoints, point_ids) in enumerate(map_views, start=1):
+            pose_w2c = np.linalg.inv(pose_c2w)
+            qx, qy, qz, qw = Rotation.from_matrix(pose_w2c[:3,:3]).as_quat()
+            tx, ty, tz = pose_w2c[:3,3]
+            f.write(f"{image_id} {qw} {qx} {qy} {qz} {tx} {ty} {tz} 1 {name}\n")
+            points2D = []
+            for idx, ((u, v), point_id) in enumerate(zip(keypoints + 0.5, point_ids)):
+                point3D_id = int(point_id) + 1 if point_id >= 0 else -1
+                points2D.append(f"{u} {v} {point3D_id}")
+                if point3D_id > 0:
+                    tracks.setdefault(point3D_id, []).append((image_id, idx))
+            f.write(" ".join(points2D) + "\n")
+
+    with open(model_dir / "points3D.txt", "w") as f:
+        for point3D_id, track in tracks.items():
+            x, y, z = scene.points3D[point3D_id - 1]
+            track_str = " ".join(f"{image_id} {idx}" for image_id, idx in track)
+            f.write(f"{point3D_id} {x} {y} {z} 128 128 128 0.5 {track_str}\n")
+
+
+# Generates the synthetic map into output_dir and returns the map config, the transform path and the queries
+def generate_synthetic_dataset(output_dir: Path, localizer: StubHlocLocalizer, num_map_images=100, num_queries=50,
+        num_points=20000, num_keypoints=1024, descriptor_dim=128, seed=0):
+    rng = np.random.default_rng(seed)
+    scene = SyntheticScene(num_points, descriptor_dim, rng)
+    reconstruction_path = output_dir / "reconstruction"
+    query_images_path = output_dir / "queries"
+    reconstruction_path.mkdir(parents=True, exist_ok=True)
+    query_images_path.mkdir(parents=True, exist_ok=True)
+
+    # NOTE: the localizer reads the features from the reconstruction folder, like in the maps of the MapBuilder
+    map_views = []
+    with h5py.File(reconstruction_path / "features.h5", "w") as features_file, h5py.File(reconstruction_path / "global_features.h5", "w") as global_file:
+        for i in range(num_map_images):
+            name = f"map_{i:05d}.png"
+            pose_c2w = scene.random_pose()
+            keypoints, descriptors, point_ids, global_descriptor = scene.features(pose_c2w, num_keypoints)
+            grp = features_file.create_group(name)
+            grp.create_dataset("keypoints", data=keypoints.astype(np.float32))
+            grp.create_dataset("descriptors", data=descriptors.astype(np.float16))
+            grp.create_dataset("scores", data=np.ones(num_keypoints, dtype=np.float16))
+            grp.create_dataset("image_size", data=np.array([kImageWidth, kImageHeight]))
+            global_file.create_group(name).create_dataset("global_descriptor", data=global_descriptor.astype(np.float16))
+            map_views.append((name, pose_c2w, keypoints, point_ids))
+    write_colmap_text_model(reconstruction_path, scene, map_views)
+
+    transform_path = output_dir / "transform.json"
+    with open(transform_path, "w") as f:
+        json.dump({"matrix": np.eye(4).tolist(), "latitude": 60.17, "longitude": 24.94, "height": 10.0}, f)
+
+    # The query images are random noise, the stub extractors recognize them by their content
+    queries = []
+    for i in range(num_queries):
+        name = f"query_{i:05d}.png"
+        pose_c2w = scene.random_pose()
+        keypoints, descriptors, _, global_descriptor = scene.features(pose_c2w, num_keypoints)
+        image = rng.integers(0, 256, size=(kImageHeight, kImageWidth), dtype=np.uint8)
+        cv2.imwrite(str(query_images_path / name), image)
+        image_data = localizer.extract_features_preprocess(image, kStubPreprocessing)["image"]
+        localizer.feature_extractor.register(image_data, keypoints, descriptors)
+        localizer.global_feature_extractor.register(image_data, global_descriptor)
+        queries.append(Query(name, query_images_path / name, kImageWidth, kImageHeight, scene.camera_parameters, pose_c2w))
+
+    config = {
+        "reconstruction_path": str(reconstruction_path),
+        "image_path": str(query_images_path),
+        "feature_conf": "stub",
+        "matcher_conf": "stub",
+        "retrieval_conf": "stub",
+    }
+    return config, transform_path, queries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU-only synthetic benchmark of the OpenVPS MapLocalizer with stub models")
+    parser.add_argument("--num_map_images", type=int, default=100)
+    parser.add_argument("--num_queries", type=int, default=50)
+    parser.add_argument("--num_points", type=int, default=20000)
+    parser.add_argument("--num_keypoints", type=int, default=1024)
+    parser.add_argument("--descriptor_dim", type=int, default=128)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", type=str, default=None, help="quality/latency profile (the stub extractors ignore its resize_max)")
+    parser.add_argument("--data_dir", type=str, default=None, help="folder for the synthetic map (default: temporary folder)")
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    setup_logging("WARNING")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(args.data_dir) if args.data_dir is not None else Path(tmp_dir)
+        localizer = StubHlocLocalizer(map_id="synthetic")
+        config, transform_path, queries = generate_synthetic_dataset(data_dir, localizer, args.num_map_images, args.num_queries,
+            args.num_points, args.num_keypoints, args.descriptor_dim, args.seed)
+        localizer.load_map_transform(transform_path)
+        localizer.load_map(config)
+
+        thresholds = [tuple(float(v) for v in t.split(",")) for t in kDefaultThresholds.split(";")]
+        report = run_benchmark(localizer, queries, "inprocess", None, args.concurrency, args.warmup, thresholds, args.profile)
+        localizer.map_local_descriptors.close()
+
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
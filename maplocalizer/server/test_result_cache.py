@@ -0,0 +1,48 @@
+# Copyright 2025 Nokia
+# Licensed under the MIT License.
+# SPDX-License-Identifier: MIT
+
+# This file is part of OpenVPS: Open Visual Positioning Service
+# Author: Gabor Soros (gabor.soros@nokia-bell-labs.com)
+
+
+# Tests of the result cache (python -m pytest server/test_result_cache.py from the maplocalizer folder)
+
+import asyncio
+
+from result_cache import ResultCache
+
+
+def test_overlapping_computes_share_the_localization():
+    async def run():
+        cache = ResultCache(10.0)
+        calls = []
+        async def localize(result):
+            calls.append(result)
+            await asyncio.sleep(0.01)
+            return result
+        first = asyncio.create_task(cache.compute("k", lambda: localize("A")))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.compute("k", lambda: localize("B")))
+        results = await asyncio.gather(first, second)
+        return results, calls, cache
+    results, calls, cache = asyncio.run(run())
+    assert results == ["A", "A"]
+    assert calls == ["A"]
+    assert cache.pending == {}
+    assert cache.get("k") == ("A", True)
+
+
+def test_failed_compute_is_not_cached():
+    async def run():
+        cache = ResultCache(10.0)
+        async def fail():
+            raise RuntimeError("failed")
+        try:
+            await cache.compute("k", fail)
+        except RuntimeError:
+            pass
+        return cache
+    cache = asyncio.run(run())
+    assert cache.pending == {}
+    assert cache.get("k") == (None, False)